@@ -35,7 +35,8 @@ def create_app(config_class=Config):
     app.config.from_object(config_class)
 
     db.init_app(app)
-    migrate.init_app(app, db)
+    from app.fulltext import include_object
+    migrate.init_app(app, db, include_object=include_object)
     login.init_app(app)
     mail.init_app(app)
     moment.init_app(app)
@@ -43,8 +44,14 @@ def create_app(config_class=Config):
 
     app.elasticsearch = Elasticsearch([app.config.get('ELASTICSEARCH_URL')]) \
         if app.config.get('ELASTICSEARCH_URL') else None
+    from app.search import create_backend
+    app.search_backend = create_backend(app)
     app.redis = Redis.from_url(app.config['REDIS_URL'])
-    app.task_queue = rq.Queue('microblog-tasks', connection=app.redis)
+    app.task_queues = {
+        name: rq.Queue(queue_name, connection=app.redis)
+        for name, queue_name in app.config['TASK_QUEUES'].items()
+    }
+    app.task_queue = app.task_queues['default']
 
     from app.errors import bp as errors_bp
     app.register_blueprint(errors_bp)
@@ -0,0 +1,127 @@
+import redis.exceptions
+import sqlalchemy as sa
+from flask import current_app
+from app import db, notification_store, recent_posts, search, timeline
+
+# Accounts are deleted by a background task, a bounded chunk of rows per
+# transaction, so that deleting a prolific user never holds locks for long.
+# The user is flagged as deleted first, which logs them out everywhere and
+# hides them, and the user row itself goes last.
+
+
+def _chunks(query, batch_size):
+    """Yield lists of at most ``batch_size`` rows of ``query`` until it
+    returns nothing. Each chunk must be deleted before the next one is
+    asked for."""
+    while True:
+        rows = db.session.execute(query.limit(batch_size)).all()
+        if not rows:
+            return
+        yield rows
+
+
+def delete(user, progress=None):
+    """Delete ``user`` and everything they own. ``progress`` is called with
+    the percentage done after each chunk."""
+    from app.models import User, Post, Message, Conversation, Notification, Task, followers
+
+    batch_size = current_app.config['ACCOUNT_DELETE_BATCH_SIZE']
+    user_id = user.id
+    total = sum(db.session.scalar(sa.select(sa.func.count()).select_from(query.subquery()))
+                for query in (
+                    sa.select(Post.id).where(Post.user_id == user_id),
+                    sa.select(Message.id).where(sa.or_(Message.sender_id == user_id,
+                                                       Message.recipient_id == user_id)),
+                    sa.select(followers).where(sa.or_(followers.c.follower_id == user_id,
+                                                      followers.c.followed_id == user_id)),
+                )) or 1
+    done = 0
+
+    def advance(rows):
+        nonlocal done
+        db.session.commit()
+        done += len(rows)
+        if progress:
+            progress(min(99, 100 * done // total))
+
+    for rows in _chunks(sa.select(Post.id).where(Post.user_id == user_id), batch_size):
+        ids = [row.id for row in rows]
+        search.remove_many_from_index(Post.__tablename__, ids)
+        db.session.execute(sa.delete(Post).where(Post.id.in_(ids)))
+        advance(rows)
+    # once the posts are gone, so that a rebuild can't bring them back
+    recent_posts.invalidate()
+
+    # messages from the user that were still unread no longer count
+    for rows in _chunks(
+            sa.select(Conversation.owner_id, Conversation.unread_count)
+            .where(Conversation.peer_id == user_id, Conversation.unread_count > 0),
+            batch_size):
+        for row in rows:
+            db.session.execute(
+                sa.update(User)
+                .where(User.id == row.owner_id)
+                .values(unread_message_counter=sa.case(
+                    (User.unread_message_counter > row.unread_count,
+                     User.unread_message_counter - row.unread_count),
+                    else_=0,
+                ))
+            )
+            db.session.execute(
+                sa.update(Conversation)
+                .where(Conversation.owner_id == row.owner_id, Conversation.peer_id == user_id)
+                .values(unread_count=0)
+            )
+        db.session.commit()
+    for rows in _chunks(
+            sa.select(Conversation.owner_id, Conversation.peer_id)
+            .where(sa.or_(Conversation.owner_id == user_id, Conversation.peer_id == user_id)),
+            batch_size):
+        db.session.execute(sa.delete(Conversation).where(
+            sa.tuple_(Conversation.owner_id, Conversation.peer_id).in_(
+                [(row.owner_id, row.peer_id) for row in rows])))
+        db.session.commit()
+    for rows in _chunks(
+            sa.select(Message.id).where(sa.or_(Message.sender_id == user_id,
+                                               Message.recipient_id == user_id)),
+            batch_size):
+        db.session.execute(sa.delete(Message).where(Message.id.in_([row.id for row in rows])))
+        advance(rows)
+
+    for rows in _chunks(
+            sa.select(followers.c.followed_id).where(followers.c.follower_id == user_id),
+            batch_size):
+        ids = [row.followed_id for row in rows]
+        db.session.execute(
+            sa.update(User).where(User.id.in_(ids))
+            .values(follower_counter=User.follower_counter - 1))
+        db.session.execute(followers.delete().where(
+            followers.c.follower_id == user_id, followers.c.followed_id.in_(ids)))
+        advance(rows)
+    for rows in _chunks(
+            sa.select(followers.c.follower_id).where(followers.c.followed_id == user_id),
+            batch_size):
+        ids = [row.follower_id for row in rows]
+        db.session.execute(
+            sa.update(User).where(User.id.in_(ids))
+            .values(following_counter=User.following_counter - 1))
+        db.session.execute(followers.delete().where(
+            followers.c.followed_id == user_id, followers.c.follower_id.in_(ids)))
+        # their timelines hold the user's posts
+        timeline.invalidate_many(ids)
+        advance(rows)
+
+    for rows in _chunks(sa.select(Notification.id).where(Notification.user_id == user_id),
+                        batch_size):
+        db.session.execute(sa.delete(Notification).where(
+            Notification.id.in_([row.id for row in rows])))
+        db.session.commit()
+
+    db.session.execute(sa.delete(Task).where(Task.user_id == user_id))
+    db.session.execute(sa.delete(User).where(User.id == user_id))
+    db.session.commit()
+    timeline.remove_user(user_id)
+    try:
+        notification_store.remove_user(user_id)
+    except redis.exceptions.RedisError:
+        current_app.logger.warning(f'Could not remove notifications of user {user_id}')
@@ -1,6 +1,7 @@
 from werkzeug.http import HTTP_STATUS_CODES
 from werkzeug.exceptions import HTTPException
 from app.api import bp
+from app.pagination import InvalidCursor
 
 
 def error_response(status_code, message=None):
@@ -17,3 +18,8 @@ def bad_request(message):
 @bp.errorhandler(HTTPException)
 def handle_exception(e):
     return error_response(e.code)
+
+
+@bp.errorhandler(InvalidCursor)
+def handle_invalid_cursor(e):
+    return bad_request('invalid pagination cursor')
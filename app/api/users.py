@@ -1,4 +1,4 @@
-from app import db
+from app import db, recent_posts
 from app.api import bp
 import sqlalchemy as sa
 from app.models import User
@@ -15,7 +15,14 @@ def get_user(id):
 def get_users():
     page = request.args.get('page', 1, type=int)
     per_page = min(request.args.get('per_page', 10, type=int), 100)
-    return User.to_collection_dict(sa.select(User), page, per_page, 'api.get_users')
+    return User.to_collection_dict(
+        sa.select(User),
+        page,
+        per_page,
+        'api.get_users',
+        cursor=request.args.get('cursor'),
+        include_total=bool(request.args.get('include_total', 0, type=int)),
+    )
 
 
 @bp.route('/users/<int:id>/followers', methods=['GET'])
@@ -28,6 +35,8 @@ def get_followers(id):
         page,
         per_page,
         'api.get_followers',
+        cursor=request.args.get('cursor'),
+        include_total=bool(request.args.get('include_total', 0, type=int)),
         id=id,
     )
 
@@ -42,6 +51,8 @@ def get_following(id):
         page,
         per_page,
         'api.get_following',
+        cursor=request.args.get('cursor'),
+        include_total=bool(request.args.get('include_total', 0, type=int)),
         id=id,
     )
 
@@ -78,6 +89,10 @@ def update_user(id):
                 sa.select(User).where(User.email == data['email'])
             )):
         return bad_request('please use a different email address')
+    author_changed = (data.get('username', user.username) != user.username
+                      or data.get('email', user.email) != user.email)
     user.from_dict(data, new_user=False)
     db.session.commit()
+    if author_changed:
+        recent_posts.invalidate()
     return user.to_dict()
@@ -34,7 +34,7 @@ def login():
     if form.validate_on_submit():
         user_obj = db.session.scalar(
             sa.select(User).where(User.username == form.username.data))
-        if user_obj is None or not user_obj.check_password(form.password.data):
+        if user_obj is None or user_obj.deleted or not user_obj.check_password(form.password.data):
             flash(_('Invalid username or password'))
             return redirect(url_for('auth.login'))
         login_user(user_obj, remember=form.remember_me.data)
@@ -38,3 +38,138 @@ def init(lang):
             'pybabel init -i messages.pot -d app/translations -l ' + lang):
         raise RuntimeError('init command failed')
     os.remove('messages.pot')
+
+
+@bp.cli.group()
+def counters():
+    """Denormalized counter maintenance commands."""
+    pass
+
+
+@counters.command()
+@click.option('--batch-size', default=1000, help='Users recounted per transaction.')
+def reconcile(batch_size):
+    """Recount posts, followers, following and unread messages for every user."""
+    from app.models import User
+    fixed = User.reconcile_counters(batch_size)
+    click.echo(f'Fixed counters of {fixed} users.')
+
+
+@bp.cli.command()
+@click.option('--burst', is_flag=True, help='Quit once the queues are empty.')
+@click.argument('queues', nargs=-1)
+def worker(burst, queues):
+    """Run a task worker on the given queues, by default all of them in
+    order of priority."""
+    from flask import current_app
+    from app.worker import Worker
+    queues = [current_app.task_queues[name] for name in queues or current_app.task_queues]
+    Worker(queues, connection=current_app.redis).work(burst=burst)
+
+
+@bp.cli.group('last-seen')
+def last_seen():
+    """Buffered last seen time commands."""
+    pass
+
+
+@last_seen.command()
+@click.option('--batch-size', default=500, help='Users updated per transaction.')
+def flush(batch_size):
+    """Write buffered last seen times to the database."""
+    from app import last_seen as buffer
+    updated = buffer.flush(batch_size)
+    click.echo(f'Updated last seen time of {updated} users.')
+
+
+@bp.cli.group()
+def notifications():
+    """Notification store commands."""
+    pass
+
+
+@notifications.command()
+@click.option('--batch-size', default=1000, help='Rows deleted per transaction.')
+def compact(batch_size):
+    """Empty the legacy notification table."""
+    from app import notification_store
+    deleted = notification_store.compact_legacy(batch_size)
+    click.echo(f'Deleted {deleted} legacy notifications.')
+
+
+@bp.cli.group()
+def search():
+    """Search index commands."""
+    pass
+
+
+@search.command()
+@click.option('--processes', type=int, help='Processes indexing in parallel.')
+@click.option('--keep-old', is_flag=True, help='Keep the previous version of the index.')
+def reindex(processes, keep_old):
+    """Rebuild the search indices and switch searches over to them."""
+    from app.models import SearchableMixin
+
+    def progress(indexed, elapsed):
+        click.echo(f'{indexed} documents, {indexed / elapsed:.0f} per second')
+
+    for cls in SearchableMixin.__subclasses__():
+        result = cls.reindex(processes, progress, keep_old)
+        if result is None:
+            click.echo('Search is not configured.')
+            return
+        index, indexed, elapsed = result
+        click.echo(f'Indexed {indexed} documents into {index} in {elapsed:.1f}s '
+                   f'({indexed / elapsed:.0f} per second).')
+
+
+@bp.cli.group('outbox')
+def outbox_group():
+    """Outbox of post-commit side effects commands."""
+    pass
+
+
+@outbox_group.command()
+def drain():
+    """Perform the side effects that are due."""
+    from app import outbox
+    done = outbox.drain()
+    click.echo(f'Performed {done} side effects.')
+
+
+@outbox_group.command('status')
+def outbox_status():
+    """Show how far behind the outbox is."""
+    from app import outbox
+    pending, lag = outbox.lag()
+    click.echo(f'{pending} side effects pending, the oldest for {lag:.1f}s.')
+
+
+@bp.cli.group()
+def scheduler():
+    """Periodic maintenance job commands."""
+    pass
+
+
+@scheduler.command()
+def run():
+    """Enqueue maintenance jobs as they fall due. Can run on every node."""
+    from app import scheduler as periodic
+    periodic.run()
+
+
+@scheduler.command()
+def status():
+    """Show how the scheduled maintenance jobs last ran."""
+    from app import scheduler as periodic
+    for name, stats in periodic.metrics().items():
+        if not stats:
+            click.echo(f'{name}: never ran')
+            continue
+        runs = int(stats['runs'])
+        click.echo(
+            f"{name}: {stats['last_status']} {float(stats['last_duration']):.2f}s "
+            f"({stats['last_result']}), {runs} runs, {stats.get('failures', 0)} failed, "
+            f"avg {float(stats['total_duration']) / runs:.2f}s, "
+            f"max {float(stats['max_duration']):.2f}s"
+        )
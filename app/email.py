@@ -1,12 +1,24 @@
-from threading import Thread
+import pickle
+import smtplib
+import redis.exceptions
+import rq
 from flask import current_app
 from flask_mail import Message
-from app import mail
+from app import jobs, mail
 
+# Emails that don't have to be sent synchronously go to an outbox list in
+# Redis, and a single send_queued_email task at a time sends them in batches
+# over one SMTP connection. When the outbox is full, or Redis is
+# unavailable, send_email sends the email itself, which slows down whoever
+# is producing emails faster than they can be delivered.
+#
+# A batch is moved to a sending list before it is sent, and each email is
+# removed from it once the server took it, so that the emails of a
+# dispatcher that failed or crashed are sent by the next one.
 
-def send_async_email(app, msg):
-    with app.app_context():
-        mail.send(msg)
+OUTBOX_KEY = 'mail:outbox'
+SENDING_KEY = 'mail:sending'
+DISPATCHER_KEY = 'mail:dispatcher'
 
 
 def send_email(subject, sender, recipients, text_body, html_body,
@@ -17,10 +29,89 @@ def send_email(subject, sender, recipients, text_body, html_body,
     if attachments:
         for attachment in attachments:
             msg.attach(*attachment)
-    if sync:
+    if sync or not _queue(msg):
         mail.send(msg)
-    else:
-        Thread(
-            target=send_async_email,
-            args=(current_app._get_current_object(), msg)
-        ).start()
+
+
+def _queue(msg):
+    """Add ``msg`` to the outbox. Returns False if it was not queued."""
+    try:
+        if current_app.redis.llen(OUTBOX_KEY) >= current_app.config['MAIL_QUEUE_LIMIT']:
+            current_app.logger.warning('Mail outbox is full, sending synchronously')
+            return False
+        current_app.redis.rpush(OUTBOX_KEY, pickle.dumps(msg))
+    except redis.exceptions.RedisError:
+        return False
+    try:
+        _start_dispatcher()
+    except redis.exceptions.RedisError:
+        # the email is queued, and goes out with the next one
+        current_app.logger.warning('Could not start the mail dispatcher', exc_info=True)
+    return True
+
+
+def _claim_dispatcher():
+    return current_app.redis.set(
+        DISPATCHER_KEY, 1, nx=True, ex=current_app.config['MAIL_DISPATCHER_TIMEOUT'],
+    )
+
+
+def _start_dispatcher():
+    if _claim_dispatcher():
+        try:
+            jobs.enqueue(
+                'send_queued_email',
+                retry=rq.Retry(max=len(current_app.config['MAIL_RETRY_INTERVALS']),
+                               interval=current_app.config['MAIL_RETRY_INTERVALS']),
+            )
+        except:
+            # let the next email start one
+            current_app.redis.delete(DISPATCHER_KEY)
+            raise
+
+
+def _take(count):
+    """Return the emails left in the sending list by a dispatcher that
+    failed, or else move up to ``count`` emails from the outbox to the
+    sending list and return them."""
+    msgs = current_app.redis.lrange(SENDING_KEY, 0, -1)
+    if not msgs:
+        pipe = current_app.redis.pipeline()
+        for _ in range(count):
+            pipe.lmove(OUTBOX_KEY, SENDING_KEY, 'LEFT', 'RIGHT')
+        msgs = [msg for msg in pipe.execute() if msg is not None]
+    return [pickle.loads(msg) for msg in msgs]
+
+
+def _done():
+    """Remove the first email of the sending list, once it was sent."""
+    current_app.redis.lpop(SENDING_KEY)
+
+
+def dispatch():
+    """Send the emails in the outbox, MAIL_BATCH_SIZE per SMTP connection,
+    until it is empty. Returns the number of emails sent."""
+    sent = 0
+    while True:
+        batch = _take(current_app.config['MAIL_BATCH_SIZE'])
+        if not batch:
+            current_app.redis.delete(DISPATCHER_KEY)
+            # an email queued just before the dispatcher key was deleted
+            # would otherwise wait for the next one
+            if not current_app.redis.llen(OUTBOX_KEY) or not _claim_dispatcher():
+                return sent
+            continue
+        current_app.redis.expire(DISPATCHER_KEY, current_app.config['MAIL_DISPATCHER_TIMEOUT'])
+        # what isn't sent when the connection fails stays in the sending
+        # list for the retry of this task
+        with mail.connect() as conn:
+            for msg in batch:
+                try:
+                    conn.send(msg)
+                    sent += 1
+                except (smtplib.SMTPRecipientsRefused, smtplib.SMTPSenderRefused,
+                        smtplib.SMTPDataError):
+                    # retrying won't help an email the server rejected
+                    current_app.logger.error(f'Email to {msg.recipients} was rejected',
+                                             exc_info=True)
+                _done()
@@ -1,6 +1,7 @@
 from flask import render_template
 from app import db
 from app.errors import bp
+from app.pagination import InvalidCursor
 
 
 @bp.app_errorhandler(404)
@@ -8,6 +9,11 @@ def not_found_error(error):
     return render_template('errors/404.html'), 404
 
 
+@bp.app_errorhandler(InvalidCursor)
+def invalid_cursor_error(error):
+    return render_template('errors/400.html'), 400
+
+
 @bp.app_errorhandler(500)
 def internal_error(error):
     db.session.rollback()
@@ -0,0 +1,74 @@
+import gzip
+import json
+import os
+import tempfile
+import time
+import sqlalchemy as sa
+from flask import current_app
+from app import db
+
+# Post exports are written as gzipped JSON lines. Posts are streamed from the
+# database in chunks and written out as they arrive, so memory use doesn't
+# grow with the number of posts being exported. Exports kept for download
+# are removed EXPORT_TTL seconds after they were written.
+
+
+def path(task_id):
+    return os.path.join(current_app.config['EXPORTS_DIR'], f'{task_id}.ndjson.gz')
+
+
+def write(user, task_id, progress=None):
+    """Export the posts of ``user``, oldest first, and return the path of
+    the file. ``progress`` is called with the percentage done after each
+    chunk of posts."""
+    from app.models import Post
+
+    batch_size = current_app.config['EXPORT_BATCH_SIZE']
+    total_posts = user.posts_count()
+    os.makedirs(current_app.config['EXPORTS_DIR'], exist_ok=True)
+    # the posts are streamed over a connection of their own, as progress is
+    # committed in the session while the cursor is open
+    with tempfile.NamedTemporaryFile(dir=current_app.config['EXPORTS_DIR'], delete=False) as f, \
+            db.engine.connect() as connection:
+        try:
+            with gzip.open(f, 'wt', encoding='utf-8') as out:
+                rows = connection.execute(
+                    sa.select(Post.body, Post.timestamp)
+                    .where(Post.user_id == user.id)
+                    .order_by(Post.timestamp.asc())
+                    .execution_options(yield_per=batch_size)
+                )
+                for i, chunk in enumerate(rows.partitions(), 1):
+                    for post in chunk:
+                        out.write(json.dumps({
+                            'body': post.body,
+                            'timestamp': post.timestamp.isoformat() + 'Z',
+                        }) + '\n')
+                    if progress and total_posts:
+                        progress(min(99, 100 * i * batch_size // total_posts))
+        except:
+            os.remove(f.name)
+            raise
+    os.replace(f.name, path(task_id))
+    return path(task_id)
+
+
+def remove_expired():
+    """Delete the exports, and the files of exports that failed, that are
+    older than EXPORT_TTL seconds. Returns the number of files deleted."""
+    directory = current_app.config['EXPORTS_DIR']
+    oldest = time.time() - current_app.config['EXPORT_TTL']
+    removed = 0
+    try:
+        entries = list(os.scandir(directory))
+    except FileNotFoundError:
+        return 0
+    for entry in entries:
+        try:
+            if entry.is_file() and entry.stat().st_mtime < oldest:
+                os.remove(entry.path)
+                removed += 1
+        except FileNotFoundError:
+            # removed by another node
+            pass
+    return removed
@@ -0,0 +1,67 @@
+import threading
+from hashlib import md5
+import redis.exceptions
+from cachetools import LRUCache
+from flask import current_app, g, render_template
+from markupsafe import Markup
+
+# Rendered ``_post.html`` fragments are cached in a per-process LRU in front
+# of Redis. The key holds the locale and short fingerprints of the post and
+# of its author, so an edited post or a renamed author simply misses the
+# cache in every process and the stale entries age out on their own.
+
+_lru = None
+_lru_lock = threading.Lock()
+
+
+def _local_cache():
+    global _lru
+    if _lru is None:
+        _lru = LRUCache(maxsize=current_app.config['POST_FRAGMENT_CACHE_SIZE'])
+    return _lru
+
+
+def _version(*fields):
+    return md5('\0'.join(str(field) for field in fields).encode('utf-8')).hexdigest()[:12]
+
+
+def fragment_key(post, locale):
+    post_version = _version(post.body, post.language)
+    author_version = _version(post.author.username, post.author.email)
+    return f'post-fragment:{post.id}:{locale}:{post_version}:{author_version}'
+
+
+def render_posts(posts):
+    """Return the rendered ``_post.html`` fragment of each post, rendering
+    only those that are in neither cache."""
+    posts = list(posts)
+    locale = g.locale
+    keys = [fragment_key(post, locale) for post in posts]
+    with _lru_lock:
+        lru = _local_cache()
+        fragments = [lru.get(key) for key in keys]
+
+    missing = [i for i, fragment in enumerate(fragments) if fragment is None]
+    if missing:
+        try:
+            shared = current_app.redis.mget([keys[i] for i in missing])
+        except redis.exceptions.RedisError:
+            shared = [None] * len(missing)
+        rendered = {}
+        for i, fragment in zip(missing, shared):
+            if fragment is not None:
+                fragments[i] = fragment.decode('utf-8')
+            else:
+                fragments[i] = rendered[keys[i]] = render_template('_post.html', post=posts[i])
+        if rendered:
+            try:
+                pipe = current_app.redis.pipeline(transaction=False)
+                for key, fragment in rendered.items():
+                    pipe.set(key, fragment, ex=current_app.config['POST_FRAGMENT_TTL'])
+                pipe.execute()
+            except redis.exceptions.RedisError:
+                pass
+        with _lru_lock:
+            for i in missing:
+                lru[keys[i]] = fragments[i]
+    return [Markup(fragment) for fragment in fragments]
@@ -0,0 +1,209 @@
+import re
+from time import time
+import sqlalchemy as sa
+import sqlalchemy.orm as so
+from app import db, search_cache
+from app.pagination import InvalidCursor
+from app.search import Backend
+
+# Search without an external service, from a full-text index that the
+# database keeps next to each searchable table, in '<table>_search'. On
+# SQLite that is an FTS5 table ranked with bm25, on PostgreSQL a tsvector
+# column with a GIN index ranked with ts_rank_cd. Index rows are written
+# from the mapper events of the searchable rows, in the same transaction,
+# so the index is always up to date, and the cached searches of the tables
+# changed are invalidated after the commit. Other databases can't be
+# searched.
+
+DIALECTS = ('sqlite', 'postgresql')
+# PostgreSQL text search configuration; posts are in any language
+TEXT_SEARCH_CONFIG = 'simple'
+_REVERSE = {'ASC': 'DESC', 'DESC': 'ASC'}
+# how values after a position compare with it, walking in an order
+_AFTER = {'ASC': '>', 'DESC': '<'}
+
+
+def _table(index):
+    return f'{index}_search'
+
+
+def install(table, fields):
+    """Have create_all and drop_all create and drop the full-text index of
+    ``table`` on ``fields`` along with it."""
+    name = _table(table.name)
+    for ddl, dialect in (
+        (f'CREATE VIRTUAL TABLE IF NOT EXISTS {name} USING fts5({", ".join(fields)})',
+         'sqlite'),
+        (f'CREATE TABLE IF NOT EXISTS {name} (id BIGINT PRIMARY KEY, document TSVECTOR NOT NULL)',
+         'postgresql'),
+        (f'CREATE INDEX IF NOT EXISTS ix_{name}_document ON {name} USING gin (document)',
+         'postgresql'),
+    ):
+        db.event.listen(table, 'after_create', sa.DDL(ddl).execute_if(dialect=dialect))
+    db.event.listen(table, 'before_drop',
+                    sa.DDL(f'DROP TABLE IF EXISTS {name}').execute_if(dialect=DIALECTS))
+
+
+def include_object(object, name, type_, reflected, compare_to):
+    """Keep the full-text indices, and the tables FTS5 keeps them in, out
+    of autogenerated migrations."""
+    return not (type_ == 'table' and reflected and compare_to is None
+                and re.search(r'_search(_\w+)?$', name))
+
+
+def populate_sql(dialect, index, fields):
+    """Return the statement that fills the empty full-text index of table
+    ``index`` from its rows, for migrations and reindexing."""
+    if dialect == 'sqlite':
+        return (f'INSERT INTO {_table(index)} (rowid, {", ".join(fields)}) '
+                f'SELECT id, {", ".join(fields)} FROM {index}')
+    document = " || ' ' || ".join(f"coalesce({field}, '')" for field in fields)
+    return (f'INSERT INTO {_table(index)} (id, document) '
+            f"SELECT id, to_tsvector('{TEXT_SEARCH_CONFIG}', {document}) FROM {index}")
+
+
+def _ids_param(statement):
+    return sa.text(statement).bindparams(sa.bindparam('ids', expanding=True))
+
+
+def _write(connection, index, models, deleted_ids):
+    """Replace the index rows of ``models`` and delete those of
+    ``deleted_ids``."""
+    name = _table(index)
+    ids = [model.id for model in models] + list(deleted_ids)
+    if not ids:
+        return
+    if connection.dialect.name == 'sqlite':
+        connection.execute(_ids_param(f'DELETE FROM {name} WHERE rowid IN :ids'), {'ids': ids})
+        if models:
+            fields = models[0].__searchable__
+            connection.execute(
+                sa.text(f'INSERT INTO {name} (rowid, {", ".join(fields)}) '
+                        f'VALUES (:id, {", ".join(":" + field for field in fields)})'),
+                [{'id': model.id, **{field: getattr(model, field) for field in fields}}
+                 for model in models],
+            )
+    else:
+        connection.execute(_ids_param(f'DELETE FROM {name} WHERE id IN :ids'), {'ids': ids})
+        if models:
+            connection.execute(
+                sa.text(f'INSERT INTO {name} (id, document) '
+                        f"VALUES (:id, to_tsvector('{TEXT_SEARCH_CONFIG}', :document))"),
+                [{'id': model.id,
+                  'document': ' '.join(getattr(model, field) or ''
+                                       for field in model.__searchable__)}
+                 for model in models],
+            )
+
+
+def _changed(session, index):
+    session.info.setdefault('search_changed', set()).add(index)
+
+
+def after_commit(session):
+    for index in session.info.pop('search_changed', ()):
+        search_cache.invalidate(index)
+
+
+def after_rollback(session):
+    session.info.pop('search_changed', None)
+
+
+class DatabaseBackend(Backend):
+    """Documents are indexed by the database, see app.fulltext."""
+
+    @staticmethod
+    def _connection():
+        connection = db.session.connection()
+        return connection if connection.dialect.name in DIALECTS else None
+
+    def record(self, connection, target, deleted=False):
+        if connection.dialect.name in DIALECTS:
+            if deleted:
+                _write(connection, target.__tablename__, [], [target.id])
+            else:
+                _write(connection, target.__tablename__, [target], [])
+            _changed(so.object_session(target), target.__tablename__)
+
+    def sync_many(self, index, models, deleted_ids):
+        connection = self._connection()
+        if connection is not None:
+            _write(connection, index, list(models), deleted_ids)
+            _changed(db.session, index)
+        return set()
+
+    def remove_many(self, index, ids):
+        connection = self._connection()
+        if connection is not None:
+            _write(connection, index, [], ids)
+            _changed(db.session, index)
+
+    def query_after(self, index, query, size, after=None, backwards=False, state=None):
+        connection = self._connection()
+        # each word of the query is a term, and documents matching any of
+        # them are found, like an Elasticsearch match query
+        terms = re.findall(r'\w+', query)
+        if connection is None or not terms:
+            return [], (0 if after is None else None), None
+        name = _table(index)
+        params = {'size': size}
+        # documents are walked by (rank, id) with keyset pagination, the
+        # position of a document being its rank and id
+        if connection.dialect.name == 'sqlite':
+            # bm25 is lower for better matches
+            params['query'] = ' OR '.join(f'"{term}"' for term in terms)
+            ranked = (f'SELECT rowid AS id, bm25({name}) AS rank FROM {name} '
+                      f'WHERE {name} MATCH :query')
+            best_first = 'ASC'
+        else:
+            params['query'] = ' | '.join(terms)
+            # ranks are real, made double so that they compare equal to
+            # themselves after a round trip through a cursor
+            ranked = (f'SELECT id, ts_rank_cd(document, query)::float8 AS rank '
+                      f"FROM {name}, to_tsquery('{TEXT_SEARCH_CONFIG}', :query) AS query "
+                      f'WHERE document @@ query')
+            best_first = 'DESC'
+        # ties go to the newer document; walking backwards reverses it all
+        rank_order, id_order = best_first, 'DESC'
+        if backwards:
+            rank_order, id_order = _REVERSE[rank_order], _REVERSE[id_order]
+        where = ''
+        if after is not None:
+            try:
+                params['rank'], params['id'] = float(after[0]), int(after[1])
+            except (TypeError, ValueError, IndexError) as e:
+                raise InvalidCursor(after) from e
+            where = (f'WHERE rank {_AFTER[rank_order]} :rank '
+                     f'OR (rank = :rank AND id {_AFTER[id_order]} :id)')
+        rows = connection.execute(sa.text(
+            f'SELECT id, rank FROM ({ranked}) AS ranked {where} '
+            f'ORDER BY rank {rank_order}, id {id_order} LIMIT :size'), params).all()
+        total = None
+        if after is None:
+            total = connection.scalar(sa.text(f'SELECT count(*) FROM ({ranked}) AS ranked'),
+                                      params)
+        return [(row.id, [row.rank, row.id]) for row in rows], total, None
+
+    def health(self, index):
+        connection = self._connection()
+        if connection is None:
+            return None
+        return 'green', connection.scalar(sa.text(f'SELECT count(*) FROM {_table(index)}'))
+
+    def reindex(self, cls, processes=None, progress=None, keep_old=False):
+        # the database rebuilds the index in one transaction, and searches
+        # see the old index until it commits
+        connection = self._connection()
+        if connection is None:
+            return None
+        started = time()
+        index = cls.__tablename__
+        connection.execute(sa.text(f'DELETE FROM {_table(index)}'))
+        connection.execute(sa.text(populate_sql(connection.dialect.name, index,
+                                                cls.__searchable__)))
+        _changed(db.session, index)
+        db.session.commit()
+        indexed = self.health(index)[1]
+        if progress:
+            progress(indexed, time() - started)
+        return _table(index), indexed, time() - started
@@ -0,0 +1,34 @@
+from flask import current_app
+
+# Background tasks are the functions of app.tasks, run by `flask worker`.
+# Every task goes to one of the TASK_QUEUES according to TASK_ROUTES, so that
+# slow tasks such as exports can't hold up quick ones.
+
+
+def queue_for(name):
+    return current_app.task_queues[current_app.config['TASK_ROUTES'].get(name, 'default')]
+
+
+def enqueue(name, *args, **kwargs):
+    return queue_for(name).enqueue(
+        f'app.tasks.{name}',
+        *args,
+        job_timeout=current_app.config['TASK_TIMEOUT'],
+        **kwargs,
+    )
+
+
+def _lock_key(name, user_id):
+    return f'task-lock:{name}:{user_id}'
+
+
+def acquire(name, user_id):
+    """Claim the right to run task ``name`` for a user. Returns False if the
+    task is already queued or running for them."""
+    return bool(current_app.redis.set(
+        _lock_key(name, user_id), 1, nx=True, ex=current_app.config['TASK_TIMEOUT'],
+    ))
+
+
+def release(name, user_id):
+    current_app.redis.delete(_lock_key(name, user_id))
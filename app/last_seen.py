@@ -0,0 +1,52 @@
+from datetime import datetime, timezone
+import redis.exceptions
+import sqlalchemy as sa
+from flask import current_app
+from app import db
+
+# Requests record when a user was last seen in a Redis hash instead of
+# writing to the user table. flush() periodically moves the hash aside and
+# writes it out with batched UPDATEs. A hash that was moved aside but not
+# written, because the flush crashed, is picked up by the next flush.
+
+PENDING_KEY = 'last-seen'
+FLUSHING_KEY = 'last-seen:flushing'
+
+
+def record(user):
+    now = datetime.now(timezone.utc)
+    try:
+        current_app.redis.hset(PENDING_KEY, user.id, now.timestamp())
+    except redis.exceptions.RedisError:
+        user.last_seen = now
+        db.session.commit()
+
+
+def flush(batch_size=500):
+    """Write buffered last seen times to the database. Returns the number of
+    users updated."""
+    from app.models import User
+
+    if not current_app.redis.exists(FLUSHING_KEY):
+        try:
+            current_app.redis.rename(PENDING_KEY, FLUSHING_KEY)
+        except redis.exceptions.ResponseError:
+            # nothing was recorded since the last flush
+            return 0
+    pending = current_app.redis.hgetall(FLUSHING_KEY)
+
+    user = User.__table__
+    statement = (
+        sa.update(user)
+        .where(user.c.id == sa.bindparam('user_id'))
+        .values(last_seen=sa.bindparam('seen'))
+    )
+    rows = [
+        {'user_id': int(user_id), 'seen': datetime.fromtimestamp(float(seen), timezone.utc)}
+        for user_id, seen in pending.items()
+    ]
+    for i in range(0, len(rows), batch_size):
+        db.session.execute(statement, rows[i:i + batch_size])
+        db.session.commit()
+    current_app.redis.delete(FLUSHING_KEY)
+    return len(rows)
@@ -1,18 +1,26 @@
 from flask import (
     g,
+    abort,
     flash,
+    Response,
     url_for,
     request,
     redirect,
     current_app,
     render_template,
+    send_file,
+    stream_with_context,
 )
 from flask_login import (
+    logout_user,
     current_user,
     login_required,
 )
+import os
+import redis.exceptions
 import sqlalchemy as sa
-from app import db, detector
+from app import db, detector, exports, fragment_cache, last_seen, microcache, notification_store, push, recent_posts, timeline
+from app.pagination import keyset_paginate
 from google.oauth2 import service_account
 from google.cloud import translate_v2 as translate
 from google.api_core.exceptions import BadRequest
@@ -24,9 +32,9 @@ from app.main.forms import (
     EditProfileForm,
 )
 from app.main import bp
-from app.models import User, Post, Message, Notification
-from datetime import datetime, timezone
+from app.models import User, Post, Message, Conversation, Task
 from flask_babel import _, get_locale
+from markupsafe import Markup
 
 current_user: User
 
@@ -34,12 +42,16 @@ current_user: User
 @bp.before_app_request
 def before_request():
     if current_user.is_authenticated:
-        current_user.last_seen = datetime.now(timezone.utc)
-        db.session.commit()
+        last_seen.record(current_user)
         g.search_form = SearchForm()
     g.locale = str(get_locale())
 
 
+@bp.app_template_global()
+def render_posts(posts):
+    return fragment_cache.render_posts(posts)
+
+
 @bp.route('/', methods=['GET', 'POST'])
 @bp.route('/index', methods=['GET', 'POST'])
 @login_required
@@ -57,45 +69,59 @@ def index():
         flash(_('Your post in now live!'))
         return redirect(url_for('main.index'))
 
-    page = request.args.get('page', 1, type=int)
-    posts = db.paginate(
-        current_user.following_posts(),
-        page=page,
-        per_page=current_app.config.get('POSTS_PER_PAGE'),
-        error_out=False,
-    )
+    cursor = request.args.get('cursor')
+    per_page = current_app.config.get('POSTS_PER_PAGE')
+    # the home timeline is scored by time, so it keeps (timestamp, id)
+    # cursors even when snowflake ids are enabled
+    posts = timeline.home_page(current_user, cursor, per_page)
+    if posts is None:
+        posts = keyset_paginate(
+            current_user.following_posts(),
+            (Post.timestamp, Post.id),
+            cursor,
+            per_page,
+        )
 
-    next_url = url_for('main.index', page=posts.next_num) if posts.has_next else None
-    prev_url = url_for('main.index', page=posts.prev_num) if posts.has_prev else None
+    next_url = url_for('main.index', cursor=posts.next_cursor) if posts.has_next else None
+    prev_url = url_for('main.index', cursor=posts.prev_cursor) if posts.has_prev else None
 
     return render_template(
         'index.html',
         title='Home Page',
-        posts=posts.items,
         form=form,
-        next_url=next_url,
-        prev_url=prev_url,
+        feed=Markup(render_template(
+            '_feed.html',
+            posts=posts.items,
+            next_url=next_url,
+            prev_url=prev_url,
+        )),
     )
 
 
 @bp.route('/explore')
 @login_required
 def explore():
-    page = request.args.get('page', 1, type=int)
-    query = sa.select(Post).order_by(Post.timestamp.desc())
-    posts = db.paginate(
-        query,
-        page=page,
-        per_page=current_app.config.get('POSTS_PER_PAGE'),
-        error_out=False,
-    )
+    cursor = request.args.get('cursor')
+    # only the first page, which most requests are for, is cached; clients
+    # could make up any number of cursors to fill the cache with
+    if cursor:
+        feed = Markup(_explore_feed(cursor))
+    else:
+        feed = microcache.cached(f'explore:{g.locale}', lambda: _explore_feed(None))
+    return render_template('index.html', title='Explore', feed=feed)
+
 
-    next_url = url_for('main.explore', page=posts.next_num) if posts.has_next else None
-    prev_url = url_for('main.explore', page=posts.prev_num) if posts.has_prev else None
+def _explore_feed(cursor):
+    per_page = current_app.config.get('POSTS_PER_PAGE')
+    posts = recent_posts.page(cursor, per_page)
+    if posts is None:
+        posts = keyset_paginate(sa.select(Post), Post.feed_keys(), cursor, per_page)
+
+    next_url = url_for('main.explore', cursor=posts.next_cursor) if posts.has_next else None
+    prev_url = url_for('main.explore', cursor=posts.prev_cursor) if posts.has_prev else None
 
     return render_template(
-        'index.html',
-        title='Explore',
+        '_feed.html',
         posts=posts.items,
         next_url=next_url,
         prev_url=prev_url,
@@ -105,24 +131,39 @@ def explore():
 @bp.route('/user/<username>')
 @login_required
 def user(username):
-    user_obj = db.first_or_404(sa.select(User).where(User.username == username))
-    page = request.args.get('page', 1, type=int)
-    query = user_obj.posts.select().order_by(Post.timestamp.desc())
-    posts = db.paginate(query, page=page,
-                        per_page=current_app.config['POSTS_PER_PAGE'],
-                        error_out=False)
+    user_obj = db.first_or_404(
+        sa.select(User).where(User.username == username, User.deleted.is_(False)))
+    cursor = request.args.get('cursor')
+    if cursor:
+        feed = Markup(_user_feed(user_obj, cursor))
+    else:
+        feed = microcache.cached(f'user:{user_obj.id}:{g.locale}',
+                                 lambda: _user_feed(user_obj, None))
+    form = EmptyForm()
+    return render_template(
+        'user.html',
+        user=user_obj,
+        form=form,
+        feed=feed,
+    )
+
+
+def _user_feed(user_obj, cursor):
+    posts = keyset_paginate(
+        user_obj.posts.select(),
+        Post.feed_keys(),
+        cursor,
+        current_app.config['POSTS_PER_PAGE'],
+    )
     next_url = url_for(
-        'main.user', username=user_obj.username, page=posts.next_num
+        'main.user', username=user_obj.username, cursor=posts.next_cursor
     ) if posts.has_next else None
     prev_url = url_for(
-        'main.user', username=user_obj.username, page=posts.prev_num
+        'main.user', username=user_obj.username, cursor=posts.prev_cursor
     ) if posts.has_prev else None
-    form = EmptyForm()
     return render_template(
-        'user.html',
-        user=user_obj,
+        '_feed.html',
         posts=posts.items,
-        form=form,
         next_url=next_url,
         prev_url=prev_url,
     )
@@ -133,10 +174,14 @@ def user(username):
 def edit_profile():
     form = EditProfileForm(current_user.username)
     if form.validate_on_submit():
+        author_changed = (form.username.data != current_user.username
+                          or form.email.data != current_user.email)
         current_user.username = form.username.data
         current_user.about_me = form.about_me.data
         current_user.email = form.email.data
         db.session.commit()
+        if author_changed:
+            recent_posts.invalidate()
         flash(_('Your changes have been saved.'))
         return redirect(url_for('main.edit_profile'))
     elif request.method == 'GET':
@@ -147,16 +192,31 @@ def edit_profile():
         'edit_profile.html',
         title='Edit Profile',
         form=form,
+        delete_form=EmptyForm(),
     )
 
 
+@bp.route('/delete_account', methods=['POST'])
+@login_required
+def delete_account():
+    form = EmptyForm()
+    if form.validate_on_submit():
+        current_user.deleted = True
+        current_user.launch_task('delete_account', _('Deleting account...'))
+        db.session.commit()
+        logout_user()
+        flash(_('Your account is being deleted.'))
+        return redirect(url_for('main.index'))
+    return redirect(url_for('main.edit_profile'))
+
+
 @bp.route('/follow/<username>', methods=['POST'])
 def follow(username):
     form = EmptyForm()
 
     if form.validate_on_submit():
         user_obj = db.session.scalar(
-            sa.select(User).where(User.username == username)
+            sa.select(User).where(User.username == username, User.deleted.is_(False))
         )
         if user_obj is None:
             flash(_(f'User %(username)s not found.', username=username))
@@ -166,6 +226,7 @@ def follow(username):
             return redirect(url_for('main.user', username=username))
         current_user.follow(user_obj)
         db.session.commit()
+        timeline.invalidate(current_user.id)
         flash(_(f'You are following %(username)s!', username=username))
         return redirect(url_for('main.user', username=username))
     else:
@@ -178,7 +239,7 @@ def unfollow(username):
     form = EmptyForm()
     if form.validate_on_submit():
         user_obj = db.session.scalar(
-            sa.select(User).where(User.username == username)
+            sa.select(User).where(User.username == username, User.deleted.is_(False))
         )
         if user_obj is None:
             flash(_(f'User %(username)s not found.', username=username))
@@ -188,6 +249,7 @@ def unfollow(username):
             return redirect(url_for('main.user', username=username))
         current_user.unfollow(user_obj)
         db.session.commit()
+        timeline.invalidate(current_user.id)
         flash(_(f'You are not following %(username)s.', username=username))
         return redirect(url_for('main.user', username=username))
     else:
@@ -220,20 +282,19 @@ def translate_text():
 def search():
     if not g.search_form.validate():
         return redirect(url_for('main.explore'))
-    page = request.args.get('page', 1, type=int)
     posts, total = Post.search(
         g.search_form.q.data,
-        page,
+        request.args.get('cursor'),
         current_app.config.get('POSTS_PER_PAGE'),
     )
-    next_url = url_for('main.search', q=g.search_form.q.data, page=page + 1) \
-        if total > page * current_app.config.get('POSTS_PER_PAGE') else None
-    prev_url = url_for('main.search', q=g.search_form.q.data, page=page - 1) \
-        if page > 1 else None
+    next_url = url_for('main.search', q=g.search_form.q.data, cursor=posts.next_cursor) \
+        if posts.has_next else None
+    prev_url = url_for('main.search', q=g.search_form.q.data, cursor=posts.prev_cursor) \
+        if posts.has_prev else None
     return render_template(
         'search.html',
         title=_('Search'),
-        posts=posts,
+        posts=posts.items,
         next_url=next_url,
         prev_url=prev_url,
     )
@@ -242,7 +303,8 @@ def search():
 @bp.route('/user/<username>/popup')
 @login_required
 def user_popup(username):
-    user_obj = db.first_or_404(sa.select(User).where(User.username == username))
+    user_obj = db.first_or_404(
+        sa.select(User).where(User.username == username, User.deleted.is_(False)))
     form = EmptyForm()
     return render_template(
         'user_popup.html',
@@ -254,7 +316,8 @@ def user_popup(username):
 @bp.route('/send_message/<recipient>', methods=['GET', 'POST'])
 @login_required
 def send_message(recipient):
-    user_obj = db.first_or_404(sa.select(User).where(User.username == recipient))
+    user_obj = db.first_or_404(
+        sa.select(User).where(User.username == recipient, User.deleted.is_(False)))
     form = MessageForm()
     if form.validate_on_submit():
         msg = Message(
@@ -263,9 +326,10 @@ def send_message(recipient):
             body=form.message.data,
         )
         db.session.add(msg)
+        Conversation.add_message(msg)
         user_obj.add_notification(
             'unread_message_count',
-            user_obj.unread_message_count()
+            user_obj.add_unread_message()
         )
         db.session.commit()
         flash(_('Your message has been sent.'))
@@ -281,23 +345,46 @@ def send_message(recipient):
 @bp.route('/messages')
 @login_required
 def messages():
-    current_user.last_message_read_time = datetime.now(timezone.utc)
-    current_user.add_notification('unread_message_count', 0)
-    db.session.commit()
-    page = request.args.get('page', 1, type=int)
-    query = current_user.messages_received.select().order_by(Message.timestamp.desc())
-    msgs = db.paginate(
-        query,
-        page=page,
-        per_page=current_app.config.get('POSTS_PER_PAGE'),
-        error_out=False,
+    conversations = keyset_paginate(
+        current_user.conversations.select(),
+        Conversation.inbox_keys(),
+        request.args.get('cursor'),
+        current_app.config.get('POSTS_PER_PAGE'),
+    )
+    next_url = url_for('main.messages', cursor=conversations.next_cursor) \
+        if conversations.has_next else None
+    prev_url = url_for('main.messages', cursor=conversations.prev_cursor) \
+        if conversations.has_prev else None
+    return render_template(
+        'messages.html',
+        title=_('Messages'),
+        next_url=next_url,
+        prev_url=prev_url,
+        conversations=conversations.items,
     )
-    next_url = url_for('main.messages', page=msgs.next_num) \
+
+
+@bp.route('/messages/<username>')
+@login_required
+def conversation(username):
+    peer = db.first_or_404(
+        sa.select(User).where(User.username == username, User.deleted.is_(False)))
+    if current_user.mark_messages_read(peer):
+        db.session.commit()
+    msgs = keyset_paginate(
+        Message.between(current_user, peer),
+        (Message.timestamp, Message.id),
+        request.args.get('cursor'),
+        current_app.config.get('POSTS_PER_PAGE'),
+    )
+    next_url = url_for('main.conversation', username=username, cursor=msgs.next_cursor) \
         if msgs.has_next else None
-    prev_url = url_for('main.messages', page=msgs.prev_num) \
+    prev_url = url_for('main.conversation', username=username, cursor=msgs.prev_cursor) \
         if msgs.has_prev else None
     return render_template(
-        'messages.html',
+        'conversation.html',
+        title=_('Messages'),
+        peer=peer,
         next_url=next_url,
         prev_url=prev_url,
         messages=msgs.items,
@@ -308,26 +395,67 @@ def messages():
 @login_required
 def notifications():
     since = request.args.get('since', 0.0, type=float)
-    query = (
-        current_user.notifications
-        .select()
-        .where(Notification.timestamp > since)
-        .order_by(Notification.timestamp.asc())
+    wait = min(request.args.get('wait', 0, type=int),
+               current_app.config['NOTIFICATIONS_LONG_POLL_TIMEOUT'])
+    try:
+        if not wait:
+            return notification_store.latest(current_user.id, since)
+        # long poll: subscribe before looking at the store so that nothing
+        # stored in between is missed
+        with push.subscription(current_user.id) as pubsub:
+            notifications_obj = notification_store.latest(current_user.id, since)
+            if not notifications_obj:
+                db.session.close()
+                if push.wait(pubsub, wait) is not None:
+                    notifications_obj = notification_store.latest(current_user.id, since)
+    except redis.exceptions.RedisError:
+        current_app.logger.warning(f'Could not read the notifications of user {current_user.id}')
+        notifications_obj = []
+    return notifications_obj
+
+
+@bp.route('/notifications/stream')
+@login_required
+def notifications_stream():
+    since = request.headers.get('Last-Event-ID', type=float) \
+        or request.args.get('since', 0.0, type=float)
+    try:
+        pubsub = push.subscribe(current_user.id)
+        backlog = notification_store.history(current_user.id, since)
+    except redis.exceptions.RedisError:
+        current_app.logger.warning(f'Could not stream the notifications of user {current_user.id}')
+        # makes the browser give up on the stream and fall back to polling
+        return '', 503
+    # the stream can stay open for hours; don't hold a database connection
+    db.session.close()
+    return Response(
+        stream_with_context(push.stream(pubsub, backlog)),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'},
     )
-    notifications_obj: list[Notification] = db.session.scalars(query)
-    return [{
-        'name': notification.name,
-        'data': notification.get_data(),
-        'timestamp': notification.timestamp,
-    } for notification in notifications_obj]
 
 
 @bp.route('/export_posts')
 @login_required
 def export_posts():
-    if current_user.get_task_in_progress('export_posts'):
+    task = None
+    if not current_user.get_task_in_progress('export_posts'):
+        task = current_user.launch_task('export_posts', _('Exporting posts...'),
+                                        base_url=request.url_root)
+    if task is None:
         flash(_('An export task is currently in progress'))
     else:
-        current_user.launch_task('export_posts', _('Exporting posts...'))
         db.session.commit()
-    return redirect(url_for('main.user', username=current_user.username))
\ No newline at end of file
+    return redirect(url_for('main.user', username=current_user.username))
+
+
+@bp.route('/export_posts/<task_id>')
+@login_required
+def download_export(task_id):
+    db.first_or_404(current_user.tasks.select().where(
+        Task.id == task_id, Task.name == 'export_posts'))
+    path = exports.path(task_id)
+    if not os.path.exists(path):
+        abort(404)
+    return send_file(path, mimetype='application/gzip', as_attachment=True,
+                     download_name='posts.ndjson.gz')
\ No newline at end of file
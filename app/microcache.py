@@ -0,0 +1,65 @@
+import json
+import time
+import redis.exceptions
+from flask import current_app
+from markupsafe import Markup
+
+# Short-lived cache for the parts of a page that are the same for every
+# viewer. An entry is fresh for MICROCACHE_TTL seconds and can then be served
+# stale for MICROCACHE_STALE_TTL more seconds while a single request, the one
+# that wins the regeneration lock, renders its replacement. Requests that
+# find no entry at all wait up to MICROCACHE_WAIT seconds for the lock
+# holder, which is usually enough for it to finish, before they render the
+# page themselves.
+
+
+def _lock_key(key):
+    return f'{key}:lock'
+
+
+def _store(key, html):
+    ttl = current_app.config['MICROCACHE_TTL']
+    entry = json.dumps({'html': html, 'fresh_until': time.time() + ttl})
+    current_app.redis.set(key, entry, ex=ttl + current_app.config['MICROCACHE_STALE_TTL'])
+
+
+def _regenerate(key, render):
+    try:
+        html = str(render())
+        try:
+            _store(key, html)
+        except redis.exceptions.RedisError:
+            pass
+    finally:
+        try:
+            current_app.redis.delete(_lock_key(key))
+        except redis.exceptions.RedisError:
+            # the lock expires on its own
+            pass
+    return Markup(html)
+
+
+def cached(key, render):
+    """Return the cached HTML stored under ``key``, calling ``render`` to
+    produce it when it is missing or stale."""
+    key = f'microcache:{key}'
+    try:
+        entry = current_app.redis.get(key)
+        if entry is not None:
+            entry = json.loads(entry)
+            if entry['fresh_until'] > time.time():
+                return Markup(entry['html'])
+        lock_timeout = current_app.config['MICROCACHE_LOCK_TIMEOUT']
+        if current_app.redis.set(_lock_key(key), 1, nx=True, ex=lock_timeout):
+            return _regenerate(key, render)
+        if entry is not None:
+            return Markup(entry['html'])
+        deadline = time.time() + current_app.config['MICROCACHE_WAIT']
+        while time.time() < deadline:
+            time.sleep(0.05)
+            entry = current_app.redis.get(key)
+            if entry is not None:
+                return Markup(json.loads(entry)['html'])
+    except redis.exceptions.RedisError:
+        pass
+    return Markup(render())
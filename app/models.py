@@ -1,7 +1,9 @@
 import json
 import redis.exceptions
 import rq
-from app.search import add_to_index, remove_from_index, query_index
+from app.search import query_page
+from app import fulltext, jobs, outbox, push, recent_posts, timeline, snowflake
+from app.pagination import keyset_paginate
 import jwt
 from time import time
 from datetime import datetime, timezone
@@ -16,7 +18,8 @@ from hashlib import md5
 
 @login.user_loader
 def load_user(user_id):
-    return db.session.get(User, int(user_id))
+    user = db.session.get(User, int(user_id))
+    return user if user is not None and not user.deleted else None
 
 
 followers = sa.Table(
@@ -27,12 +30,30 @@ followers = sa.Table(
 )
 
 
+def link_template(endpoint, **kwargs):
+    """Build the URL for ``endpoint`` once, with an ``{id}`` placeholder to
+    be formatted for each item of a collection."""
+    return url_for(endpoint, id=_LINK_MARKER, **kwargs).replace(str(_LINK_MARKER), '{id}')
+
+
+_LINK_MARKER = 918273645546372819
+
+
 class PaginatedAPIMixin:
+    @classmethod
+    def to_dict_batch(cls, items):
+        return [item.to_dict() for item in items]
+
     @staticmethod
-    def to_collection_dict(query, page, per_page, endpoint, **kwargs):
+    def to_collection_dict(query, page, per_page, endpoint, cursor=None, include_total=False, **kwargs):
+        if cursor is not None:
+            return PaginatedAPIMixin.to_cursor_collection_dict(
+                query, cursor, per_page, endpoint, include_total, **kwargs
+            )
+        entity = query.column_descriptions[0]['entity']
         resources = db.paginate(query, page=page, per_page=per_page, error_out=False)
         data = {
-            'items': [item.to_dict() for item in resources.items],
+            'items': entity.to_dict_batch(resources.items),
             '_meta': {
                 'page': page,
                 'per_page': per_page,
@@ -56,6 +77,40 @@ class PaginatedAPIMixin:
         }
         return data
 
+    @staticmethod
+    def to_cursor_collection_dict(query, cursor, per_page, endpoint, include_total=False, **kwargs):
+        entity = query.column_descriptions[0]['entity']
+        keys = [getattr(entity, column.key) for column in sa.inspect(entity).primary_key]
+        resources = keyset_paginate(query, keys, cursor or None, per_page, descending=False)
+        if include_total:
+            kwargs['include_total'] = 1
+        data = {
+            'items': entity.to_dict_batch(resources.items),
+            '_meta': {
+                'per_page': per_page,
+                'cursor': cursor or None,
+            },
+            '_links': {
+                'self': url_for(endpoint,
+                                cursor=cursor,
+                                per_page=per_page,
+                                **kwargs),
+                'next': url_for(endpoint,
+                                cursor=resources.next_cursor,
+                                per_page=per_page,
+                                **kwargs) if resources.has_next else None,
+                'prev': url_for(endpoint,
+                                cursor=resources.prev_cursor,
+                                per_page=per_page,
+                                **kwargs) if resources.has_prev else None
+            }
+        }
+        if include_total:
+            data['_meta']['total_items'] = db.session.scalar(
+                sa.select(sa.func.count()).select_from(query.order_by(None).subquery())
+            )
+        return data
+
 
 class User(PaginatedAPIMixin, UserMixin, db.Model):
     id: so.Mapped[int] = so.mapped_column(primary_key=True)
@@ -97,19 +152,75 @@ class User(PaginatedAPIMixin, UserMixin, db.Model):
         foreign_keys='Message.recipient_id',
         back_populates='recipient',
     )
+    conversations: so.WriteOnlyMapped['Conversation'] = so.relationship(
+        foreign_keys='Conversation.owner_id',
+        back_populates='owner',
+    )
     notifications: so.WriteOnlyMapped['Notification'] = so.relationship(back_populates='user')
     tasks: so.WriteOnlyMapped['Task'] = so.relationship(back_populates='user')
+    post_counter: so.Mapped[int] = so.mapped_column(default=0)
+    follower_counter: so.Mapped[int] = so.mapped_column(default=0)
+    following_counter: so.Mapped[int] = so.mapped_column(default=0)
+    unread_message_counter: so.Mapped[int] = so.mapped_column(default=0)
+    # set while the account is being deleted by the delete_account task
+    deleted: so.Mapped[bool] = so.mapped_column(default=False)
 
     def __repr__(self):
         return '<User {}>'.format(self.username)
 
     def unread_message_count(self):
-        last_read_time = self.last_message_read_time or datetime(1900, 1, 1)
-        query = sa.select(Message).where(
-            Message.recipient == self,
-            Message.timestamp > last_read_time,
+        return self.unread_message_counter
+
+    def add_unread_message(self):
+        db.session.execute(
+            sa.update(User)
+            .where(User.id == self.id)
+            .values(unread_message_counter=User.unread_message_counter + 1)
+            .execution_options(synchronize_session=False)
         )
-        return db.session.scalar(sa.select(sa.func.count()).select_from(query.subquery()))
+        # the counter is loaded again with the messages counted by others
+        db.session.expire(self, ['unread_message_counter'])
+        return self.unread_message_counter
+
+    def mark_messages_read(self, peer=None):
+        """Reset the unread message count of the conversation with ``peer``,
+        or of all conversations. Returns False, without writing anything, if
+        there was nothing unread."""
+        # the conversations are locked, so that exactly what was unread in
+        # them is taken off the counter that new messages keep adding to
+        if peer is None:
+            if not self.unread_message_counter:
+                return False
+            conversations = db.session.scalars(
+                self.conversations.select()
+                .where(Conversation.unread_count > 0)
+                .with_for_update()
+                .execution_options(populate_existing=True)
+            ).all()
+            cleared = sum(conversation.unread_count for conversation in conversations)
+            for conversation in conversations:
+                conversation.unread_count = 0
+            self.last_message_read_time = datetime.now(timezone.utc)
+        else:
+            conversation = db.session.get(Conversation, (self.id, peer.id),
+                                          with_for_update=True, populate_existing=True)
+            if conversation is None or not conversation.unread_count:
+                return False
+            cleared = conversation.unread_count
+            conversation.unread_count = 0
+        db.session.execute(
+            sa.update(User)
+            .where(User.id == self.id)
+            .values(unread_message_counter=sa.case(
+                (User.unread_message_counter > cleared,
+                 User.unread_message_counter - cleared),
+                else_=0,
+            ))
+            .execution_options(synchronize_session=False)
+        )
+        db.session.expire(self, ['unread_message_counter'])
+        self.add_notification('unread_message_count', self.unread_message_counter)
+        return True
 
     def set_password(self, password):
         self.password_hash = generate_password_hash(password)
@@ -128,20 +239,39 @@ class User(PaginatedAPIMixin, UserMixin, db.Model):
     def follow(self, user):
         if not self.is_following(user):
             self.following.add(user)
+            self._adjust_follow_counters(user, 1)
 
     def unfollow(self, user):
         if self.is_following(user):
             self.following.remove(user)
+            self._adjust_follow_counters(user, -1)
+
+    def _adjust_follow_counters(self, user, delta):
+        # increment in SQL so that concurrent follows of the same user are
+        # not lost; new users need their ids first
+        db.session.flush()
+        assert self.id is not None and user.id is not None
+        db.session.execute(
+            sa.update(User)
+            .where(User.id == self.id)
+            .values(following_counter=User.following_counter + delta)
+            .execution_options(synchronize_session=False)
+        )
+        db.session.execute(
+            sa.update(User)
+            .where(User.id == user.id)
+            .values(follower_counter=User.follower_counter + delta)
+            .execution_options(synchronize_session=False)
+        )
+        # the counters are loaded again with the increments of others
+        db.session.expire(self, ['following_counter'])
+        db.session.expire(user, ['follower_counter'])
 
     def followers_count(self):
-        query = (sa.select(sa.func.count())
-                 .select_from(self.followers.select().subquery()))
-        return db.session.scalar(query)
+        return self.follower_counter
 
     def following_count(self):
-        query = (sa.select(sa.func.count())
-                 .select_from(self.following.select().subquery()))
-        return db.session.scalar(query)
+        return self.following_counter
 
     def following_posts(self):
         Author = so.aliased(User)
@@ -183,26 +313,22 @@ class User(PaginatedAPIMixin, UserMixin, db.Model):
         return db.session.get(User, user_id)
 
     def add_notification(self, name, data):
-        db.session.execute(
-            self.notifications
-            .delete()
-            .where(Notification.name == name)
-        )
-        n = Notification(
-            name=name,
-            payload_json=json.dumps(data),
-            user=self
-        )
-        db.session.add(n)
+        n = {'name': name, 'data': data, 'timestamp': time()}
+        push.queue(db.session, self.id, n)
         return n
 
     def launch_task(self, name, description, *args, **kwargs):
-        rq_job = current_app.task_queue.enqueue(
-            f'app.tasks.{name}',
-            self.id,
-            *args,
-            **kwargs,
-        )
+        """Enqueue task ``name`` for this user. Returns None, without
+        enqueuing anything, if the task is already queued or running for
+        them."""
+        if not jobs.acquire(name, self.id):
+            return None
+        try:
+            rq_job = jobs.enqueue(name, self.id, *args, meta={'task_lock': [name, self.id]},
+                                  **kwargs)
+        except:
+            jobs.release(name, self.id)
+            raise
         task = Task(
             id=rq_job.get_id(),
             name=name,
@@ -213,44 +339,117 @@ class User(PaginatedAPIMixin, UserMixin, db.Model):
         return task
 
     def get_tasks_in_progress(self):
-        query = self.tasks.select().where(Task.complete is False)
-        return db.session.scalars(query)
+        query = self.tasks.select().where(Task.complete.is_(False))
+        tasks = db.session.scalars(query).all()
+        Task.load_progress(tasks)
+        return tasks
 
     def get_task_in_progress(self, name):
         query = self.tasks.select().where(
             Task.name == name,
-            Task.complete is False,
+            Task.complete.is_(False),
         )
         return db.session.scalar(query)
 
     def posts_count(self):
-        query = (sa.select(sa.func.count())
-                 .select_from(self.posts.select().subquery()))
-        return db.session.scalar(query)
+        return self.post_counter
+
+    @staticmethod
+    def reconcile_counters(batch_size=1000):
+        """Recount posts, followers, following and unread messages for all
+        users, a batch of users per transaction, and fix the counters that
+        drifted. Returns the number of users that were fixed."""
+        fixed = 0
+        last_id = 0
+        while True:
+            users = db.session.execute(
+                sa.select(
+                    User.id,
+                    User.post_counter,
+                    User.follower_counter,
+                    User.following_counter,
+                    User.unread_message_counter,
+                )
+                .where(User.id > last_id)
+                .order_by(User.id)
+                .limit(batch_size)
+                .with_for_update()
+            ).all()
+            if not users:
+                break
+            ids = [user.id for user in users]
+            last_id = ids[-1]
+            post_counts = dict(db.session.execute(
+                sa.select(Post.user_id, sa.func.count())
+                .where(Post.user_id.in_(ids))
+                .group_by(Post.user_id)
+            ).all())
+            follower_counts = dict(db.session.execute(
+                sa.select(followers.c.followed_id, sa.func.count())
+                .where(followers.c.followed_id.in_(ids))
+                .group_by(followers.c.followed_id)
+            ).all())
+            following_counts = dict(db.session.execute(
+                sa.select(followers.c.follower_id, sa.func.count())
+                .where(followers.c.follower_id.in_(ids))
+                .group_by(followers.c.follower_id)
+            ).all())
+            unread_counts = dict(db.session.execute(
+                sa.select(Conversation.owner_id, sa.func.sum(Conversation.unread_count))
+                .where(Conversation.owner_id.in_(ids))
+                .group_by(Conversation.owner_id)
+            ).all())
+            updates = []
+            for user in users:
+                counters = {
+                    'post_counter': post_counts.get(user.id, 0),
+                    'follower_counter': follower_counts.get(user.id, 0),
+                    'following_counter': following_counts.get(user.id, 0),
+                    'unread_message_counter': unread_counts.get(user.id, 0),
+                }
+                if counters != {key: getattr(user, key) for key in counters}:
+                    updates.append({'id': user.id, **counters})
+            if updates:
+                db.session.execute(sa.update(User), updates)
+            db.session.commit()
+            fixed += len(updates)
+        return fixed
 
     def to_dict(self, include_email=False):
+        return User.to_dict_batch([self], include_email)[0]
 
-        data = {
-            'id': self.id,
-            'username': self.username,
-            # 'last_seen': self.last_seen.replace(
-            #     tzinfo=timezone.utc
-            # ).isoformat() if self.last_seen else None,
-            'last_seen': self.last_seen,
-            'about_me': self.about_me,
-            'post_count': self.posts_count(),
-            'follower_count': self.followers_count(),
-            'following_count': self.following_count(),
-            '_links': {
-                'self': url_for('api.get_user', id=self.id),
-                'followers': url_for('api.get_followers', id=self.id),
-                'following': url_for('api.get_following', id=self.id),
-                'avatar': self.avatar(128)
+    @classmethod
+    def to_dict_batch(cls, users, include_email=False):
+        # the counters are columns of the user rows and the links are built
+        # once per batch, so a page of users costs no queries beyond the
+        # one that loaded it
+        self_link = link_template('api.get_user')
+        followers_link = link_template('api.get_followers')
+        following_link = link_template('api.get_following')
+        items = []
+        for user in users:
+            data = {
+                'id': user.id,
+                'username': user.username,
+                # 'last_seen': user.last_seen.replace(
+                #     tzinfo=timezone.utc
+                # ).isoformat() if user.last_seen else None,
+                'last_seen': user.last_seen,
+                'about_me': user.about_me,
+                'post_count': user.posts_count(),
+                'follower_count': user.followers_count(),
+                'following_count': user.following_count(),
+                '_links': {
+                    'self': self_link.format(id=user.id),
+                    'followers': followers_link.format(id=user.id),
+                    'following': following_link.format(id=user.id),
+                    'avatar': user.avatar(128)
+                }
             }
-        }
-        if include_email:
-            data['email'] = self.email
-        return data
+            if include_email:
+                data['email'] = user.email
+            items.append(data)
+        return items
 
     def from_dict(self, data, new_user=False):
         for field in ['username', 'email', 'about_me']:
@@ -262,56 +461,83 @@ class User(PaginatedAPIMixin, UserMixin, db.Model):
 
 class SearchableMixin:
     @classmethod
-    def search(cls, expression, page, per_page) -> sa.engine.result.ScalarResult:
-        ids, total = query_index(cls.__tablename__, expression, page, per_page)
-        if total == 0:
-            # todo: warning
-            return [], 0
-        when = []
-        for i in range(len(ids)):
-            when.append((ids[i], i))
-        query = (
-            sa.select(cls)
-            .where(cls.id.in_(ids))
-            .order_by(db.case(*when, value=cls.id))
-        )
-        return db.session.scalars(query), total
+    def search(cls, expression, cursor=None, per_page=25):
+        """Return a :class:`KeysetPage` of the models matching
+        ``expression``, best first, and the number of models matching, which
+        is None past the first page."""
+        page, total = query_page(cls.__tablename__, expression, per_page, cursor)
+        if page.items:
+            when = [(id, i) for i, id in enumerate(page.items)]
+            page.items = db.session.scalars(
+                sa.select(cls)
+                .where(cls.id.in_(page.items))
+                .order_by(db.case(*when, value=cls.id))
+            ).all()
+        return page, total
 
-    @classmethod
-    def before_commit(cls, session):
-        session._changes = {
-            'add': list(session.new),
-            'update': list(session.dirty),
-            'delete': list(session.deleted)
-        }
+    @staticmethod
+    def after_commit(session):
+        if session.info.pop('outbox', False):
+            outbox.kick()
+
+    @staticmethod
+    def after_rollback(session):
+        session.info.pop('outbox', None)
+
+    @staticmethod
+    def after_insert(mapper, connection, target):
+        current_app.search_backend.record(connection, target)
+
+    @staticmethod
+    def after_update(mapper, connection, target):
+        state = sa.inspect(target)
+        if any(state.attrs[field].history.has_changes() for field in target.__searchable__):
+            current_app.search_backend.record(connection, target)
+
+    @staticmethod
+    def after_delete(mapper, connection, target):
+        current_app.search_backend.record(connection, target, deleted=True)
 
     @classmethod
-    def after_commit(cls, session):
-        for obj in session._changes['add']:
-            if isinstance(obj, SearchableMixin):
-                add_to_index(obj.__tablename__, obj)
-        for obj in session._changes['update']:
-            if isinstance(obj, SearchableMixin):
-                add_to_index(obj.__tablename__, obj)
-        for obj in session._changes['delete']:
-            if isinstance(obj, SearchableMixin):
-                remove_from_index(obj.__tablename__, obj)
-        session._changes = None
+    def reindex(cls, processes=None, progress=None, keep_old=False):
+        """Rebuild the search index of the model. Returns None if search is
+        not configured."""
+        return current_app.search_backend.reindex(cls, processes, progress, keep_old)
+
+
+class SnowflakeMixin:
+    """Models whose primary keys are generated by :mod:`app.snowflake` when
+    the ``SNOWFLAKE_IDS`` option is enabled."""
 
     @classmethod
-    def reindex(cls):
-        for obj in db.session.scalars(sa.select(cls)):
-            add_to_index(cls.__tablename__, obj)
+    def feed_keys(cls):
+        # snowflake ids sort by creation time on their own, and rows created
+        # before the switch have smaller autoincrement ids
+        if current_app.config['SNOWFLAKE_IDS']:
+            return (cls.id,)
+        return (cls.timestamp, cls.id)
+
+    @staticmethod
+    def before_insert(mapper, connection, target):
+        if target.id is None and current_app.config['SNOWFLAKE_IDS']:
+            target.id = snowflake.next_id()
 
 
-db.event.listen(db.session, 'before_commit', SearchableMixin.before_commit)
+db.event.listen(SnowflakeMixin, 'before_insert', SnowflakeMixin.before_insert, propagate=True)
 db.event.listen(db.session, 'after_commit', SearchableMixin.after_commit)
+db.event.listen(db.session, 'after_rollback', SearchableMixin.after_rollback)
+db.event.listen(SearchableMixin, 'after_insert', SearchableMixin.after_insert, propagate=True)
+db.event.listen(SearchableMixin, 'after_update', SearchableMixin.after_update, propagate=True)
+db.event.listen(SearchableMixin, 'after_delete', SearchableMixin.after_delete, propagate=True)
 
 
-class Post(SearchableMixin, db.Model):
+class Post(SnowflakeMixin, SearchableMixin, db.Model):
     __searchable__ = ['body']
 
-    id: so.Mapped[int] = so.mapped_column(primary_key=True)
+    id: so.Mapped[int] = so.mapped_column(
+        sa.BigInteger().with_variant(sa.Integer, 'sqlite'),
+        primary_key=True,
+    )
     body: so.Mapped[str] = so.mapped_column(sa.String(140))
     timestamp: so.Mapped[datetime] = so.mapped_column(
         index=True,
@@ -321,15 +547,57 @@ class Post(SearchableMixin, db.Model):
         sa.ForeignKey(User.id),
         index=True,
     )
-    author: so.Mapped[User] = so.relationship(back_populates='posts')
+    # every page that lists posts shows their authors; load them for the
+    # whole result in one query instead of one query per author
+    author: so.Mapped[User] = so.relationship(back_populates='posts', lazy='selectin')
     language: so.Mapped[str | None] = so.mapped_column(sa.String(5))
 
     def __repr__(self):
         return '<Post {}>'.format(self.body)
 
+    @staticmethod
+    def after_insert(mapper, connection, target):
+        connection.execute(
+            sa.update(User.__table__)
+            .where(User.__table__.c.id == target.user_id)
+            .values(post_counter=User.__table__.c.post_counter + 1)
+        )
+        # whenever in the transaction the post was flushed
+        so.object_session(target).info.setdefault('new_posts', []).append(target)
+
+    @staticmethod
+    def after_delete(mapper, connection, target):
+        connection.execute(
+            sa.update(User.__table__)
+            .where(User.__table__.c.id == target.user_id)
+            .values(post_counter=User.__table__.c.post_counter - 1)
+        )
 
-class Message(db.Model):
-    id: so.Mapped[int] = so.mapped_column(primary_key=True)
+    @staticmethod
+    def after_commit(session):
+        for post in session.info.pop('new_posts', ()):
+            timeline.enqueue_fan_out(post)
+            recent_posts.push(post)
+
+    @staticmethod
+    def after_rollback(session):
+        session.info.pop('new_posts', None)
+
+
+db.event.listen(db.session, 'after_commit', Post.after_commit)
+db.event.listen(db.session, 'after_rollback', Post.after_rollback)
+db.event.listen(Post, 'after_insert', Post.after_insert)
+db.event.listen(Post, 'after_delete', Post.after_delete)
+fulltext.install(Post.__table__, Post.__searchable__)
+db.event.listen(db.session, 'after_commit', fulltext.after_commit)
+db.event.listen(db.session, 'after_rollback', fulltext.after_rollback)
+
+
+class Message(SnowflakeMixin, db.Model):
+    id: so.Mapped[int] = so.mapped_column(
+        sa.BigInteger().with_variant(sa.Integer, 'sqlite'),
+        primary_key=True,
+    )
     sender_id: so.Mapped[int] = so.mapped_column(sa.ForeignKey(User.id), index=True)
     recipient_id: so.Mapped[int] = so.mapped_column(sa.ForeignKey(User.id), index=True)
     body: so.Mapped[str] = so.mapped_column(sa.String(140))
@@ -340,17 +608,97 @@ class Message(db.Model):
     author: so.Mapped[User] = so.relationship(
         foreign_keys='Message.sender_id',
         back_populates='messages_sent',
+        lazy='selectin',
     )
     recipient: so.Mapped[User] = so.relationship(
         foreign_keys='Message.recipient_id',
         back_populates='messages_received',
     )
 
+    __table_args__ = (
+        # serves the messages of a conversation, one direction at a time
+        sa.Index('ix_message_sender_recipient_timestamp', 'sender_id', 'recipient_id', 'timestamp'),
+    )
+
     def __repr__(self):
         return f'<Message {self.body}'
 
+    @staticmethod
+    def between(user, peer):
+        return sa.select(Message).where(sa.or_(
+            sa.and_(Message.sender_id == user.id, Message.recipient_id == peer.id),
+            sa.and_(Message.sender_id == peer.id, Message.recipient_id == user.id),
+        ))
+
+
+class Conversation(db.Model):
+    """Summary of the messages a user exchanged with another user. Every
+    pair of users that exchanged messages has two, one for each of them."""
+
+    owner_id: so.Mapped[int] = so.mapped_column(sa.ForeignKey(User.id), primary_key=True)
+    peer_id: so.Mapped[int] = so.mapped_column(sa.ForeignKey(User.id), primary_key=True)
+    last_message_id: so.Mapped[int] = so.mapped_column(
+        sa.BigInteger().with_variant(sa.Integer, 'sqlite'),
+        sa.ForeignKey(Message.id),
+    )
+    last_message_at: so.Mapped[datetime]
+    unread_count: so.Mapped[int] = so.mapped_column(default=0)
+    owner: so.Mapped[User] = so.relationship(
+        foreign_keys='Conversation.owner_id',
+        back_populates='conversations',
+    )
+    peer: so.Mapped[User] = so.relationship(foreign_keys='Conversation.peer_id', lazy='selectin')
+    last_message: so.Mapped[Message] = so.relationship(lazy='selectin')
+
+    __table_args__ = (
+        sa.Index('ix_conversation_owner_last_message', 'owner_id', 'last_message_at', 'peer_id'),
+    )
+
+    def __repr__(self):
+        return f'<Conversation {self.owner_id} {self.peer_id}>'
+
+    @staticmethod
+    def inbox_keys():
+        return (Conversation.last_message_at, Conversation.peer_id)
+
+    @staticmethod
+    def add_message(message):
+        """Update, or start, the conversations of the sender and of the
+        recipient of ``message``."""
+        db.session.flush()
+        Conversation._upsert(message.sender_id, message.recipient_id, message, unread=0)
+        Conversation._upsert(message.recipient_id, message.sender_id, message, unread=1)
+
+    @staticmethod
+    def _upsert(owner_id, peer_id, message, unread):
+        update = (
+            sa.update(Conversation)
+            .where(Conversation.owner_id == owner_id, Conversation.peer_id == peer_id)
+            .values(
+                last_message_id=message.id,
+                last_message_at=message.timestamp,
+                unread_count=Conversation.unread_count + unread,
+            )
+        )
+        if db.session.execute(update).rowcount:
+            return
+        try:
+            with db.session.begin_nested():
+                db.session.add(Conversation(
+                    owner_id=owner_id,
+                    peer_id=peer_id,
+                    last_message_id=message.id,
+                    last_message_at=message.timestamp,
+                    unread_count=unread,
+                ))
+        except sa.exc.IntegrityError:
+            # started by a concurrent request
+            db.session.execute(update)
+
 
 class Notification(db.Model):
+    # no longer written to, notifications are kept in Redis by
+    # app.notification_store; `flask notifications compact` empties it
     id: so.Mapped[int] = so.mapped_column(primary_key=True)
     name: so.Mapped[str] = so.mapped_column(sa.String(128), index=True)
     user_id: so.Mapped[int] = so.mapped_column(sa.ForeignKey(User.id), index=True)
@@ -361,6 +709,29 @@ class Notification(db.Model):
     def get_data(self):
         return json.loads(str(self.payload_json))
 
+    def to_dict(self):
+        return {
+            'name': self.name,
+            'data': self.get_data(),
+            'timestamp': self.timestamp,
+        }
+
+
+db.event.listen(db.session, 'after_commit', push.publish_pending)
+db.event.listen(db.session, 'after_rollback', push.discard_pending)
+
+
+class Outbox(db.Model):
+    """Side effect of a committed change that is still to be performed, see
+    :mod:`app.outbox`."""
+
+    id: so.Mapped[int] = so.mapped_column(primary_key=True)
+    topic: so.Mapped[str] = so.mapped_column(sa.String(32))
+    key: so.Mapped[str] = so.mapped_column(sa.String(128))
+    created_at: so.Mapped[float]
+    available_at: so.Mapped[float] = so.mapped_column(index=True)
+    attempts: so.Mapped[int] = so.mapped_column(default=0)
+
 
 class Task(db.Model):
     id: so.Mapped[str] = so.mapped_column(sa.String(36), primary_key=True)
@@ -371,12 +742,28 @@ class Task(db.Model):
 
     user: so.Mapped[User] = so.relationship(back_populates='tasks')
 
+    __table_args__ = (
+        sa.Index('ix_task_user_id_complete', 'user_id', 'complete'),
+    )
+
     def get_rq_job(self):
         try:
             return rq.job.Job.fetch(self.id, connection=current_app.redis)
         except (redis.exceptions.RedisError, rq.exceptions.NoSuchJobError):
             return None
 
+    @staticmethod
+    def load_progress(tasks):
+        """Fetch the progress of all ``tasks`` from their RQ jobs in a single
+        round trip to Redis."""
+        try:
+            jobs = rq.job.Job.fetch_many([task.id for task in tasks], connection=current_app.redis)
+        except redis.exceptions.RedisError:
+            jobs = [None] * len(tasks)
+        for task, job in zip(tasks, jobs):
+            task._progress = job.meta.get('progress', 0) if job is not None else 100
+
     def get_progress(self):
-        job = self.get_rq_job()
-        return job.meta.get('progress', 0) if job is not None else 100
+        if not hasattr(self, '_progress'):
+            Task.load_progress([self])
+        return self._progress
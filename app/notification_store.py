@@ -0,0 +1,97 @@
+import json
+from time import time
+import sqlalchemy as sa
+from flask import current_app
+from app import db
+
+# Notifications live in Redis rather than in the notification table. Each
+# user has a hash holding the latest notification of every name, so that
+# storing one is a single HSET however often it is repeated, and a stream
+# of the most recent notifications in the order they happened. Both keys
+# expire NOTIFICATION_TTL seconds after the user's last notification, and
+# entries older than that are ignored while the key is still alive.
+
+
+def _latest_key(user_id):
+    return f'notifications:{user_id}:latest'
+
+
+def _stream_key(user_id):
+    return f'notifications:{user_id}:stream'
+
+
+def save(pipe, user_id, notification):
+    """Add the commands that store ``notification`` to the ``pipe``
+    pipeline."""
+    ttl = current_app.config['NOTIFICATION_TTL']
+    payload = json.dumps(notification)
+    pipe.hset(_latest_key(user_id), notification['name'], payload)
+    pipe.expire(_latest_key(user_id), ttl)
+    pipe.xadd(
+        _stream_key(user_id),
+        {'notification': payload},
+        maxlen=current_app.config['NOTIFICATION_STREAM_LENGTH'],
+        approximate=True,
+    )
+    pipe.expire(_stream_key(user_id), ttl)
+
+
+def _oldest():
+    return time() - current_app.config['NOTIFICATION_TTL']
+
+
+def latest(user_id, since=0.0):
+    """Return the latest notification of each name newer than ``since``,
+    oldest first."""
+    since = max(since, _oldest())
+    notifications = [
+        json.loads(payload)
+        for payload in current_app.redis.hvals(_latest_key(user_id))
+    ]
+    return sorted(
+        (n for n in notifications if n['timestamp'] > since),
+        key=lambda n: n['timestamp'],
+    )
+
+
+def history(user_id, since=0.0):
+    """Return the notifications newer than ``since`` that are still in the
+    stream, in the order they happened."""
+    since = max(since, _oldest())
+    # stream ids start with the time they were added in milliseconds
+    entries = current_app.redis.xrange(_stream_key(user_id), min=int(since * 1000))
+    notifications = [json.loads(fields[b'notification']) for _, fields in entries]
+    return [n for n in notifications if n['timestamp'] > since]
+
+
+def remove_user(user_id):
+    current_app.redis.delete(_latest_key(user_id), _stream_key(user_id))
+
+
+def compact_legacy(batch_size=1000):
+    """Empty the notification table, which is no longer written to, in
+    transactions of ``batch_size`` rows. Rows that have not expired yet are
+    copied to the users' latest notifications unless a newer notification
+    of the same name is already there. Returns the number of rows
+    deleted."""
+    from app.models import Notification
+
+    deleted = 0
+    oldest = _oldest()
+    while True:
+        rows = db.session.scalars(
+            sa.select(Notification).order_by(Notification.id).limit(batch_size)
+        ).all()
+        if not rows:
+            return deleted
+        pipe = current_app.redis.pipeline(transaction=False)
+        for n in rows:
+            if n.timestamp > oldest:
+                pipe.hsetnx(_latest_key(n.user_id), n.name, json.dumps(n.to_dict()))
+                pipe.expire(_latest_key(n.user_id), current_app.config['NOTIFICATION_TTL'])
+        pipe.execute()
+        db.session.execute(
+            sa.delete(Notification).where(Notification.id.in_([n.id for n in rows]))
+        )
+        db.session.commit()
+        deleted += len(rows)
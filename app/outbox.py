@@ -0,0 +1,155 @@
+from time import time
+import redis.exceptions
+import sqlalchemy as sa
+from flask import current_app
+from app import db, jobs, search
+
+# Side effects of a commit that talk to other services are recorded as rows
+# of the outbox table in the same transaction as the change, rather than
+# being performed by the request after it commits. A drain_outbox task sends
+# them in batches; rows whose side effect failed are retried later with an
+# exponential backoff, so nothing is lost if a service is down or the
+# process dies right after the commit.
+#
+# A row only names what changed, as a topic and a key. The handler of the
+# topic looks at the current state of what the key names, so rows that
+# arrive late or twice are harmless.
+
+DRAINER_KEY = 'outbox:drainer'
+
+
+def record(connection, topic, key):
+    """Add a row to the outbox using ``connection``, for use in mapper
+    events."""
+    record_many(connection, topic, [key])
+
+
+def record_many(connection, topic, keys):
+    """Add a row for each of ``keys`` to the outbox using ``connection``."""
+    from app.models import Outbox
+
+    now = time()
+    connection.execute(sa.insert(Outbox.__table__), [
+        {'topic': topic, 'key': key, 'created_at': now, 'available_at': now, 'attempts': 0}
+        for key in keys
+    ])
+
+
+def _sync_search(rows):
+    """Bring the search index in line with the rows named by ``rows``, keys
+    of the form '<table>:<id>'. Returns the rows that failed."""
+    from app.models import SearchableMixin
+
+    models = {cls.__tablename__: cls for cls in SearchableMixin.__subclasses__()}
+    by_index = {}
+    for row in rows:
+        index, id = row.key.split(':')
+        by_index.setdefault(index, {}).setdefault(int(id), []).append(row)
+    failed = []
+    for index, rows_by_id in by_index.items():
+        cls = models[index]
+        existing = db.session.scalars(sa.select(cls).where(cls.id.in_(rows_by_id))).all()
+        deleted = set(rows_by_id) - {obj.id for obj in existing}
+        for id in search.sync_many(index, existing, deleted):
+            failed.extend(rows_by_id[id])
+    return failed
+
+
+HANDLERS = {
+    'search': _sync_search,
+}
+
+
+def _claim_drainer():
+    return current_app.redis.set(DRAINER_KEY, 1, nx=True, ex=current_app.config['TASK_TIMEOUT'])
+
+
+def kick():
+    """Make sure a drain_outbox task is on its way."""
+    try:
+        if _claim_drainer():
+            jobs.enqueue('drain_outbox')
+    except redis.exceptions.RedisError:
+        # the scheduled drain will pick the rows up
+        current_app.logger.warning('Could not enqueue an outbox drain')
+
+
+def _backoff(attempts):
+    return min(current_app.config['OUTBOX_MAX_BACKOFF'], 2 ** attempts)
+
+
+def drain():
+    """Perform the side effects that are due, OUTBOX_BATCH_SIZE rows at a
+    time, until none is left or a batch fails completely. Returns the
+    number of rows done."""
+    from app.models import Outbox
+
+    def due(*columns):
+        return sa.select(*columns).where(Outbox.available_at <= time()).order_by(Outbox.id)
+
+    done = 0
+    try:
+        while True:
+            rows = db.session.execute(
+                due(Outbox.id, Outbox.topic, Outbox.key, Outbox.attempts)
+                .limit(current_app.config['OUTBOX_BATCH_SIZE'])
+                .with_for_update(skip_locked=True)
+            ).all()
+            if not rows:
+                db.session.commit()
+                current_app.redis.delete(DRAINER_KEY)
+                # rows committed just before the drainer key was deleted
+                # would otherwise wait for the scheduled drain
+                if db.session.scalar(due(Outbox.id).limit(1)) is None or not _claim_drainer():
+                    return done
+                continue
+            # the rows are claimed for a while and their locks released
+            # before other services are called; the rows of a drain that
+            # dies become due again when the claim runs out
+            db.session.execute(
+                sa.update(Outbox).where(Outbox.id.in_([row.id for row in rows]))
+                .values(available_at=time() + current_app.config['OUTBOX_CLAIM_TIMEOUT'])
+            )
+            db.session.commit()
+
+            failed = []
+            by_topic = {}
+            for row in rows:
+                by_topic.setdefault(row.topic, []).append(row)
+            for topic, topic_rows in by_topic.items():
+                try:
+                    failed.extend(HANDLERS[topic](topic_rows))
+                except Exception:
+                    db.session.rollback()
+                    current_app.logger.warning(f'Outbox {topic} handler failed', exc_info=True)
+                    failed.extend(topic_rows)
+            now = time()
+            for row in failed:
+                db.session.execute(
+                    sa.update(Outbox).where(Outbox.id == row.id)
+                    .values(attempts=row.attempts + 1,
+                            available_at=now + _backoff(row.attempts + 1))
+                )
+            failed_ids = {row.id for row in failed}
+            db.session.execute(sa.delete(Outbox).where(
+                Outbox.id.in_([row.id for row in rows if row.id not in failed_ids])))
+            db.session.commit()
+            done += len(rows) - len(failed)
+            if len(failed) == len(rows):
+                # everything failed, wait for the backoff
+                current_app.redis.delete(DRAINER_KEY)
+                return done
+    except:
+        current_app.redis.delete(DRAINER_KEY)
+        raise
+
+
+def lag():
+    """Return the number of rows waiting in the outbox and the age in
+    seconds of the oldest one."""
+    from app.models import Outbox
+
+    pending, oldest = db.session.execute(
+        sa.select(sa.func.count(Outbox.id), sa.func.min(Outbox.created_at))
+    ).one()
+    return pending, time() - oldest if oldest is not None else 0.0
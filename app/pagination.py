@@ -0,0 +1,119 @@
+import json
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from binascii import Error as BinasciiError
+from datetime import datetime
+import sqlalchemy as sa
+from app import db
+
+# Keyset pagination walks a query ordered by a unique tuple of columns
+# (for example ``(Post.timestamp, Post.id)``) and resumes after the last row
+# of the previous page instead of skipping rows with OFFSET. A cursor is the
+# key of the row to resume from plus the direction to walk in, serialized as
+# an opaque url-safe string.
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def encode_cursor(values, direction='next'):
+    values = [value.isoformat() if isinstance(value, datetime) else value
+              for value in values]
+    raw = json.dumps([direction, values], separators=(',', ':')).encode('utf-8')
+    return urlsafe_b64encode(raw).rstrip(b'=').decode('ascii')
+
+
+def load_cursor(cursor):
+    """Return ``(values, direction)`` for a cursor produced by
+    :func:`encode_cursor`, with the values as they were serialized."""
+    try:
+        raw = urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        direction, values = json.loads(raw)
+    except (BinasciiError, UnicodeDecodeError, TypeError, ValueError) as e:
+        raise InvalidCursor(cursor) from e
+    if direction not in ('next', 'prev') or not isinstance(values, list):
+        raise InvalidCursor(cursor)
+    return values, direction
+
+
+def decode_cursor(cursor, keys):
+    """Return ``(values, direction)`` for a cursor produced by
+    :func:`encode_cursor`, converting the values back to the types of the
+    key columns."""
+    values, direction = load_cursor(cursor)
+    if len(values) != len(keys):
+        raise InvalidCursor(cursor)
+    try:
+        return [
+            datetime.fromisoformat(value)
+            if isinstance(key.type, sa.DateTime) else key.type.python_type(value)
+            for key, value in zip(keys, values)
+        ], direction
+    except (TypeError, ValueError) as e:
+        raise InvalidCursor(cursor) from e
+
+
+class KeysetPage:
+    def __init__(self, items, next_cursor, prev_cursor):
+        self.items = items
+        self.next_cursor = next_cursor
+        self.prev_cursor = prev_cursor
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    @property
+    def has_prev(self):
+        return self.prev_cursor is not None
+
+
+def key_of(item, keys):
+    return [getattr(item, key.key) for key in keys]
+
+
+def keyset_paginate(query, keys, cursor=None, per_page=25, descending=True):
+    """Return a :class:`KeysetPage` of ``query`` ordered by ``keys``.
+
+    ``descending`` gives the order of the "next" direction, so that for a
+    newest-first feed the next page holds older rows. Any ``ORDER BY`` already
+    on the query is replaced. Raises :class:`InvalidCursor` if the cursor is
+    malformed.
+    """
+    values, direction = decode_cursor(cursor, keys) if cursor else (None, 'next')
+    forward = direction == 'next'
+    walk_descending = descending == forward
+
+    if values is not None:
+        row, bound = sa.tuple_(*keys), sa.tuple_(*values)
+        query = query.where(row < bound if walk_descending else row > bound)
+    order = [key.desc() if walk_descending else key.asc() for key in keys]
+    query = query.order_by(None).order_by(*order).limit(per_page + 1)
+
+    return make_page(list(db.session.scalars(query)), lambda row: key_of(row, keys), values,
+                     direction, per_page)
+
+
+def make_page(items, position, values, direction, per_page):
+    """Build a :class:`KeysetPage` from up to ``per_page + 1`` items fetched
+    in walk order after the cursor position ``values``, where
+    ``position(item)`` gives the cursor position of an item."""
+    forward = direction == 'next'
+    has_more = len(items) > per_page
+    items = items[:per_page]
+    if not forward:
+        items.reverse()
+
+    next_cursor = prev_cursor = None
+    if items:
+        if has_more or not forward:
+            next_cursor = encode_cursor(position(items[-1]), 'next')
+        if values is not None and (forward or has_more):
+            prev_cursor = encode_cursor(position(items[0]), 'prev')
+    elif values is not None:
+        # walked past either end; offer the way back
+        if forward:
+            prev_cursor = encode_cursor(values, 'prev')
+        else:
+            next_cursor = encode_cursor(values, 'next')
+    return KeysetPage(items, next_cursor, prev_cursor)
@@ -0,0 +1,89 @@
+import json
+import time
+from contextlib import contextmanager
+import redis.exceptions
+from flask import current_app
+from app import notification_store
+
+# Notifications are stored and published on a per-user Redis channel once
+# the transaction that created them commits, so that browsers can be pushed
+# new events over Server-Sent Events, or woken up from a long poll, instead
+# of polling the notification table.
+
+
+def _channel(user_id):
+    return f'notifications:{user_id}'
+
+
+def queue(session, user_id, notification):
+    session.info.setdefault('notifications', []).append((user_id, notification))
+
+
+def publish_pending(session):
+    pending = session.info.pop('notifications', None)
+    if not pending:
+        return
+    try:
+        pipe = current_app.redis.pipeline(transaction=False)
+        for user_id, notification in pending:
+            notification_store.save(pipe, user_id, notification)
+            pipe.publish(_channel(user_id), json.dumps(notification))
+        pipe.execute()
+    except redis.exceptions.RedisError:
+        current_app.logger.warning(
+            f'Could not store {len(pending)} notifications of users '
+            f'{sorted({user_id for user_id, _ in pending})}')
+
+
+def discard_pending(session):
+    session.info.pop('notifications', None)
+
+
+def subscribe(user_id):
+    pubsub = current_app.redis.pubsub(ignore_subscribe_messages=True)
+    pubsub.subscribe(_channel(user_id))
+    return pubsub
+
+
+@contextmanager
+def subscription(user_id):
+    pubsub = subscribe(user_id)
+    try:
+        yield pubsub
+    finally:
+        pubsub.close()
+
+
+def wait(pubsub, timeout):
+    """Return the next notification published on ``pubsub``, or None if
+    there is none within ``timeout`` seconds."""
+    deadline = time.monotonic() + timeout
+    while True:
+        # get_message() also returns None for the subscribe confirmation
+        # it skips, so keep waiting until the deadline
+        message = pubsub.get_message(timeout=max(deadline - time.monotonic(), 0))
+        if message is not None:
+            return json.loads(message['data'])
+        if time.monotonic() >= deadline:
+            return None
+
+
+def _event(notification):
+    return f'id: {notification["timestamp"]}\ndata: {json.dumps(notification)}\n\n'
+
+
+def stream(pubsub, backlog, keepalive=15):
+    """Generate a Server-Sent Events stream of the ``backlog`` notifications
+    followed by every notification published on ``pubsub``."""
+    try:
+        yield f'retry: {current_app.config["NOTIFICATIONS_RETRY_MS"]}\n\n'
+        for notification in backlog:
+            yield _event(notification)
+        while True:
+            notification = wait(pubsub, keepalive)
+            if notification is None:
+                yield ': keepalive\n\n'
+            else:
+                yield _event(notification)
+    finally:
+        pubsub.close()
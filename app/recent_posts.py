@@ -0,0 +1,190 @@
+import json
+import threading
+from datetime import datetime, timezone
+from hashlib import md5
+import redis.exceptions
+import sqlalchemy as sa
+import sqlalchemy.orm as so
+from flask import current_app
+from app import db
+from app.pagination import decode_cursor, make_page, key_of
+
+# The newest EXPLORE_BUFFER_LENGTH posts are kept in a Redis list as JSON
+# snapshots, newest first, so that explore pages can be rendered without
+# touching the database. The list always ends with an empty sentinel entry
+# while it holds every post there is; once older posts are trimmed away the
+# sentinel goes with them and pages past the window fall back to SQL.
+#
+# Every change bumps a version counter, which lets each process keep the
+# parsed buffer in memory and reload it only when it is out of date.
+
+BUFFER_KEY = 'explore:recent'
+VERSION_KEY = 'explore:version'
+SENTINEL = '{}'
+REBUILD_ATTEMPTS = 5
+
+
+class BufferedAuthor:
+    def __init__(self, id, username, email):
+        self.id = id
+        self.username = username
+        self.email = email
+
+    def avatar(self, size):
+        digest = md5(self.email.lower().encode('utf-8')).hexdigest()
+        return f'https://www.gravatar.com/avatar/{digest}?d=identicon&s={size}'
+
+
+class BufferedPost:
+    def __init__(self, id, body, timestamp, language, author):
+        self.id = id
+        self.body = body
+        self.timestamp = timestamp
+        self.language = language
+        self.author = author
+        self.user_id = author.id
+
+
+def _utc(timestamp):
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.astimezone(timezone.utc).replace(tzinfo=None)
+    return timestamp
+
+
+def _snapshot(post):
+    return json.dumps({
+        'id': post.id,
+        'body': post.body,
+        'timestamp': _utc(post.timestamp).isoformat(),
+        'language': post.language,
+        'author': {
+            'id': post.author.id,
+            'username': post.author.username,
+            'email': post.author.email,
+        },
+    })
+
+
+def _load(entry):
+    data = json.loads(entry)
+    return BufferedPost(
+        data['id'],
+        data['body'],
+        datetime.fromisoformat(data['timestamp']),
+        data['language'],
+        BufferedAuthor(**data['author']),
+    )
+
+
+# (version, posts sorted newest first, complete) shared by all threads of
+# the process
+_local_copy = (None, [], False)
+_local_copy_lock = threading.Lock()
+
+
+def push(post):
+    """Add a newly committed post to the buffer, if the buffer exists."""
+    try:
+        pipe = current_app.redis.pipeline()
+        pipe.lpushx(BUFFER_KEY, _snapshot(post))
+        pipe.ltrim(BUFFER_KEY, 0, current_app.config['EXPLORE_BUFFER_LENGTH'])
+        pipe.incr(VERSION_KEY)
+        pipe.execute()
+    except redis.exceptions.RedisError:
+        current_app.logger.warning(f'Could not add post {post.id} to the explore buffer')
+
+
+def invalidate():
+    """Drop the buffer, for changes that affect posts already in it."""
+    try:
+        pipe = current_app.redis.pipeline()
+        pipe.delete(BUFFER_KEY)
+        pipe.incr(VERSION_KEY)
+        pipe.execute()
+    except redis.exceptions.RedisError:
+        current_app.logger.warning('Could not invalidate the explore buffer')
+
+
+def rebuild():
+    """Fill the buffer from the database. Returns False if posts kept being
+    added while it was read, in which case it is left as it was."""
+    from app.models import Post
+
+    length = current_app.config['EXPLORE_BUFFER_LENGTH']
+    query = (
+        sa.select(Post)
+        .options(so.joinedload(Post.author))
+        .order_by(*[key.desc() for key in Post.feed_keys()])
+        .limit(length)
+    )
+    with current_app.redis.pipeline() as pipe:
+        for _ in range(REBUILD_ATTEMPTS):
+            try:
+                # a post pushed from here on bumps the version and aborts the
+                # rebuild; the read has a session and transaction of its own,
+                # so it sees every post pushed before
+                pipe.watch(VERSION_KEY)
+                with so.Session(db.engine) as session:
+                    entries = [_snapshot(post) for post in session.scalars(query)]
+                if len(entries) < length:
+                    entries.append(SENTINEL)
+                pipe.multi()
+                pipe.delete(BUFFER_KEY)
+                pipe.rpush(BUFFER_KEY, *entries)
+                pipe.incr(VERSION_KEY)
+                pipe.execute()
+                return True
+            except redis.exceptions.WatchError:
+                continue
+    current_app.logger.warning('Gave up rebuilding the explore buffer')
+    return False
+
+
+def _buffered_posts(keys):
+    global _local_copy
+    version = current_app.redis.get(VERSION_KEY)
+    if version is not None and version == _local_copy[0]:
+        return _local_copy[1], _local_copy[2]
+    with _local_copy_lock:
+        entries = current_app.redis.lrange(BUFFER_KEY, 0, -1)
+        if not entries:
+            rebuild()
+            version = current_app.redis.get(VERSION_KEY)
+            entries = current_app.redis.lrange(BUFFER_KEY, 0, -1)
+        posts = {}
+        for entry in entries:
+            if entry != SENTINEL.encode('utf-8'):
+                post = _load(entry)
+                posts[post.id] = post
+        posts = sorted(posts.values(), key=lambda post: key_of(post, keys), reverse=True)
+        complete = SENTINEL.encode('utf-8') in entries
+        _local_copy = (version, posts, complete)
+    return posts, complete
+
+
+def page(cursor, per_page):
+    """Return a :class:`KeysetPage` of explore posts served from the buffer.
+
+    ``None`` is returned when the page reaches past the buffered window or
+    Redis is unavailable, in which case the caller should run the SQL query
+    with the same cursor.
+    """
+    from app.models import Post
+
+    keys = Post.feed_keys()
+    values, direction = decode_cursor(cursor, keys) if cursor else (None, 'next')
+    forward = direction == 'next'
+    try:
+        posts, complete = _buffered_posts(keys)
+    except redis.exceptions.RedisError:
+        return None
+
+    if values is not None:
+        if forward:
+            posts = [post for post in posts if key_of(post, keys) < values]
+        else:
+            posts = [post for post in reversed(posts) if key_of(post, keys) > values]
+    if forward and len(posts) <= per_page and not complete:
+        return None
+    return make_page(posts[:per_page + 1], lambda post: key_of(post, keys), values, direction,
+                     per_page)
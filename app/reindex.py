@@ -0,0 +1,101 @@
+import multiprocessing
+from time import time
+import sqlalchemy as sa
+from elasticsearch import Elasticsearch
+from flask import current_app
+from app import db, search
+
+# A reindex builds a new version of the index behind the alias searches go
+# through, then swaps the alias over to it atomically, so searches keep
+# working from the old version until the new one is complete. The rows are
+# cut into id ranges of REINDEX_RANGE_SIZE rows, which a pool of processes
+# stream through with yield_per and send to Elasticsearch with the bulk API.
+# Changes indexed from the outbox while the build runs go to both versions.
+
+
+def _ranges(cls, range_size):
+    """Return the (first, next) id bounds of consecutive ranges of
+    ``range_size`` rows of ``cls``. The last range has no next id."""
+    numbered = sa.select(
+        cls.id, sa.func.row_number().over(order_by=cls.id).label('number'),
+    ).subquery()
+    firsts = db.session.scalars(
+        sa.select(numbered.c.id)
+        .where((numbered.c.number - 1) % range_size == 0)
+        .order_by(numbered.c.id)
+    ).all()
+    return list(zip(firsts, firsts[1:] + [None]))
+
+
+def _init_process(app):
+    # the processes are forked with the application already loaded, but
+    # must not share connections with the parent
+    app.app_context().push()
+    db.engine.dispose(close=False)
+    app.elasticsearch = Elasticsearch([app.config['ELASTICSEARCH_URL']])
+
+
+def _index_range(cls, index, first, next, batch_size):
+    """Add the documents of the rows of ``cls`` from id ``first`` up to
+    ``next`` to ``index``. Returns the number added and failed."""
+    query = sa.select(cls.id, *[getattr(cls, field) for field in cls.__searchable__]) \
+        .where(cls.id >= first)
+    if next is not None:
+        query = query.where(cls.id < next)
+    rows = db.session.execute(query.order_by(cls.id).execution_options(yield_per=batch_size))
+    try:
+        return search.bulk_create(index, rows, cls.__searchable__, batch_size)
+    finally:
+        # the rows are not all read if the bulk requests failed
+        rows.close()
+        db.session.rollback()
+
+
+def _index_range_args(args):
+    return _index_range(*args)
+
+
+def rebuild(cls, processes=None, progress=None, keep_old=False):
+    """Rebuild the index of ``cls`` with ``processes`` processes, by default
+    REINDEX_PROCESSES. ``progress`` is called with the number of documents
+    indexed and the seconds elapsed after each range. Unless ``keep_old``
+    is set, the previous versions of the index are deleted. Returns the
+    name of the new index, the number of documents and the seconds it
+    took."""
+    config = current_app.config
+    processes = processes or config['REINDEX_PROCESSES']
+    alias = cls.__tablename__
+    started = time()
+    index = search.create_index(alias)
+    indexed = failed = 0
+    try:
+        work = [(cls, index, first, next, config['REINDEX_BATCH_SIZE'])
+                for first, next in _ranges(cls, config['REINDEX_RANGE_SIZE'])]
+        db.session.rollback()
+        if processes == 1:
+            pool = None
+            results = map(_index_range_args, work)
+        else:
+            pool = multiprocessing.get_context('fork').Pool(
+                processes, _init_process, (current_app._get_current_object(),))
+            results = pool.imap_unordered(_index_range_args, work)
+        try:
+            for added, errors in results:
+                indexed += added
+                failed += errors
+                if progress:
+                    progress(indexed, time() - started)
+        finally:
+            if pool:
+                pool.terminate()
+        if failed:
+            raise RuntimeError(f'{failed} documents could not be indexed, {alias} was left as it was')
+        old = search.promote(alias, index)
+    except BaseException:
+        search.finish_building(alias)
+        search.delete_indices([index])
+        raise
+    search.finish_building(alias)
+    if not keep_old:
+        search.delete_indices(old)
+    return index, indexed, time() - started
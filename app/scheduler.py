@@ -0,0 +1,135 @@
+import time
+import redis.exceptions
+import sqlalchemy as sa
+from flask import current_app
+from app import db, jobs
+
+# `flask scheduler run` enqueues the maintenance jobs in SCHEDULE as they fall
+# due. It can run on every node: each time a job is due, the nodes race for
+# a Redis lock that lasts for the job's interval, and only the one that wins
+# enqueues it. The job itself runs on a task worker, which records how long
+# it took and how it ended in a Redis hash per job.
+
+
+def _flush_last_seen():
+    from app import last_seen
+    return f'{last_seen.flush()} users updated'
+
+
+def _compact_notifications():
+    from app import notification_store
+    return f'{notification_store.compact_legacy()} rows deleted'
+
+
+def _reconcile_counters():
+    from app.models import User
+    return f'{User.reconcile_counters()} users fixed'
+
+
+def _search_health():
+    from app import search
+    from app.models import Post
+    health = search.health(Post.__tablename__)
+    if health is None:
+        return 'search is not configured'
+    status, indexed = health
+    posts = db.session.scalar(sa.select(sa.func.count(Post.id)))
+    if status == 'red' or indexed != posts:
+        current_app.logger.warning(
+            f'Search index is {status} with {indexed} of {posts} posts indexed')
+    return f'{status}, {indexed} of {posts} posts indexed'
+
+
+def _drain_outbox():
+    from app import outbox
+    done = outbox.drain()
+    pending, lag = outbox.lag()
+    if lag > current_app.config['OUTBOX_LAG_WARNING']:
+        current_app.logger.warning(f'Outbox is {lag:.0f}s behind with {pending} rows pending')
+    return f'{done} done, {pending} pending, {lag:.1f}s behind'
+
+
+def _remove_expired_exports():
+    from app import exports
+    return f'{exports.remove_expired()} exports removed'
+
+
+JOBS = {
+    'flush_last_seen': _flush_last_seen,
+    'compact_notifications': _compact_notifications,
+    'reconcile_counters': _reconcile_counters,
+    'search_health': _search_health,
+    'drain_outbox': _drain_outbox,
+    'remove_expired_exports': _remove_expired_exports,
+}
+
+
+def _metrics_key(name):
+    return f'scheduler:metrics:{name}'
+
+
+def enqueue_due():
+    """Enqueue the jobs that are due and that no other node has claimed.
+    Returns their names."""
+    enqueued = []
+    for name, interval in current_app.config['SCHEDULE'].items():
+        if current_app.redis.set(f'scheduler:due:{name}', 1, nx=True, ex=interval):
+            jobs.enqueue('run_scheduled_job', name)
+            enqueued.append(name)
+    return enqueued
+
+
+def run(tick=1.0):
+    """Enqueue jobs as they fall due, forever."""
+    while True:
+        try:
+            for name in enqueue_due():
+                current_app.logger.info(f'Enqueued scheduled job {name}')
+        except redis.exceptions.RedisError:
+            current_app.logger.warning('Scheduler could not reach Redis', exc_info=True)
+        time.sleep(tick)
+
+
+def run_job(name):
+    """Run scheduled job ``name`` unless it is still running from an
+    earlier turn, and record its metrics."""
+    running_key = f'scheduler:running:{name}'
+    if not current_app.redis.set(running_key, 1, nx=True, ex=current_app.config['TASK_TIMEOUT']):
+        current_app.logger.warning(f'Scheduled job {name} is still running, skipped')
+        return
+    started = time.time()
+    try:
+        result = JOBS[name]()
+        status = 'ok'
+    except Exception as e:
+        db.session.rollback()
+        result = repr(e)
+        status = 'failed'
+        current_app.logger.error(f'Scheduled job {name} failed', exc_info=True)
+    finally:
+        current_app.redis.delete(running_key)
+    duration = time.time() - started
+    key = _metrics_key(name)
+    pipe = current_app.redis.pipeline()
+    pipe.hincrby(key, 'runs', 1)
+    if status == 'failed':
+        pipe.hincrby(key, 'failures', 1)
+    pipe.hincrbyfloat(key, 'total_duration', duration)
+    pipe.hset(key, mapping={
+        'last_run_at': started,
+        'last_duration': duration,
+        'last_status': status,
+        'last_result': result,
+    })
+    pipe.execute()
+    if duration > float(current_app.redis.hget(key, 'max_duration') or 0):
+        current_app.redis.hset(key, 'max_duration', duration)
+
+
+def metrics():
+    """Return the recorded metrics of every scheduled job."""
+    stats = {}
+    for name in current_app.config['SCHEDULE']:
+        raw = current_app.redis.hgetall(_metrics_key(name))
+        stats[name] = {key.decode(): value.decode() for key, value in raw.items()}
+    return stats
@@ -1,31 +1,311 @@
+from time import time
+import redis.exceptions
+import sqlalchemy.orm as so
 from flask import current_app
-from elasticsearch import Elasticsearch
+from elasticsearch import BadRequestError, Elasticsearch, NotFoundError
+from elasticsearch.helpers import bulk
+from app import db, search_cache
+from app.pagination import InvalidCursor, load_cursor, make_page
 
 current_app.elasticsearch: Elasticsearch
 
+# The functions of this module hand searches and writes over to the search
+# backend the application was configured with, current_app.search_backend.
+# SEARCH_BACKEND picks it: 'elasticsearch', 'database' for the full-text
+# index of the database in app.fulltext, or 'none'. By default it is
+# Elasticsearch when ELASTICSEARCH_URL is set and the database otherwise.
+
+
+def create_backend(app):
+    name = app.config['SEARCH_BACKEND'] or \
+        ('elasticsearch' if app.config.get('ELASTICSEARCH_URL') else 'database')
+    if name == 'elasticsearch':
+        return ElasticsearchBackend()
+    if name == 'database':
+        from app.fulltext import DatabaseBackend
+        return DatabaseBackend()
+    return Backend()
+
+
+class Backend:
+    """A search backend. This one does nothing and finds nothing, and is
+    used when search is turned off."""
+
+    def record(self, connection, target, deleted=False):
+        """Take note that searchable ``target`` was added, changed or
+        ``deleted``. Called from mapper events with the ``connection`` of
+        the flush."""
+        pass
+
+    def sync_many(self, index, models, deleted_ids):
+        """Index ``models`` and delete the documents of ``deleted_ids``.
+        Returns the ids whose documents failed."""
+        return set()
+
+    def remove_many(self, index, ids):
+        """Delete the documents of ``ids`` along with the rows, when the
+        transaction of the session commits."""
+        pass
+
+    def query_after(self, index, query, size, after=None, backwards=False, state=None):
+        """Return up to ``size`` documents matching ``query``, best first,
+        that come after the position ``after``, or before it if
+        ``backwards``, as (id, position) pairs in the order walked. The
+        position of a document serializes to JSON. Also returns the number
+        of documents matching, which is only counted for the first page,
+        when ``after`` is None, and the ``state`` to hand to the next
+        call for a consistent view of the documents."""
+        return [], (0 if after is None else None), None
+
+    def health(self, index):
+        """Return the health status of ``index`` and the number of documents
+        in it, or None if search is not configured."""
+        return None
+
+    def reindex(self, cls, processes=None, progress=None, keep_old=False):
+        """Rebuild the index of ``cls``. Returns the name of the index, the
+        number of documents and the seconds it took, or None if search is
+        not configured."""
+        return None
+
+
+class ElasticsearchBackend(Backend):
+    """Documents are indexed by Elasticsearch. Changes go through the
+    outbox, see app.outbox."""
+
+    def record(self, connection, target, deleted=False):
+        from app import outbox
+        outbox.record(connection, 'search', f'{target.__tablename__}:{target.id}')
+        so.object_session(target).info['outbox'] = True
+
+    def sync_many(self, index, models, deleted_ids):
+        targets = _targets(index)
+        actions = [
+            {
+                '_op_type': 'index',
+                '_index': target,
+                '_id': model.id,
+                '_source': {field: getattr(model, field) for field in model.__searchable__},
+            }
+            for target in targets for model in models
+        ] + [{'_op_type': 'delete', '_index': target, '_id': id}
+             for target in targets for id in deleted_ids]
+        # the cached searches are invalidated once the changes are visible
+        _, errors = bulk(current_app.elasticsearch, actions, raise_on_error=False,
+                         refresh='wait_for')
+        search_cache.invalidate(index)
+        failed = set()
+        for error in errors:
+            (op, result), = error.items()
+            # deleting a document that was never indexed is not a failure
+            if not (op == 'delete' and result.get('status') == 404):
+                failed.add(int(result['_id']))
+        return failed
+
+    def remove_many(self, index, ids):
+        from app import outbox
+        outbox.record_many(db.session.connection(), 'search', [f'{index}:{id}' for id in ids])
+        db.session.info['outbox'] = True
+
+    def query_after(self, index, query, size, after=None, backwards=False, state=None):
+        es = current_app.elasticsearch
+        match = {'multi_match': {'query': query, 'fields': ['*']}}
+        if after is None:
+            # the first page, which most searches stop at, is a plain search;
+            # the next one starts after its documents by offset
+            search = es.search(index=index, query=match, size=size)
+            hits = [(int(hit['_id']), ['offset', i + 1])
+                    for i, hit in enumerate(search['hits']['hits'])]
+            return hits, search['hits']['total']['value'], None
+
+        # deeper pages walk a point in time of the index with search_after,
+        # and don't count the documents matching
+        keep_alive = current_app.config['SEARCH_KEEP_ALIVE']
+        # a position is an offset, ['offset', n], or the sort values of a
+        # document, [score, shard doc]
+        if not isinstance(after, list) or len(after) != 2:
+            raise InvalidCursor(after)
+        by_offset = after[0] == 'offset'
+        if not all(isinstance(value, (int, float)) and not isinstance(value, bool)
+                   for value in after[1 if by_offset else 0:]):
+            raise InvalidCursor(after)
+        order = 'asc' if backwards and not by_offset else 'desc'
+        params = {
+            'query': match,
+            'size': size,
+            'sort': [{'_score': order}, {'_shard_doc': order}],
+            'track_total_hits': False,
+        }
+        if by_offset:
+            if not isinstance(after[1], int) or after[1] < 0:
+                raise InvalidCursor(after)
+            if backwards:
+                params['from_'] = max(0, after[1] - size)
+                params['size'] = min(size, after[1])
+            else:
+                params['from_'] = after[1]
+        else:
+            params['search_after'] = after
+        try:
+            if state is not None:
+                try:
+                    search = es.search(pit={'id': state, 'keep_alive': keep_alive}, **params)
+                except NotFoundError:
+                    # the point in time expired, carry on from a new one
+                    state = None
+            if state is None:
+                state = es.open_point_in_time(index=index, keep_alive=keep_alive)['id']
+                search = es.search(pit={'id': state, 'keep_alive': keep_alive}, **params)
+        except BadRequestError as e:
+            # a position or point in time that was tampered with
+            raise InvalidCursor(after) from e
+        hits = [(int(hit['_id']), hit['sort']) for hit in search['hits']['hits']]
+        if by_offset and backwards:
+            hits.reverse()
+        return hits, None, search.get('pit_id', state)
+
+    def health(self, index):
+        status = current_app.elasticsearch.cluster.health(index=index)['status']
+        count = current_app.elasticsearch.count(index=index)['count']
+        return status, count
+
+    def reindex(self, cls, processes=None, progress=None, keep_old=False):
+        from app import reindex
+        result = reindex.rebuild(cls, processes, progress, keep_old)
+        search_cache.invalidate(cls.__tablename__)
+        return result
+
 
 def add_to_index(index, model):
-    if not current_app.elasticsearch:
-        return
-    payload = {}
-    for field in model.__searchable__:
-        payload[field] = getattr(model, field)
-    current_app.elasticsearch.index(index=index, id=model.id, document=payload)
+    current_app.search_backend.sync_many(index, [model], [])
 
 
 def remove_from_index(index, model):
-    if not current_app.elasticsearch:
-        return
-    current_app.elasticsearch.delete(index=index, id=model.id)
-
-
-def query_index(index, query, page, per_page):
-    if not current_app.elasticsearch:
-        return [], 0
-    search = current_app.elasticsearch.search(
-        index=index,
-        query={'multi_match': {'query': query, 'fields': ['*']}},
-        from_=(page - 1) * per_page,
-        size=per_page)
-    ids = [int(hit['_id']) for hit in search['hits']['hits']]
-    return ids, search['hits']['total']['value']
+    current_app.search_backend.sync_many(index, [], [model.id])
+
+
+def remove_many_from_index(index, ids):
+    current_app.search_backend.remove_many(index, ids)
+
+
+def sync_many(index, models, deleted_ids):
+    return current_app.search_backend.sync_many(index, models, deleted_ids)
+
+
+def health(index):
+    return current_app.search_backend.health(index)
+
+
+def query_page(index, query, per_page, cursor=None):
+    """Return a :class:`KeysetPage` of the ids of the documents matching
+    ``query``, best first, from ``cursor``, and the number of documents
+    matching, which is None past the first page. Raises
+    :class:`InvalidCursor` if the cursor is malformed."""
+    backend = current_app.search_backend
+    if cursor is None:
+        hits, total, state = search_cache.first_page(
+            index, query, per_page,
+            lambda query, per_page: backend.query_after(index, query, per_page + 1),
+        )
+        after, direction = None, 'next'
+    else:
+        values, direction = load_cursor(cursor)
+        if len(values) != 2 or not isinstance(values[0], (str, type(None))) \
+                or not isinstance(values[1], list):
+            raise InvalidCursor(cursor)
+        state, after = values
+        hits, total, state = backend.query_after(
+            index, search_cache.normalize(query), per_page + 1, after,
+            direction == 'prev', state)
+
+    # cursors carry the search state along with the position in the results
+    page = make_page(hits, lambda hit: [state, hit[1]],
+                     None if after is None else [state, after], direction, per_page)
+    page.items = [id for id, _ in page.items]
+    return page, total
+
+
+# Elasticsearch searches and writes go through an alias named after the
+# table, which points at a versioned index '<table>-<timestamp>'. While a
+# new version is being built, writes also go to it, see app.reindex.
+
+
+def _building_key(alias):
+    return f'search:building:{alias}'
+
+
+def _targets(alias):
+    """Return the indices a write to ``alias`` has to go to."""
+    try:
+        building = current_app.redis.get(_building_key(alias))
+    except redis.exceptions.RedisError:
+        current_app.logger.warning(f'Could not check whether {alias} is being rebuilt')
+        building = None
+    return [alias, building.decode()] if building else [alias]
+
+
+def create_index(alias):
+    """Create a new version of the index behind ``alias`` and return its
+    name. Writes to ``alias`` go to it as well until finish_building is
+    called. It has no replicas and is not refreshed while it is built."""
+    index = f'{alias}-{int(time() * 1000)}'
+    current_app.elasticsearch.indices.create(
+        index=index, settings={'number_of_replicas': 0, 'refresh_interval': '-1'})
+    current_app.redis.set(_building_key(alias), index)
+    return index
+
+
+def finish_building(alias):
+    current_app.redis.delete(_building_key(alias))
+
+
+def bulk_create(index, rows, fields, chunk_size):
+    """Add a document for each of ``rows``, which have an id and the
+    ``fields`` attributes, in bulk requests of ``chunk_size`` documents.
+    Returns the number of documents added and of documents that failed."""
+    actions = (
+        {
+            # a document that is already there was written by a change
+            # made since the row was read, so it is newer
+            '_op_type': 'create',
+            '_index': index,
+            '_id': row.id,
+            '_source': {field: getattr(row, field) for field in fields},
+        }
+        for row in rows
+    )
+    created, errors = bulk(current_app.elasticsearch, actions, chunk_size=chunk_size,
+                           raise_on_error=False)
+    return created, sum(1 for error in errors if error['create'].get('status') != 409)
+
+
+def promote(alias, index):
+    """Give ``index`` the replicas of the index ``alias`` points at, then
+    point ``alias`` at ``index`` alone in a single atomic step. Returns the
+    names of the indices ``alias`` pointed at before."""
+    es = current_app.elasticsearch
+    old = []
+    actions = []
+    replicas = None
+    if es.indices.exists_alias(name=alias):
+        old = list(es.indices.get_alias(name=alias))
+        actions = [{'remove': {'index': name, 'alias': alias}} for name in old]
+    elif es.indices.exists(index=alias):
+        # an index from before they were versioned, which has the name the
+        # alias needs
+        actions = [{'remove_index': {'index': alias}}]
+    if es.indices.exists(index=alias):
+        settings = es.indices.get_settings(index=alias, name='index.number_of_replicas',
+                                           flat_settings=True)
+        replicas = next(iter(settings.values()))['settings']['index.number_of_replicas']
+    es.indices.put_settings(index=index, settings={
+        'index': {'number_of_replicas': replicas, 'refresh_interval': None},
+    })
+    es.indices.refresh(index=index)
+    es.indices.update_aliases(actions=actions + [{'add': {'index': index, 'alias': alias}}])
+    return old
+
+
+def delete_indices(names):
+    if names:
+        current_app.elasticsearch.indices.delete(index=names)
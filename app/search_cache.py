@@ -0,0 +1,74 @@
+import json
+import threading
+import unicodedata
+from hashlib import md5
+import redis.exceptions
+from cachetools import TTLCache
+from flask import current_app
+
+# The first pages of search results, which most searches stop at, are
+# cached for SEARCH_CACHE_TTL seconds in a per-process LRU in front of Redis.
+# Queries that only differ in case, Unicode form or spacing share an entry.
+# The key holds a generation number of the index, which is bumped whenever
+# its documents change, so that every process misses the cache on the next
+# search after a change and the stale entries age out on their own.
+
+_lru = None
+_lru_lock = threading.Lock()
+
+
+def _local_cache():
+    global _lru
+    if _lru is None:
+        _lru = TTLCache(maxsize=current_app.config['SEARCH_CACHE_SIZE'],
+                        ttl=current_app.config['SEARCH_CACHE_TTL'])
+    return _lru
+
+
+def _generation_key(index):
+    return f'search:generation:{index}'
+
+
+def normalize(query):
+    return ' '.join(unicodedata.normalize('NFKC', query).casefold().split())
+
+
+def invalidate(index):
+    """Make the cached results of ``index`` stale."""
+    try:
+        current_app.redis.incr(_generation_key(index))
+    except redis.exceptions.RedisError:
+        current_app.logger.warning(f'Could not invalidate cached searches of {index}')
+
+
+def first_page(index, query, per_page, run):
+    """Return the result of ``run(query, per_page)``, the first page of
+    results for ``query``, from the cache if it is there. ``run`` is given
+    the normalized query and its result must serialize to JSON."""
+    query = normalize(query)
+    try:
+        generation = int(current_app.redis.get(_generation_key(index)) or 0)
+    except redis.exceptions.RedisError:
+        # without the generation a cached result may be stale
+        return run(query, per_page)
+    digest = md5(query.encode('utf-8')).hexdigest()
+    key = f'search:{index}:{generation}:{per_page}:{digest}'
+    # entries are kept serialized, so every caller gets a copy of its own
+    with _lru_lock:
+        payload = _local_cache().get(key)
+    if payload is not None:
+        return json.loads(payload)
+
+    try:
+        payload = current_app.redis.get(key)
+    except redis.exceptions.RedisError:
+        payload = None
+    if payload is None:
+        payload = json.dumps(run(query, per_page))
+        try:
+            current_app.redis.set(key, payload, ex=current_app.config['SEARCH_CACHE_TTL'])
+        except redis.exceptions.RedisError:
+            pass
+    with _lru_lock:
+        _local_cache()[key] = payload
+    return json.loads(payload)
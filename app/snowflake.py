@@ -0,0 +1,109 @@
+import os
+import socket
+import threading
+import time
+from flask import current_app
+
+# 64-bit k-sortable ids: 41 bits of milliseconds since EPOCH_MS, 10 bits of
+# worker id and 12 bits of per-millisecond sequence. Ids generated by
+# different workers never collide as long as their worker ids differ, and
+# sort by creation time across all of them.
+
+EPOCH_MS = 1704067200000  # 2024-01-01T00:00:00Z
+WORKER_ID_BITS = 10
+SEQUENCE_BITS = 12
+MAX_WORKER_ID = (1 << WORKER_ID_BITS) - 1
+MAX_SEQUENCE = (1 << SEQUENCE_BITS) - 1
+LEASE_SECONDS = 600
+
+
+class SnowflakeGenerator:
+    def __init__(self, worker_id):
+        if not 0 <= worker_id <= MAX_WORKER_ID:
+            raise ValueError(f'worker id must be between 0 and {MAX_WORKER_ID}')
+        self.worker_id = worker_id
+        self.last_ms = -1
+        self.sequence = 0
+        self.lock = threading.Lock()
+
+    def next_id(self):
+        with self.lock:
+            now = int(time.time() * 1000)
+            if now < self.last_ms:
+                # the clock went backwards; never reuse a timestamp
+                if self.last_ms - now > 1000:
+                    raise RuntimeError('clock moved backwards, refusing to generate ids')
+                time.sleep((self.last_ms - now) / 1000)
+                now = self.last_ms
+            if now == self.last_ms:
+                self.sequence = (self.sequence + 1) & MAX_SEQUENCE
+                if self.sequence == 0:
+                    while now <= self.last_ms:
+                        now = int(time.time() * 1000)
+            else:
+                self.sequence = 0
+            self.last_ms = now
+            return ((now - EPOCH_MS) << (WORKER_ID_BITS + SEQUENCE_BITS)) \
+                | (self.worker_id << SEQUENCE_BITS) | self.sequence
+
+
+def timestamp_of(snowflake_id):
+    """Return the creation time embedded in an id, in seconds since the
+    Unix epoch."""
+    return ((snowflake_id >> (WORKER_ID_BITS + SEQUENCE_BITS)) + EPOCH_MS) / 1000
+
+
+def _owner():
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+
+def _lease_worker_id():
+    # worker ids are leased from Redis so that every process on every node
+    # gets a distinct one; the lease is refreshed while ids are generated
+    for _ in range(MAX_WORKER_ID + 1):
+        worker_id = current_app.redis.incr('snowflake:next-worker') % (MAX_WORKER_ID + 1)
+        if current_app.redis.set(f'snowflake:worker:{worker_id}', _owner(),
+                                 nx=True, ex=LEASE_SECONDS):
+            return worker_id
+    raise RuntimeError('no free snowflake worker id')
+
+
+def _renew_lease(worker_id):
+    key = f'snowflake:worker:{worker_id}'
+    if current_app.redis.get(key) != _owner().encode('utf-8'):
+        return False
+    current_app.redis.expire(key, LEASE_SECONDS)
+    return True
+
+
+_generator = None
+_generator_pid = None
+_lease_renewed = 0
+_generator_lock = threading.Lock()
+
+
+def _get_generator():
+    global _generator, _generator_pid, _lease_renewed
+    with _generator_lock:
+        configured = current_app.config.get('SNOWFLAKE_WORKER_ID')
+        if configured is None and _generator is not None \
+                and _generator_pid == os.getpid() \
+                and time.time() - _lease_renewed > LEASE_SECONDS / 3:
+            if _renew_lease(_generator.worker_id):
+                _lease_renewed = time.time()
+            else:
+                _generator = None
+        # a forked worker must not share its parent's worker id
+        if _generator is None or _generator_pid != os.getpid():
+            if configured is None:
+                worker_id = _lease_worker_id()
+                _lease_renewed = time.time()
+            else:
+                worker_id = int(configured)
+            _generator = SnowflakeGenerator(worker_id)
+            _generator_pid = os.getpid()
+        return _generator
+
+
+def next_id():
+    return _get_generator().next_id()
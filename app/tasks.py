@@ -1,65 +1,112 @@
-import json
+import os
 import sys
-import sqlalchemy as sa
-from flask import render_template
-from app import create_app, db
 import time
+from flask import current_app, render_template, url_for
+from app import db
 from rq import get_current_job
+from app import accounts, email, exports, jobs, outbox, scheduler, timeline
 from app.email import send_email
 from app.models import Task, User, Post
 
-app = create_app()
-app.app_context().push()
+
+# job id -> (time, progress) of the last progress update that was saved
+_last_progress = {}
 
 
 def _set_task_progress(progress):
     job = get_current_job()
     if job:
+        # a task reports progress far more often than anyone can watch it,
+        # so intermediate updates are dropped unless enough time has passed
+        # and the progress moved enough since the last one that was saved
+        now = time.monotonic()
+        last_time, last_progress = _last_progress.get(job.get_id(), (None, None))
+        if last_time is not None and 0 < progress < 100 and (
+                now - last_time < current_app.config['TASK_PROGRESS_INTERVAL']
+                or progress - last_progress < current_app.config['TASK_PROGRESS_STEP']):
+            return
+        if progress >= 100:
+            _last_progress.pop(job.get_id(), None)
+        else:
+            _last_progress[job.get_id()] = (now, progress)
         job.meta['progress'] = progress
         job.save_meta()
+        # the task row is gone once the task deleted the account of its user
         task = db.session.get(Task, job.get_id())
-        task.user.add_notification('task_progress', {
-            'task_id': job.get_id(),
-            'progress': progress,
-        })
-        if progress >= 100:
-            task.complete = True
-        db.session.commit()
+        if task is not None:
+            task.user.add_notification('task_progress', {
+                'task_id': job.get_id(),
+                'progress': progress,
+            })
+            if progress >= 100:
+                task.complete = True
+            db.session.commit()
+        if progress >= 100 and 'task_lock' in job.meta:
+            jobs.release(*job.meta['task_lock'])
 
 
-def export_posts(user_id):
+def export_posts(user_id, base_url=None):
     try:
         user = db.session.get(User, user_id)
         _set_task_progress(0)
-        data = []
-        i = 0
-        total_posts = db.session.scalar(
-            sa.select(sa.func.count()).select_from(user.posts.select().subquery())
+        job_id = get_current_job().get_id()
+        path = exports.write(user, job_id, _set_task_progress)
+        if os.path.getsize(path) <= current_app.config['EXPORT_ATTACHMENT_LIMIT']:
+            with open(path, 'rb') as f:
+                attachments = [('posts.ndjson.gz', 'application/gzip', f.read())]
+            os.remove(path)
+            download_url = None
+        else:
+            # too large to attach, it is kept for the user to download
+            attachments = None
+            with current_app.test_request_context(base_url=base_url):
+                download_url = url_for('main.download_export', task_id=job_id, _external=True)
+        send_email(
+            '[Microblog] Your blog posts',
+            sender=current_app.config['ADMINS'][0], recipients=[user.email],
+            text_body=render_template('email/export_posts.txt', user=user,
+                                      download_url=download_url),
+            html_body=render_template('email/export_posts.html', user=user,
+                                      download_url=download_url),
+            sync=True,
+            attachments=attachments,
         )
-        for post in db.session.scalars(
-                user.posts.select().order_by(Post.timestamp.asc())
-        ):
-            data.append({
-                'body': post.body,
-                'timestamp': post.timestamp.isoformat() + 'Z',
-            })
-            time.sleep(5)
-            i += 1
-            _set_task_progress(100 * i // total_posts)
-            send_email(
-                '[Microblog] Your blog posts',
-                sender=app.config['ADMINS'][0], recipients=[user.email],
-                text_body=render_template('email/export_posts.txt', user=user),
-                html_body=render_template('email/export_posts.html', user=user),
-                sync=True,
-                attachments=[(
-                    'posts.json',
-                    'application/json',
-                    json.dumps({'posts': data}, indent=4),
-                )],
-            )
     except:
+        current_app.logger.error(f'Unhandled exception', exc_info=sys.exc_info())
+    finally:
         _set_task_progress(100)
-        app.logger.error(f'Unhandled exception', exc_info=sys.exc_info())
+
+
+def delete_account(user_id):
+    try:
+        user = db.session.get(User, user_id)
+        _set_task_progress(0)
+        accounts.delete(user, _set_task_progress)
+    except:
+        current_app.logger.error(f'Unhandled exception', exc_info=sys.exc_info())
     finally:
         _set_task_progress(100)
+
+
+def fan_out_post(post_id):
+    post = db.session.get(Post, post_id)
+    if post is not None:
+        timeline.fan_out(post)
+
+
+def rebuild_timeline(user_id):
+    user = db.session.get(User, user_id)
+    if user is not None:
+        timeline.rebuild(user)
+
+
+def send_queued_email():
+    email.dispatch()
+
+
+def run_scheduled_job(name):
+    scheduler.run_job(name)
+
+
+def drain_outbox():
+    outbox.drain()
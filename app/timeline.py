@@ -0,0 +1,259 @@
+import redis.exceptions
+import sqlalchemy as sa
+from datetime import timezone
+from flask import current_app
+from app import db, jobs
+from app.pagination import decode_cursor, make_page, key_of
+
+# Each user's home timeline is a sorted set of post ids scored by the post
+# timestamp. A separate marker key records that the timeline has been built,
+# so an empty timeline can be told apart from one that was never populated.
+# Authors with too many followers are not fanned out on write; their posts
+# are merged into the timelines of their followers at read time instead.
+
+FAN_OUT_ON_READ_KEY = 'timeline:fan-out-on-read'
+REBUILD_ATTEMPTS = 5
+
+
+def _timeline_key(user_id):
+    return f'timeline:{user_id}'
+
+
+def _built_key(user_id):
+    return f'timeline:{user_id}:built'
+
+
+def _rebuilding_key(user_id):
+    return f'timeline:{user_id}:rebuilding'
+
+
+def _score(timestamp):
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.replace(tzinfo=timezone.utc)
+    return timestamp.timestamp()
+
+
+def enqueue_fan_out(post):
+    try:
+        jobs.enqueue('fan_out_post', post.id)
+    except redis.exceptions.RedisError:
+        current_app.logger.warning(f'Could not enqueue fan out of post {post.id}')
+
+
+def invalidate(user_id):
+    """Drop a user's home timeline and schedule a rebuild.
+
+    Until the rebuild job runs, reads fall back to the SQL query.
+    """
+    try:
+        current_app.redis.delete(_built_key(user_id))
+        current_app.redis.set(_rebuilding_key(user_id), 1, ex=60)
+        jobs.enqueue('rebuild_timeline', user_id)
+    except redis.exceptions.RedisError:
+        current_app.logger.warning(f'Could not invalidate timeline of user {user_id}')
+
+
+def invalidate_many(user_ids):
+    """Drop the home timelines of ``user_ids`` without rebuilding them. Each
+    one is rebuilt when it is next read."""
+    try:
+        pipe = current_app.redis.pipeline(transaction=False)
+        for user_id in user_ids:
+            pipe.delete(_built_key(user_id))
+        pipe.execute()
+    except redis.exceptions.RedisError:
+        current_app.logger.warning('Could not invalidate timelines')
+
+
+def remove_user(user_id):
+    """Drop everything kept for a deleted user."""
+    try:
+        pipe = current_app.redis.pipeline(transaction=False)
+        pipe.delete(_timeline_key(user_id), _built_key(user_id), _rebuilding_key(user_id))
+        pipe.srem(FAN_OUT_ON_READ_KEY, user_id)
+        pipe.execute()
+    except redis.exceptions.RedisError:
+        current_app.logger.warning(f'Could not remove timeline of user {user_id}')
+
+
+def _schedule_rebuild(user_id):
+    # several requests can find the same timeline missing; only the first
+    # one enqueues the rebuild
+    if current_app.redis.set(_rebuilding_key(user_id), 1, nx=True, ex=60):
+        jobs.enqueue('rebuild_timeline', user_id)
+
+
+def fan_out(post):
+    from app.models import followers
+
+    author = post.author
+    if author.followers_count() >= current_app.config['TIMELINE_FANOUT_LIMIT']:
+        current_app.redis.sadd(FAN_OUT_ON_READ_KEY, author.id)
+        return
+    # the timelines of the followers of an author who dropped back below the
+    # limit lack the posts that were merged in at read time until now
+    backfill = current_app.redis.srem(FAN_OUT_ON_READ_KEY, author.id)
+
+    reader_ids = sa.select(followers.c.follower_id).where(followers.c.followed_id == author.id)
+    batch = [author.id]
+    for reader_id in db.session.scalars(reader_ids.execution_options(yield_per=1000)):
+        batch.append(reader_id)
+        if len(batch) >= 1000:
+            _push(batch, post, backfill)
+            batch = []
+    if batch:
+        _push(batch, post, backfill)
+
+
+def _push(user_ids, post, backfill=False):
+    length = current_app.config['TIMELINE_LENGTH']
+    pipe = current_app.redis.pipeline(transaction=False)
+    for user_id in user_ids:
+        key = _timeline_key(user_id)
+        pipe.zadd(key, {post.id: _score(post.timestamp)})
+        pipe.zremrangebyrank(key, 0, -length - 1)
+        if backfill:
+            # rebuilt when next read
+            pipe.delete(_built_key(user_id))
+    pipe.execute()
+
+
+def rebuild(user):
+    """Rebuild a user's home timeline from the database. Returns False if
+    posts kept being fanned out to it while it was read, in which case it is
+    left unbuilt and reads keep falling back to the SQL query."""
+    from app.models import Post
+
+    user_id = user.id
+    key = _timeline_key(user_id)
+    with current_app.redis.pipeline() as pipe:
+        for _ in range(REBUILD_ATTEMPTS):
+            try:
+                # a post fanned out from here on aborts the rebuild, and the
+                # read starts a new transaction, so it sees every post fanned
+                # out before
+                pipe.watch(key)
+                db.session.rollback()
+                query = (
+                    user.following_posts()
+                    .where(Post.user_id.not_in(_fan_out_on_read_authors()))
+                    .limit(current_app.config['TIMELINE_LENGTH'])
+                    .with_only_columns(Post.id, Post.timestamp)
+                )
+                entries = {post_id: _score(timestamp)
+                           for post_id, timestamp in db.session.execute(query)}
+                pipe.multi()
+                pipe.delete(key)
+                if entries:
+                    pipe.zadd(key, entries)
+                pipe.set(_built_key(user_id), 1)
+                pipe.delete(_rebuilding_key(user_id))
+                pipe.execute()
+                return True
+            except redis.exceptions.WatchError:
+                continue
+    current_app.logger.warning(f'Gave up rebuilding the timeline of user {user_id}')
+    current_app.redis.delete(_rebuilding_key(user_id))
+    return False
+
+
+def _fan_out_on_read_authors():
+    return [int(user_id) for user_id in current_app.redis.smembers(FAN_OUT_ON_READ_KEY)]
+
+
+def _followed_fan_out_on_read_authors(user):
+    from app.models import followers
+
+    author_ids = _fan_out_on_read_authors()
+    if not author_ids:
+        return []
+    query = (
+        sa.select(followers.c.followed_id)
+        .where(
+            followers.c.follower_id == user.id,
+            followers.c.followed_id.in_(author_ids),
+        )
+    )
+    followed = list(db.session.scalars(query))
+    if user.id in author_ids:
+        followed.append(user.id)
+    return followed
+
+
+def home_page(user, cursor, per_page):
+    """Return a :class:`KeysetPage` of the user's home timeline.
+
+    ``None`` is returned when the page cannot be served from the
+    materialized timeline, in which case the caller should paginate
+    :meth:`User.following_posts` with the same cursor instead.
+    """
+    from app.models import Post
+
+    keys = (Post.timestamp, Post.id)
+    values, direction = decode_cursor(cursor, keys) if cursor else (None, 'next')
+    forward = direction == 'next'
+    key = _timeline_key(user.id)
+    try:
+        if not current_app.redis.exists(_built_key(user.id)):
+            _schedule_rebuild(user.id)
+            return None
+        if values is None:
+            bound, ties = '+inf', 0
+        else:
+            bound = _score(values[0])
+            ties = current_app.redis.zcount(key, bound, bound)
+        limit = per_page + 1 + ties
+        pipe = current_app.redis.pipeline(transaction=False)
+        if forward:
+            pipe.zrevrangebyscore(key, bound, '-inf', start=0, num=limit, withscores=True)
+        else:
+            pipe.zrangebyscore(key, bound, '+inf', start=0, num=limit, withscores=True)
+        pipe.zcard(key)
+        entries, size = pipe.execute()
+        if len(entries) == limit:
+            # posts with the same score come in the string order of their
+            # ids, so the newer ones tied with the last entry may be cut off
+            edge = entries[-1][1]
+            if forward:
+                entries = current_app.redis.zrevrangebyscore(key, bound, edge, withscores=True)
+            else:
+                entries = current_app.redis.zrangebyscore(key, bound, edge, withscores=True)
+        pulled_authors = _followed_fan_out_on_read_authors(user)
+    except redis.exceptions.RedisError:
+        return None
+
+    entries = sorted(((score, int(post_id)) for post_id, score in entries), reverse=forward)
+    if values is not None:
+        position = (_score(values[0]), values[1])
+        entries = [entry for entry in entries
+                   if (entry < position if forward else entry > position)]
+    if forward and len(entries) <= per_page \
+            and size >= current_app.config['TIMELINE_LENGTH']:
+        # older posts have been trimmed from the timeline
+        return None
+
+    if pulled_authors:
+        query = sa.select(Post.id, Post.timestamp).where(Post.user_id.in_(pulled_authors))
+        if values is not None:
+            row, position = sa.tuple_(*keys), sa.tuple_(*values)
+            query = query.where(row < position if forward else row > position)
+        order = (Post.timestamp.desc(), Post.id.desc()) if forward \
+            else (Post.timestamp.asc(), Post.id.asc())
+        entries.extend(
+            (_score(timestamp), post_id)
+            for post_id, timestamp in db.session.execute(
+                query.order_by(*order).limit(per_page + 1)
+            )
+        )
+        # posts pushed before the author crossed the fan-out limit can be
+        # in both sources
+        entries = sorted(set(entries), reverse=forward)
+
+    page_ids = [post_id for _, post_id in entries[:per_page + 1]]
+    posts = {post.id: post for post in db.session.scalars(
+        sa.select(Post).where(Post.id.in_(page_ids))
+    )} if page_ids else {}
+    return make_page(
+        [posts[post_id] for post_id in page_ids if post_id in posts],
+        lambda post: key_of(post, keys), values, direction, per_page,
+    )
@@ -0,0 +1,15 @@
+import rq
+from app import db
+# imported once here instead of in every work horse
+from app import tasks  # noqa: F401
+
+
+class Worker(rq.Worker):
+    """RQ worker for the application it is started in. Each job runs in a
+    work horse forked from the worker, which already has the application
+    and the task module loaded."""
+
+    def main_work_horse(self, job, queue):
+        # the work horse must not share the worker's database connections
+        db.engine.dispose(close=False)
+        super().main_work_horse(job, queue)
@@ -0,0 +1,94 @@
+"""Compare keyset paginated feeds ordered by snowflake id alone with the
+same feeds ordered by (timestamp, id).
+
+    python -m benchmarks.feed_order --posts 200000 --pages 100
+
+Set BENCHMARK_DATABASE_URL to run against a database other than an
+in-memory SQLite one. The database must be empty; tables are created and
+dropped by the benchmark.
+"""
+import argparse
+import os
+import random
+import time
+from datetime import datetime, timezone
+import sqlalchemy as sa
+from app import create_app, db
+from app.models import User, Post
+from app.pagination import keyset_paginate
+from app.snowflake import SnowflakeGenerator, timestamp_of
+from config import Config
+
+
+class BenchmarkConfig(Config):
+    TESTING = True
+    SQLALCHEMY_DATABASE_URI = os.environ.get('BENCHMARK_DATABASE_URL', 'sqlite://')
+    SNOWFLAKE_IDS = True
+    SNOWFLAKE_WORKER_ID = 0
+
+
+def populate(posts, users):
+    db.session.execute(sa.insert(User), [
+        {'id': i + 1, 'username': f'user{i}', 'email': f'user{i}@example.com'}
+        for i in range(users)
+    ])
+    generator = SnowflakeGenerator(0)
+    batch = []
+    for i in range(posts):
+        post_id = generator.next_id()
+        batch.append({
+            'id': post_id,
+            'body': f'post {i}',
+            'user_id': random.randint(1, users),
+            'timestamp': datetime.fromtimestamp(timestamp_of(post_id), timezone.utc),
+        })
+        if len(batch) == 10000:
+            db.session.execute(sa.insert(Post), batch)
+            batch = []
+    if batch:
+        db.session.execute(sa.insert(Post), batch)
+    db.session.commit()
+
+
+def walk(query, keys, pages, per_page):
+    start = time.perf_counter()
+    cursor = None
+    for _ in range(pages):
+        page = keyset_paginate(query, keys, cursor, per_page)
+        db.session.expunge_all()
+        if not page.has_next:
+            break
+        cursor = page.next_cursor
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--posts', type=int, default=100000)
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--pages', type=int, default=100)
+    parser.add_argument('--per-page', type=int, default=25)
+    args = parser.parse_args()
+
+    app = create_app(BenchmarkConfig)
+    with app.app_context():
+        db.create_all()
+        try:
+            populate(args.posts, args.users)
+            feeds = {
+                'explore': sa.select(Post),
+                'user': sa.select(Post).where(Post.user_id == 1),
+            }
+            for name, query in feeds.items():
+                by_timestamp = walk(query, (Post.timestamp, Post.id), args.pages, args.per_page)
+                by_id = walk(query, (Post.id,), args.pages, args.per_page)
+                print(f'{name:8} ORDER BY timestamp, id: {by_timestamp * 1000:8.1f} ms   '
+                      f'ORDER BY id: {by_id * 1000:8.1f} ms   '
+                      f'({args.pages} pages of {args.per_page})')
+        finally:
+            db.session.remove()
+            db.drop_all()
+
+
+if __name__ == '__main__':
+    main()
@@ -7,4 +7,5 @@ while true; do
     echo Upgrade command failed, retrying in 5 secs...
     sleep 5
 done
-exec gunicorn -b :5000 --access-logfile - --error-logfile - microblog:app
+# notification streams stay open, so workers must not be tied up by them
+exec gunicorn -b :5000 -k gevent --access-logfile - --error-logfile - microblog:app
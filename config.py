@@ -17,8 +17,74 @@ class Config:
     MAIL_USERNAME = os.environ.get('MAIL_USERNAME')
     MAIL_PASSWORD = os.environ.get('MAIL_PASSWORD')
     ADMINS = ['your-email@example.com']
+    MAIL_QUEUE_LIMIT = int(os.environ.get('MAIL_QUEUE_LIMIT', 1000))
+    MAIL_BATCH_SIZE = int(os.environ.get('MAIL_BATCH_SIZE', 50))
+    MAIL_DISPATCHER_TIMEOUT = int(os.environ.get('MAIL_DISPATCHER_TIMEOUT', 600))
+    # seconds to wait before each retry of a dispatcher that lost its connection
+    MAIL_RETRY_INTERVALS = [10, 60, 300]
     POSTS_PER_PAGE = 25
+    # workers take jobs from these queues in this order
+    TASK_QUEUES = {
+        'high': 'microblog-tasks-high',
+        'default': 'microblog-tasks',
+        'low': 'microblog-tasks-low',
+    }
+    # queue of each task, tasks not listed go to the default queue
+    TASK_ROUTES = {
+        'fan_out_post': 'high',
+        'rebuild_timeline': 'high',
+        'send_queued_email': 'high',
+        'drain_outbox': 'high',
+        'export_posts': 'low',
+        'delete_account': 'low',
+    }
+    # seconds between runs of each maintenance job of `flask scheduler run`
+    SCHEDULE = {
+        'flush_last_seen': int(os.environ.get('SCHEDULE_FLUSH_LAST_SEEN', 60)),
+        'compact_notifications': int(os.environ.get('SCHEDULE_COMPACT_NOTIFICATIONS', 24 * 3600)),
+        'reconcile_counters': int(os.environ.get('SCHEDULE_RECONCILE_COUNTERS', 3600)),
+        'search_health': int(os.environ.get('SCHEDULE_SEARCH_HEALTH', 300)),
+        'drain_outbox': int(os.environ.get('SCHEDULE_DRAIN_OUTBOX', 30)),
+        'remove_expired_exports': int(os.environ.get('SCHEDULE_REMOVE_EXPIRED_EXPORTS', 3600)),
+    }
+    TASK_TIMEOUT = int(os.environ.get('TASK_TIMEOUT', 3600))
+    TASK_PROGRESS_INTERVAL = float(os.environ.get('TASK_PROGRESS_INTERVAL', 1.0))
+    TASK_PROGRESS_STEP = int(os.environ.get('TASK_PROGRESS_STEP', 5))
+    OUTBOX_BATCH_SIZE = int(os.environ.get('OUTBOX_BATCH_SIZE', 500))
+    OUTBOX_MAX_BACKOFF = int(os.environ.get('OUTBOX_MAX_BACKOFF', 600))
+    OUTBOX_CLAIM_TIMEOUT = int(os.environ.get('OUTBOX_CLAIM_TIMEOUT', 600))
+    OUTBOX_LAG_WARNING = int(os.environ.get('OUTBOX_LAG_WARNING', 300))
+    ACCOUNT_DELETE_BATCH_SIZE = int(os.environ.get('ACCOUNT_DELETE_BATCH_SIZE', 500))
+    EXPORTS_DIR = os.environ.get('EXPORTS_DIR') or os.path.join(basedir, 'exports')
+    EXPORT_BATCH_SIZE = int(os.environ.get('EXPORT_BATCH_SIZE', 1000))
+    EXPORT_ATTACHMENT_LIMIT = int(os.environ.get('EXPORT_ATTACHMENT_LIMIT', 5 * 1024 * 1024))
+    EXPORT_TTL = int(os.environ.get('EXPORT_TTL', 7 * 24 * 3600))
     LANGUAGES = ['en', 'ru']
     GOOGLE_APPLICATION_CREDENTIALS = os.environ.get('GOOGLE_APPLICATION_CREDENTIALS')
     ELASTICSEARCH_URL = os.environ.get('ELASTICSEARCH_URL')
+    # 'elasticsearch', 'database' or 'none', see app/search.py
+    SEARCH_BACKEND = os.environ.get('SEARCH_BACKEND')
+    SEARCH_CACHE_TTL = int(os.environ.get('SEARCH_CACHE_TTL', 30))
+    SEARCH_CACHE_SIZE = int(os.environ.get('SEARCH_CACHE_SIZE', 1000))
+    # how long Elasticsearch keeps the view of the index a search walks
+    # between two pages
+    SEARCH_KEEP_ALIVE = os.environ.get('SEARCH_KEEP_ALIVE', '5m')
+    REINDEX_PROCESSES = int(os.environ.get('REINDEX_PROCESSES', os.cpu_count() or 1))
+    REINDEX_RANGE_SIZE = int(os.environ.get('REINDEX_RANGE_SIZE', 100000))
+    REINDEX_BATCH_SIZE = int(os.environ.get('REINDEX_BATCH_SIZE', 1000))
     REDIS_URL = os.environ.get('REDIS_URL', 'redis://')
+    EXPLORE_BUFFER_LENGTH = int(os.environ.get('EXPLORE_BUFFER_LENGTH', 500))
+    MICROCACHE_TTL = int(os.environ.get('MICROCACHE_TTL', 5))
+    MICROCACHE_STALE_TTL = int(os.environ.get('MICROCACHE_STALE_TTL', 30))
+    MICROCACHE_LOCK_TIMEOUT = int(os.environ.get('MICROCACHE_LOCK_TIMEOUT', 5))
+    MICROCACHE_WAIT = float(os.environ.get('MICROCACHE_WAIT', 0.5))
+    NOTIFICATIONS_LONG_POLL_TIMEOUT = int(os.environ.get('NOTIFICATIONS_LONG_POLL_TIMEOUT', 25))
+    NOTIFICATION_TTL = int(os.environ.get('NOTIFICATION_TTL', 7 * 24 * 3600))
+    NOTIFICATION_STREAM_LENGTH = int(os.environ.get('NOTIFICATION_STREAM_LENGTH', 100))
+    NOTIFICATIONS_RETRY_MS = int(os.environ.get('NOTIFICATIONS_RETRY_MS', 5000))
+    POST_FRAGMENT_CACHE_SIZE = int(os.environ.get('POST_FRAGMENT_CACHE_SIZE', 2000))
+    POST_FRAGMENT_TTL = int(os.environ.get('POST_FRAGMENT_TTL', 86400))
+    TIMELINE_LENGTH = int(os.environ.get('TIMELINE_LENGTH', 800))
+    SNOWFLAKE_IDS = os.environ.get('SNOWFLAKE_IDS') is not None
+    SNOWFLAKE_WORKER_ID = os.environ.get('SNOWFLAKE_WORKER_ID')
+    TIMELINE_FANOUT_LIMIT = int(os.environ.get('TIMELINE_FANOUT_LIMIT', 10000))
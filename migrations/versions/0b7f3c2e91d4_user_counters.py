@@ -0,0 +1,55 @@
+"""user counters
+
+Revision ID: 0b7f3c2e91d4
+Revises: 5e0c1d7a9b42
+Create Date: 2026-10-16 14:21:07.552913
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0b7f3c2e91d4'
+down_revision = '5e0c1d7a9b42'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('user', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('post_counter', sa.Integer(), nullable=False, server_default='0'))
+        batch_op.add_column(sa.Column('follower_counter', sa.Integer(), nullable=False, server_default='0'))
+        batch_op.add_column(sa.Column('following_counter', sa.Integer(), nullable=False, server_default='0'))
+
+    user = sa.table(
+        'user',
+        sa.column('id', sa.Integer),
+        sa.column('post_counter', sa.Integer),
+        sa.column('follower_counter', sa.Integer),
+        sa.column('following_counter', sa.Integer),
+    )
+    post = sa.table('post', sa.column('user_id', sa.Integer))
+    followers = sa.table(
+        'followers',
+        sa.column('follower_id', sa.Integer),
+        sa.column('followed_id', sa.Integer),
+    )
+    op.execute(user.update().values(
+        post_counter=sa.select(sa.func.count())
+        .where(post.c.user_id == user.c.id)
+        .scalar_subquery(),
+        follower_counter=sa.select(sa.func.count())
+        .where(followers.c.followed_id == user.c.id)
+        .scalar_subquery(),
+        following_counter=sa.select(sa.func.count())
+        .where(followers.c.follower_id == user.c.id)
+        .scalar_subquery(),
+    ))
+
+
+def downgrade():
+    with op.batch_alter_table('user', schema=None) as batch_op:
+        batch_op.drop_column('following_counter')
+        batch_op.drop_column('follower_counter')
+        batch_op.drop_column('post_counter')
@@ -0,0 +1,26 @@
+"""task in progress index
+
+Revision ID: 4f2b9e61d8a3
+Revises: e3a58c07b6d2
+Create Date: 2026-10-16 19:12:08.417532
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '4f2b9e61d8a3'
+down_revision = 'e3a58c07b6d2'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('task', schema=None) as batch_op:
+        batch_op.create_index('ix_task_user_id_complete', ['user_id', 'complete'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('task', schema=None) as batch_op:
+        batch_op.drop_index('ix_task_user_id_complete')
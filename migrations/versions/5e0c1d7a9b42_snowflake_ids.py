@@ -0,0 +1,54 @@
+"""snowflake ids
+
+Revision ID: 5e0c1d7a9b42
+Revises: a80335a0f2e6
+Create Date: 2026-10-16 12:02:41.318204
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5e0c1d7a9b42'
+down_revision = 'a80335a0f2e6'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # SQLite integer keys are already 64-bit, and changing their declared
+    # type would stop them from aliasing the rowid
+    if op.get_bind().dialect.name == 'sqlite':
+        return
+    with op.batch_alter_table('post', schema=None) as batch_op:
+        batch_op.alter_column('id',
+               existing_type=sa.Integer(),
+               type_=sa.BigInteger(),
+               existing_nullable=False,
+               autoincrement=True)
+
+    with op.batch_alter_table('message', schema=None) as batch_op:
+        batch_op.alter_column('id',
+               existing_type=sa.Integer(),
+               type_=sa.BigInteger(),
+               existing_nullable=False,
+               autoincrement=True)
+
+
+def downgrade():
+    if op.get_bind().dialect.name == 'sqlite':
+        return
+    with op.batch_alter_table('message', schema=None) as batch_op:
+        batch_op.alter_column('id',
+               existing_type=sa.BigInteger(),
+               type_=sa.Integer(),
+               existing_nullable=False,
+               autoincrement=True)
+
+    with op.batch_alter_table('post', schema=None) as batch_op:
+        batch_op.alter_column('id',
+               existing_type=sa.BigInteger(),
+               type_=sa.Integer(),
+               existing_nullable=False,
+               autoincrement=True)
@@ -0,0 +1,33 @@
+"""full text search
+
+Revision ID: 7a1e4c93b0d5
+Revises: c58e2a17f903
+Create Date: 2026-10-16 23:41:12.507934
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7a1e4c93b0d5'
+down_revision = 'c58e2a17f903'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    dialect = op.get_bind().dialect.name
+    if dialect == 'sqlite':
+        op.execute('CREATE VIRTUAL TABLE post_search USING fts5(body)')
+        op.execute('INSERT INTO post_search (rowid, body) SELECT id, body FROM post')
+    elif dialect == 'postgresql':
+        op.execute('CREATE TABLE post_search (id BIGINT PRIMARY KEY, document TSVECTOR NOT NULL)')
+        op.execute("INSERT INTO post_search (id, document) "
+                   "SELECT id, to_tsvector('simple', coalesce(body, '')) FROM post")
+        op.execute('CREATE INDEX ix_post_search_document ON post_search USING gin (document)')
+
+
+def downgrade():
+    if op.get_bind().dialect.name in ('sqlite', 'postgresql'):
+        op.execute('DROP TABLE post_search')
@@ -0,0 +1,49 @@
+"""unread message counter
+
+Revision ID: 9d41e6a2c8f5
+Revises: 0b7f3c2e91d4
+Create Date: 2026-10-16 16:48:33.104729
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9d41e6a2c8f5'
+down_revision = '0b7f3c2e91d4'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('user', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('unread_message_counter', sa.Integer(), nullable=False, server_default='0'))
+
+    user = sa.table(
+        'user',
+        sa.column('id', sa.Integer),
+        sa.column('last_message_read_time', sa.DateTime),
+        sa.column('unread_message_counter', sa.Integer),
+    )
+    message = sa.table(
+        'message',
+        sa.column('recipient_id', sa.Integer),
+        sa.column('timestamp', sa.DateTime),
+    )
+    op.execute(user.update().values(
+        unread_message_counter=sa.select(sa.func.count())
+        .where(
+            message.c.recipient_id == user.c.id,
+            sa.or_(
+                user.c.last_message_read_time.is_(None),
+                message.c.timestamp > user.c.last_message_read_time,
+            ),
+        )
+        .scalar_subquery(),
+    ))
+
+
+def downgrade():
+    with op.batch_alter_table('user', schema=None) as batch_op:
+        batch_op.drop_column('unread_message_counter')
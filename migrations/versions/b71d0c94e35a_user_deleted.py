@@ -0,0 +1,26 @@
+"""user deleted flag
+
+Revision ID: b71d0c94e35a
+Revises: 4f2b9e61d8a3
+Create Date: 2026-10-16 20:26:51.093714
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b71d0c94e35a'
+down_revision = '4f2b9e61d8a3'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('user', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('deleted', sa.Boolean(), nullable=False, server_default=sa.false()))
+
+
+def downgrade():
+    with op.batch_alter_table('user', schema=None) as batch_op:
+        batch_op.drop_column('deleted')
@@ -0,0 +1,37 @@
+"""outbox
+
+Revision ID: c58e2a17f903
+Revises: b71d0c94e35a
+Create Date: 2026-10-16 21:03:39.842116
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c58e2a17f903'
+down_revision = 'b71d0c94e35a'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('outbox',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('topic', sa.String(length=32), nullable=False),
+    sa.Column('key', sa.String(length=128), nullable=False),
+    sa.Column('created_at', sa.Float(), nullable=False),
+    sa.Column('available_at', sa.Float(), nullable=False),
+    sa.Column('attempts', sa.Integer(), nullable=False),
+    sa.PrimaryKeyConstraint('id')
+    )
+    with op.batch_alter_table('outbox', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_outbox_available_at'), ['available_at'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('outbox', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_outbox_available_at'))
+
+    op.drop_table('outbox')
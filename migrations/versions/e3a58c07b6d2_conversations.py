@@ -0,0 +1,101 @@
+"""conversations
+
+Revision ID: e3a58c07b6d2
+Revises: 9d41e6a2c8f5
+Create Date: 2026-10-16 18:05:42.310264
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e3a58c07b6d2'
+down_revision = '9d41e6a2c8f5'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('conversation',
+    sa.Column('owner_id', sa.Integer(), nullable=False),
+    sa.Column('peer_id', sa.Integer(), nullable=False),
+    sa.Column('last_message_id', sa.BigInteger().with_variant(sa.Integer(), 'sqlite'), nullable=False),
+    sa.Column('last_message_at', sa.DateTime(), nullable=False),
+    sa.Column('unread_count', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['last_message_id'], ['message.id'], ),
+    sa.ForeignKeyConstraint(['owner_id'], ['user.id'], ),
+    sa.ForeignKeyConstraint(['peer_id'], ['user.id'], ),
+    sa.PrimaryKeyConstraint('owner_id', 'peer_id')
+    )
+    with op.batch_alter_table('conversation', schema=None) as batch_op:
+        batch_op.create_index('ix_conversation_owner_last_message', ['owner_id', 'last_message_at', 'peer_id'], unique=False)
+
+    with op.batch_alter_table('message', schema=None) as batch_op:
+        batch_op.create_index('ix_message_sender_recipient_timestamp', ['sender_id', 'recipient_id', 'timestamp'], unique=False)
+
+    user = sa.table(
+        'user',
+        sa.column('id', sa.Integer),
+        sa.column('last_message_read_time', sa.DateTime),
+    )
+    message = sa.table(
+        'message',
+        sa.column('id', sa.BigInteger),
+        sa.column('sender_id', sa.Integer),
+        sa.column('recipient_id', sa.Integer),
+        sa.column('timestamp', sa.DateTime),
+    )
+    conversation = sa.table(
+        'conversation',
+        sa.column('owner_id', sa.Integer),
+        sa.column('peer_id', sa.Integer),
+        sa.column('last_message_id', sa.BigInteger),
+        sa.column('last_message_at', sa.DateTime),
+        sa.column('unread_count', sa.Integer),
+    )
+    # every message belongs to the conversation of its sender and to the
+    # conversation of its recipient, where it is unread if it arrived after
+    # the recipient last read their messages
+    sides = sa.union_all(
+        sa.select(
+            message.c.sender_id.label('owner_id'),
+            message.c.recipient_id.label('peer_id'),
+            message.c.id,
+            message.c.timestamp,
+            sa.literal(0).label('unread'),
+        ),
+        sa.select(
+            message.c.recipient_id,
+            message.c.sender_id,
+            message.c.id,
+            message.c.timestamp,
+            sa.case(
+                (sa.or_(
+                    user.c.last_message_read_time.is_(None),
+                    message.c.timestamp > user.c.last_message_read_time,
+                ), 1),
+                else_=0,
+            ),
+        ).join(user, user.c.id == message.c.recipient_id),
+    ).subquery()
+    op.execute(conversation.insert().from_select(
+        ['owner_id', 'peer_id', 'last_message_id', 'last_message_at', 'unread_count'],
+        sa.select(
+            sides.c.owner_id,
+            sides.c.peer_id,
+            sa.func.max(sides.c.id),
+            sa.func.max(sides.c.timestamp),
+            sa.func.sum(sides.c.unread),
+        ).group_by(sides.c.owner_id, sides.c.peer_id),
+    ))
+
+
+def downgrade():
+    with op.batch_alter_table('message', schema=None) as batch_op:
+        batch_op.drop_index('ix_message_sender_recipient_timestamp')
+
+    with op.batch_alter_table('conversation', schema=None) as batch_op:
+        batch_op.drop_index('ix_conversation_owner_last_message')
+
+    op.drop_table('conversation')
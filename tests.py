@@ -1,13 +1,36 @@
+from contextlib import contextmanager
 from datetime import datetime, timezone, timedelta
+import gzip
+import json
+import os
+import re
+import smtplib
+import tempfile
+import threading
 import unittest
-from app import db, create_app
-from app.models import User, Post
+from unittest import mock
+import fakeredis
+import flask_mail
+import redis.exceptions
+import rq
+import sqlalchemy as sa
+from flask import g, render_template
+from app import (db, create_app, email, exports, fragment_cache, last_seen, mail, microcache,
+                 notification_store, outbox, push, recent_posts, scheduler, search, search_cache,
+                 tasks, timeline)
+from app.models import (User, Post, Message, Conversation, Notification, Outbox, Task,
+                        load_user)
+from app.pagination import keyset_paginate, encode_cursor, InvalidCursor
+from app.snowflake import SnowflakeGenerator, timestamp_of
 from config import Config
 
 
 class TestConfig(Config):
     TESTING = True
     SQLALCHEMY_DATABASE_URI = 'sqlite://'
+    SECRET_KEY = 'test'
+    WTF_CSRF_ENABLED = False
+    SEARCH_BACKEND = 'database'
 
 
 class UserModelCase(unittest.TestCase):
@@ -15,6 +38,16 @@ class UserModelCase(unittest.TestCase):
         self.app = create_app(TestConfig)
         self.app_context = self.app.app_context()
         self.app_context.push()
+        self.redis_server = fakeredis.FakeServer()
+        self.app.redis = fakeredis.FakeRedis(server=self.redis_server)
+        self.app.task_queues = {
+            name: rq.Queue(queue_name, connection=self.app.redis)
+            for name, queue_name in self.app.config['TASK_QUEUES'].items()
+        }
+        self.app.task_queue = self.app.task_queues['default']
+        # requests share the application context of the test, where
+        # flask-login would keep the user of the last request
+        self.app.teardown_request(lambda exc: g.pop('_login_user', None))
         db.create_all()
 
     def tearDown(self):
@@ -22,6 +55,32 @@ class UserModelCase(unittest.TestCase):
         db.drop_all()
         self.app_context.pop()
 
+    def run_jobs(self):
+        """Run the queued background tasks in this process."""
+        rq.SimpleWorker(list(self.app.task_queues.values()),
+                        connection=self.app.redis).work(burst=True)
+
+    @contextmanager
+    def statements(self):
+        """Collect the SQL statements run in the block."""
+        statements = []
+
+        def collect(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        sa.event.listen(db.engine, 'before_cursor_execute', collect)
+        try:
+            yield statements
+        finally:
+            sa.event.remove(db.engine, 'before_cursor_execute', collect)
+
+    def login(self, user):
+        """Return a test client logged in as ``user``."""
+        client = self.app.test_client()
+        with client.session_transaction() as session:
+            session['_user_id'] = str(user.id)
+        return client
+
     def test_password_hashing(self):
         u = User(username='susan', email='susan@example.com')
         u.set_password('cat')
@@ -99,6 +158,1109 @@ class UserModelCase(unittest.TestCase):
         self.assertEqual(f3, [p3, p4])
         self.assertEqual(f4, [p4])
 
+    def test_keyset_pagination(self):
+        u = User(username='john', email='john@example.com')
+        now = datetime.now(timezone.utc)
+        posts = [Post(body=f'post {i}', author=u, timestamp=now + timedelta(seconds=i % 3))
+                 for i in range(5)]
+        db.session.add_all(posts)
+        db.session.commit()
+        newest_first = db.session.scalars(
+            sa.select(Post).order_by(Post.timestamp.desc(), Post.id.desc())
+        ).all()
+        keys = (Post.timestamp, Post.id)
+
+        page1 = keyset_paginate(sa.select(Post), keys, None, 2)
+        self.assertEqual(page1.items, newest_first[:2])
+        self.assertIsNone(page1.prev_cursor)
+        page2 = keyset_paginate(sa.select(Post), keys, page1.next_cursor, 2)
+        self.assertEqual(page2.items, newest_first[2:4])
+        page3 = keyset_paginate(sa.select(Post), keys, page2.next_cursor, 2)
+        self.assertEqual(page3.items, newest_first[4:])
+        self.assertIsNone(page3.next_cursor)
+
+        back = keyset_paginate(sa.select(Post), keys, page3.prev_cursor, 2)
+        self.assertEqual(back.items, page2.items)
+        back = keyset_paginate(sa.select(Post), keys, back.prev_cursor, 2)
+        self.assertEqual(back.items, page1.items)
+        self.assertIsNone(back.prev_cursor)
+
+        with self.assertRaises(InvalidCursor):
+            keyset_paginate(sa.select(Post), keys, 'not-a-cursor', 2)
+
+    def test_snowflake_ids(self):
+        generator = SnowflakeGenerator(3)
+        ids = [generator.next_id() for _ in range(10000)]
+        self.assertEqual(ids, sorted(set(ids)))
+        self.assertAlmostEqual(timestamp_of(ids[-1]), datetime.now().timestamp(), delta=5)
+        other = SnowflakeGenerator(4)
+        self.assertNotIn(other.next_id(), ids)
+
+        self.app.config['SNOWFLAKE_IDS'] = True
+        self.app.config['SNOWFLAKE_WORKER_ID'] = 1
+        u = User(username='john', email='john@example.com')
+        p1 = Post(body='first', author=u)
+        db.session.add(p1)
+        db.session.commit()
+        p2 = Post(body='second', author=u)
+        db.session.add(p2)
+        db.session.commit()
+        self.assertGreater(p1.id, 1 << 32)
+        self.assertGreater(p2.id, p1.id)
+        self.assertEqual(Post.feed_keys(), (Post.id,))
+
+    def test_counters(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        db.session.add_all([u1, u2])
+        db.session.commit()
+        p1 = Post(body='post from john', author=u1)
+        p2 = Post(body='another post from john', author=u1)
+        db.session.add_all([p1, p2])
+        u2.follow(u1)
+        db.session.commit()
+        self.assertEqual(u1.posts_count(), 2)
+        self.assertEqual(u1.followers_count(), 1)
+        self.assertEqual(u2.following_count(), 1)
+
+        db.session.delete(p2)
+        db.session.commit()
+        self.assertEqual(u1.posts_count(), 1)
+
+        db.session.execute(
+            sa.update(User).where(User.id == u1.id).values(post_counter=7, follower_counter=0)
+        )
+        db.session.commit()
+        self.assertEqual(User.reconcile_counters(batch_size=1), 1)
+        self.assertEqual(u1.posts_count(), 1)
+        self.assertEqual(u1.followers_count(), 1)
+        self.assertEqual(User.reconcile_counters(), 0)
+
+        # the counters seen after a follow include the follows of others
+        db.session.execute(
+            sa.update(User).where(User.id == u1.id).values(follower_counter=5)
+            .execution_options(synchronize_session=False)
+        )
+        u3 = User(username='mary', email='mary@example.com')
+        db.session.add(u3)
+        u3.follow(u1)
+        self.assertEqual(u1.followers_count(), 6)
+        self.assertEqual(u3.following_count(), 1)
+        db.session.commit()
+        self.assertEqual(u1.followers_count(), 6)
+
+    def test_collection_dict_queries(self):
+        users = [User(username=f'user{i}', email=f'user{i}@example.com') for i in range(6)]
+        db.session.add_all(users)
+        db.session.commit()
+        for user in users[1:]:
+            users[0].follow(user)
+            user.follow(users[0])
+        db.session.add_all([Post(body='post', author=user) for user in users])
+        db.session.commit()
+
+        with self.statements() as statements, self.app.test_request_context():
+            data = User.to_collection_dict(sa.select(User), 1, 10, 'api.get_users')
+            cursor_data = User.to_collection_dict(
+                users[0].followers.select(), 1, 10, 'api.get_followers',
+                cursor='', id=users[0].id,
+            )
+        # one page query and one count query, then one page query
+        self.assertEqual(len(statements), 3)
+        self.assertEqual(len(data['items']), 6)
+        self.assertEqual(data['items'][0]['follower_count'], 5)
+        self.assertEqual(data['items'][0]['_links']['followers'],
+                         f'/api/users/{users[0].id}/followers')
+        self.assertEqual(len(cursor_data['items']), 5)
+        self.assertEqual(cursor_data['items'][0]['post_count'], 1)
+
+    def test_feed_page_query_count(self):
+        now = datetime.now(timezone.utc)
+        for i in range(30):
+            u = User(username=f'user{i}', email=f'user{i}@example.com')
+            db.session.add(Post(body=f'post {i}', author=u, timestamp=now + timedelta(seconds=i)))
+        db.session.commit()
+        db.session.expunge_all()
+
+        with self.statements() as statements, self.app.test_request_context():
+            g.locale = 'en'
+            page = keyset_paginate(sa.select(Post), (Post.timestamp, Post.id), None, 25)
+            for post in page.items:
+                render_template('_post.html', post=post)
+        # the page of posts, then all of their authors at once
+        self.assertEqual(len(page.items), 25)
+        self.assertEqual(len(statements), 2)
+
+    def test_timeline_fan_out_and_merge(self):
+        self.app.config['TIMELINE_FANOUT_LIMIT'] = 2
+        john = User(username='john', email='john@example.com')
+        susan = User(username='susan', email='susan@example.com')
+        mary = User(username='mary', email='mary@example.com')
+        david = User(username='david', email='david@example.com')
+        db.session.add_all([john, susan, mary, david])
+        susan.follow(john)
+        mary.follow(john)
+        susan.follow(david)
+        db.session.commit()
+        now = datetime.now(timezone.utc)
+        p1 = Post(body='from john', author=john, timestamp=now)
+        p2 = Post(body='from david', author=david, timestamp=now + timedelta(seconds=1))
+        db.session.add_all([p1, p2])
+        db.session.commit()
+        self.assertIsNone(timeline.home_page(susan, None, 10))
+        self.run_jobs()
+
+        # david's post was pushed, john's is merged in at read time
+        self.assertEqual(self.app.redis.zrange(f'timeline:{susan.id}', 0, -1),
+                         [str(p2.id).encode()])
+        page = timeline.home_page(susan, None, 10)
+        self.assertEqual(page.items, [p2, p1])
+
+        # john drops below the limit; his followers' timelines get his posts
+        mary.unfollow(john)
+        p3 = Post(body='john again', author=john, timestamp=now + timedelta(seconds=2))
+        db.session.add(p3)
+        db.session.commit()
+        self.run_jobs()
+        self.assertIsNone(timeline.home_page(susan, None, 10))
+        self.run_jobs()
+        self.assertEqual(timeline.home_page(susan, None, 10).items, [p3, p2, p1])
+
+    def test_posts_flushed_before_commit_are_fanned_out(self):
+        recent_posts._local_copy = (None, [], False)
+        john = User(username='john', email='john@example.com')
+        susan = User(username='susan', email='susan@example.com')
+        db.session.add_all([john, susan])
+        susan.follow(john)
+        db.session.commit()
+        self.assertIsNone(timeline.home_page(susan, None, 10))
+        self.run_jobs()
+        self.assertEqual(timeline.home_page(susan, None, 10).items, [])
+        self.assertEqual(recent_posts.page(None, 10).items, [])
+
+        db.session.add(Post(body='flushed early', author=john))
+        db.session.flush()
+        db.session.commit()
+        db.session.add(Post(body='rolled back', author=john))
+        db.session.flush()
+        db.session.rollback()
+        self.run_jobs()
+        self.assertEqual([post.body for post in timeline.home_page(susan, None, 10).items],
+                         ['flushed early'])
+        self.assertEqual([post.body for post in recent_posts.page(None, 10).items],
+                         ['flushed early'])
+
+    def test_timeline_tied_timestamps(self):
+        john = User(username='john', email='john@example.com')
+        susan = User(username='susan', email='susan@example.com')
+        db.session.add_all([john, susan])
+        susan.follow(john)
+        db.session.commit()
+        # like on MySQL, where timestamps are truncated to seconds
+        now = datetime.now(timezone.utc).replace(microsecond=0)
+        posts = [Post(body=f'post {i}', author=john, timestamp=now) for i in range(12)]
+        db.session.add_all(posts)
+        db.session.commit()
+        self.assertIsNone(timeline.home_page(susan, None, 5))
+        self.run_jobs()
+
+        newest_first = sorted(posts, key=lambda post: post.id, reverse=True)
+        pages = []
+        page = timeline.home_page(susan, None, 5)
+        pages.append(page.items)
+        while page.next_cursor:
+            page = timeline.home_page(susan, page.next_cursor, 5)
+            pages.append(page.items)
+        self.assertEqual(pages, [newest_first[:5], newest_first[5:10], newest_first[10:]])
+        page = timeline.home_page(susan, page.prev_cursor, 5)
+        self.assertEqual(page.items, newest_first[5:10])
+        self.assertEqual(timeline.home_page(susan, page.prev_cursor, 5).items,
+                         newest_first[:5])
+
+    def test_timeline_rebuild_keeps_concurrent_fan_out(self):
+        john = User(username='john', email='john@example.com')
+        susan = User(username='susan', email='susan@example.com')
+        db.session.add_all([john, susan])
+        susan.follow(john)
+        db.session.commit()
+        p1 = Post(body='first', author=john)
+        db.session.add(p1)
+        db.session.commit()
+        late = Post(body='late', author=john)
+        db.session.add(late)
+        db.session.commit()
+
+        execute = db.session.execute
+        reads = []
+
+        def read_then_fan_out(statement, *args, **kwargs):
+            # the first read happens before the late post was committed,
+            # and its fan out lands before the rebuild writes the timeline
+            rows = execute(statement, *args, **kwargs).all()
+            reads.append(rows)
+            if len(reads) == 1:
+                timeline._push([susan.id], late)
+                return [row for row in rows if row[0] != late.id]
+            return rows
+
+        with mock.patch.object(db.session, 'execute', read_then_fan_out):
+            self.assertTrue(timeline.rebuild(susan))
+        self.assertEqual(len(reads), 2)
+        self.assertEqual(timeline.home_page(susan, None, 10).items, [late, p1])
+
+    def test_explore_buffer(self):
+        self.app.config['EXPLORE_BUFFER_LENGTH'] = 3
+        recent_posts._local_copy = (None, [], False)
+        john = User(username='john', email='john@example.com')
+        db.session.add(john)
+        posts = []
+        for body in ('one', 'two', 'three', 'four'):
+            posts.append(Post(body=body, author=john))
+            db.session.add(posts[-1])
+            db.session.commit()
+        p1, p2, p3, p4 = [post.id for post in posts]
+
+        # the first read builds the buffer from the newest posts
+        page = recent_posts.page(None, 1)
+        self.assertEqual([post.id for post in page.items], [p4])
+        self.assertIsNone(page.prev_cursor)
+        page = recent_posts.page(page.next_cursor, 1)
+        self.assertEqual([post.id for post in page.items], [p3])
+        self.assertEqual([post.id for post in recent_posts.page(page.prev_cursor, 1).items],
+                         [p4])
+        # the page after reaches the oldest post, which is outside the
+        # window, so it comes from SQL
+        self.assertIsNone(recent_posts.page(page.next_cursor, 1))
+
+        # new posts are pushed to the buffer
+        p5 = Post(body='five', author=john)
+        db.session.add(p5)
+        db.session.commit()
+        page = recent_posts.page(None, 2)
+        self.assertEqual([post.id for post in page.items], [p5.id, p4])
+        self.assertEqual(page.items[0].author.username, 'john')
+
+    def test_explore_buffer_without_redis(self):
+        recent_posts._local_copy = (None, [], False)
+        self.redis_server.connected = False
+        self.assertIsNone(recent_posts.page(None, 10))
+
+    def test_explore_rebuild_keeps_concurrent_push(self):
+        recent_posts._local_copy = (None, [], False)
+        john = User(username='john', email='john@example.com')
+        p1 = Post(body='first', author=john)
+        db.session.add(p1)
+        db.session.commit()
+        late = Post(body='late', author=john)
+        db.session.add(late)
+        db.session.commit()
+
+        scalars = sa.orm.Session.scalars
+        reads = []
+
+        def read_then_push(session, statement, *args, **kwargs):
+            # the first read happens before the late post was committed,
+            # and its push lands before the rebuild writes the buffer
+            posts = scalars(session, statement, *args, **kwargs).all()
+            reads.append(posts)
+            if len(reads) == 1:
+                recent_posts.push(late)
+                return [post for post in posts if post.id != late.id]
+            return posts
+
+        with mock.patch.object(sa.orm.Session, 'scalars', read_then_push):
+            self.assertTrue(recent_posts.rebuild())
+        self.assertEqual(len(reads), 2)
+        self.assertEqual([post.id for post in recent_posts.page(None, 10).items],
+                         [late.id, p1.id])
+
+    def test_post_fragment_cache(self):
+        fragment_cache._lru = None
+        john = User(username='john', email='john@example.com')
+        post = Post(body='first version', author=john)
+        db.session.add(post)
+        db.session.commit()
+
+        with self.app.test_request_context(), \
+                mock.patch('app.fragment_cache.render_template',
+                           wraps=render_template) as render:
+            g.locale = 'en'
+            fragment, = fragment_cache.render_posts([post])
+            self.assertIn('first version', fragment)
+            self.assertEqual(fragment_cache.render_posts([post]), [fragment])
+            self.assertEqual(render.call_count, 1)
+
+            # another process finds the fragment in Redis
+            fragment_cache._lru = None
+            self.assertEqual(fragment_cache.render_posts([post]), [fragment])
+            self.assertEqual(render.call_count, 1)
+
+            # an edited post or a renamed author is rendered again
+            post.body = 'second version'
+            fragment, = fragment_cache.render_posts([post])
+            self.assertIn('second version', fragment)
+            john.username = 'johnny'
+            fragment, = fragment_cache.render_posts([post])
+            self.assertIn('johnny', fragment)
+            self.assertEqual(render.call_count, 3)
+
+    def test_microcache(self):
+        self.app.config['MICROCACHE_WAIT'] = 0.1
+        render = mock.Mock(return_value='<p>page</p>')
+        self.assertEqual(microcache.cached('page', render), '<p>page</p>')
+        self.assertEqual(microcache.cached('page', render), '<p>page</p>')
+        self.assertEqual(render.call_count, 1)
+
+        # a stale entry is served while another request renders it
+        with mock.patch('time.time', return_value=datetime.now().timestamp() + 10):
+            self.app.redis.set('microcache:page:lock', 1)
+            self.assertEqual(microcache.cached('page', render), '<p>page</p>')
+            self.assertEqual(render.call_count, 1)
+            self.app.redis.delete('microcache:page:lock')
+            microcache.cached('page', render)
+            self.assertEqual(render.call_count, 2)
+
+        # without an entry, a request waits briefly and then renders
+        self.app.redis.set('microcache:other:lock', 1)
+        self.assertEqual(microcache.cached('other', render), '<p>page</p>')
+        self.assertEqual(render.call_count, 3)
+
+        # the lock is released when the page can't be rendered or stored
+        self.assertRaises(ValueError, microcache.cached, 'broken',
+                          mock.Mock(side_effect=ValueError))
+        self.assertIsNone(self.app.redis.get('microcache:broken:lock'))
+        with mock.patch('app.microcache._store', side_effect=redis.exceptions.ConnectionError):
+            self.assertEqual(microcache.cached('unstored', render), '<p>page</p>')
+        self.assertIsNone(self.app.redis.get('microcache:unstored:lock'))
+
+    def test_microcache_skips_cursors(self):
+        john = User(username='john', email='john@example.com')
+        db.session.add(john)
+        db.session.add_all([Post(body=f'post {i}', author=john) for i in range(3)])
+        db.session.commit()
+        self.app.config['POSTS_PER_PAGE'] = 1
+        client = self.login(john)
+        response = client.get('/explore')
+        self.assertEqual(response.status_code, 200)
+        next_url = re.search(r'href="(/explore\?cursor=[^"]+)"', response.text).group(1)
+        self.assertEqual(client.get(next_url).status_code, 200)
+        self.assertEqual(client.get('/explore?cursor=made-up').status_code, 400)
+        self.assertEqual(sorted(key for key in self.app.redis.keys('microcache:*')),
+                         [b'microcache:explore:en'])
+
+    def test_last_seen_write_behind(self):
+        john = User(username='john', email='john@example.com')
+        susan = User(username='susan', email='susan@example.com')
+        db.session.add_all([john, susan])
+        db.session.commit()
+        john_seen, susan_seen = john.last_seen, susan.last_seen
+        first, second = (datetime(year, 1, 1, tzinfo=timezone.utc) for year in (2030, 2031))
+
+        # visits are buffered in Redis until a flush writes them out
+        with mock.patch('app.last_seen.datetime', wraps=datetime) as clock:
+            clock.now.return_value = first
+            last_seen.record(john)
+            last_seen.record(susan)
+        db.session.expire_all()
+        self.assertEqual((john.last_seen, susan.last_seen), (john_seen, susan_seen))
+        self.assertEqual(last_seen.flush(batch_size=1), 2)
+        db.session.expire_all()
+        self.assertEqual((john.last_seen, susan.last_seen), (str(first), str(first)))
+        self.assertEqual(last_seen.flush(), 0)
+
+        # a flush that crashed is picked up by the next one
+        self.app.redis.hset(last_seen.FLUSHING_KEY, john.id, second.timestamp())
+        with mock.patch('app.last_seen.datetime', wraps=datetime) as clock:
+            clock.now.return_value = second
+            last_seen.record(susan)
+        self.assertEqual(last_seen.flush(), 1)
+        db.session.expire_all()
+        self.assertEqual((john.last_seen, susan.last_seen), (str(second), str(first)))
+        self.assertEqual(last_seen.flush(), 1)
+        db.session.expire_all()
+        self.assertEqual(susan.last_seen, str(second))
+
+    def test_unread_message_counter(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        u3 = User(username='mary', email='mary@example.com')
+        db.session.add_all([u1, u2, u3])
+        db.session.commit()
+        for author, body in ((u1, 'hi'), (u1, 'there'), (u3, 'hello')):
+            message = Message(author=author, recipient=u2, body=body)
+            db.session.add(message)
+            Conversation.add_message(message)
+            count = u2.add_unread_message()
+            db.session.commit()
+        self.assertEqual(count, 3)
+        self.assertEqual(u2.unread_message_count(), 3)
+
+        # reading a conversation takes what was unread in it off the counter
+        self.assertTrue(u2.mark_messages_read(u1))
+        db.session.commit()
+        self.assertEqual(u2.unread_message_count(), 1)
+        self.assertFalse(u2.mark_messages_read(u1))
+
+        # a message that arrives while the counter is loaded is not lost
+        message = Message(author=u1, recipient=u2, body='again')
+        db.session.add(message)
+        Conversation.add_message(message)
+        db.session.execute(
+            sa.update(User).where(User.id == u2.id)
+            .values(unread_message_counter=User.unread_message_counter + 1)
+            .execution_options(synchronize_session=False)
+        )
+        self.assertTrue(u2.mark_messages_read(u3))
+        db.session.commit()
+        self.assertEqual(u2.unread_message_count(), 1)
+
+        # a message counted by another request before the read is written
+        # stays unread
+        self.assertTrue(u2.mark_messages_read())
+        u4 = User(username='david', email='david@example.com')
+        message = Message(author=u4, recipient=u2, body='late')
+        with db.session.no_autoflush:
+            db.session.execute(
+                sa.update(User).where(User.id == u2.id)
+                .values(unread_message_counter=User.unread_message_counter + 1)
+                .execution_options(synchronize_session=False)
+            )
+        db.session.add(message)
+        Conversation.add_message(message)
+        db.session.commit()
+        self.assertEqual(u2.unread_message_count(), 1)
+        self.assertIsNotNone(u2.last_message_read_time)
+
+        self.assertTrue(u2.mark_messages_read())
+        db.session.commit()
+        self.assertEqual(u2.unread_message_count(), 0)
+        self.assertFalse(u2.mark_messages_read())
+
+        # the count of a new message includes those counted by others since
+        # the counter was loaded
+        self.assertEqual(u2.unread_message_count(), 0)
+        db.session.execute(
+            sa.update(User).where(User.id == u2.id)
+            .values(unread_message_counter=User.unread_message_counter + 1)
+            .execution_options(synchronize_session=False)
+        )
+        self.assertEqual(u2.add_unread_message(), 2)
+        db.session.commit()
+        self.assertEqual(u2.unread_message_count(), 2)
+
+    def test_notification_push(self):
+        john = User(username='john', email='john@example.com')
+        db.session.add(john)
+        db.session.commit()
+
+        # notifications are published once their transaction commits
+        with push.subscription(john.id) as pubsub:
+            john.add_notification('discarded', 0)
+            db.session.rollback()
+            self.assertIsNone(push.wait(pubsub, 0.1))
+            first = john.add_notification('unread_message_count', 1)
+            db.session.commit()
+            self.assertEqual(push.wait(pubsub, 1), first)
+
+        # a long poll is woken up by the next notification
+        client = self.login(john)
+        self.assertEqual(client.get(f'/notifications?since={first["timestamp"]}').json, [])
+
+        def notify():
+            session = sa.orm.Session()
+            push.queue(session, john.id, {'name': 'task_progress', 'data': 50,
+                                          'timestamp': first['timestamp'] + 1})
+            with self.app.app_context():
+                push.publish_pending(session)
+
+        timer = threading.Timer(0.2, notify)
+        timer.start()
+        response = client.get(f'/notifications?since={first["timestamp"]}&wait=5')
+        timer.join()
+        self.assertEqual([n['name'] for n in response.json], ['task_progress'])
+
+        # the stream starts with what was missed since the last event
+        response = client.get('/notifications/stream',
+                              headers={'Last-Event-ID': str(first['timestamp'])})
+        self.assertEqual(response.mimetype, 'text/event-stream')
+        events = (chunk.decode() for chunk in response.response)
+        self.assertTrue(next(events).startswith('retry: '))
+        event = next(events)
+        self.assertTrue(event.startswith(f'id: {first["timestamp"] + 1}\n'))
+        self.assertEqual(json.loads(event.split('data: ')[1])['name'], 'task_progress')
+        second = john.add_notification('unread_message_count', 2)
+        db.session.commit()
+        self.assertEqual(json.loads(next(events).split('data: ')[1]), second)
+        response.close()
+
+    def test_notification_store(self):
+        self.app.config['NOTIFICATION_TTL'] = 60
+        john = User(username='john', email='john@example.com')
+        db.session.add(john)
+        db.session.commit()
+        now = datetime.now().timestamp()
+        with mock.patch('app.models.time', side_effect=[now - 2, now - 1, now]):
+            first = john.add_notification('unread_message_count', 1)
+            john.add_notification('task_progress', 50)
+            third = john.add_notification('unread_message_count', 2)
+        db.session.commit()
+
+        # the latest of each name, and every one of them in order
+        self.assertEqual([n['data'] for n in notification_store.latest(john.id)], [50, 2])
+        self.assertEqual(notification_store.latest(john.id, now - 1), [third])
+        self.assertEqual([n['data'] for n in notification_store.history(john.id)], [1, 50, 2])
+        self.assertEqual(notification_store.history(john.id, first['timestamp'])[0]['data'], 50)
+        for key in self.app.redis.keys(f'notifications:{john.id}:*'):
+            self.assertTrue(0 < self.app.redis.ttl(key) <= 60)
+
+        # notifications older than the TTL are ignored while the keys live
+        with mock.patch('app.notification_store.time', return_value=now + 59.5):
+            self.assertEqual(notification_store.latest(john.id), [third])
+            self.assertEqual(notification_store.history(john.id), [third])
+
+        # without Redis, notifications are lost but not silently
+        self.redis_server.connected = False
+        john.add_notification('unread_message_count', 3)
+        with self.assertLogs(self.app.logger, 'WARNING'):
+            db.session.commit()
+        with self.assertLogs(self.app.logger, 'WARNING'):
+            self.assertEqual(self.login(john).get('/notifications').json, [])
+
+    def test_compact_legacy_notifications(self):
+        self.app.config['NOTIFICATION_TTL'] = 60
+        john = User(username='john', email='john@example.com')
+        susan = User(username='susan', email='susan@example.com')
+        db.session.add_all([john, susan])
+        db.session.commit()
+        now = datetime.now().timestamp()
+        john.add_notification('unread_message_count', 5)
+        db.session.add_all([
+            Notification(name='unread_message_count', user=john, timestamp=now - 10,
+                         payload_json='1'),
+            Notification(name='task_progress', user=john, timestamp=now - 10,
+                         payload_json='50'),
+            Notification(name='unread_message_count', user=susan, timestamp=now - 10,
+                         payload_json='2'),
+            Notification(name='task_progress', user=susan, timestamp=now - 120,
+                         payload_json='100'),
+        ])
+        db.session.commit()
+
+        self.assertEqual(notification_store.compact_legacy(batch_size=3), 4)
+        self.assertEqual(db.session.scalar(sa.select(sa.func.count(Notification.id))), 0)
+        # the newer notification in Redis is kept, expired rows are dropped
+        self.assertEqual([(n['name'], n['data']) for n in notification_store.latest(john.id)],
+                         [('task_progress', 50), ('unread_message_count', 5)])
+        self.assertEqual([(n['name'], n['data']) for n in notification_store.latest(susan.id)],
+                         [('unread_message_count', 2)])
+        self.assertEqual(notification_store.compact_legacy(), 0)
+
+    def test_export_posts(self):
+        exports_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(exports_dir.cleanup)
+        self.app.config['EXPORTS_DIR'] = exports_dir.name
+        self.app.config['EXPORT_BATCH_SIZE'] = 2
+        john = User(username='john', email='john@example.com')
+        now = datetime.now(timezone.utc)
+        for i in range(5):
+            db.session.add(Post(body=f'post {i}', author=john,
+                                timestamp=now + timedelta(seconds=i)))
+        db.session.commit()
+
+        reported = []
+
+        def progress(percent):
+            # like task progress, which is committed as the posts stream
+            reported.append(percent)
+            john.add_notification('task_progress', percent)
+            db.session.commit()
+
+        path = exports.write(john, 'task', progress)
+        self.assertEqual(path, exports.path('task'))
+        with gzip.open(path, 'rt', encoding='utf-8') as f:
+            posts = [json.loads(line) for line in f]
+        self.assertEqual([post['body'] for post in posts], [f'post {i}' for i in range(5)])
+        self.assertTrue(posts[0]['timestamp'].endswith('Z'))
+        self.assertEqual(reported, [40, 80, 99])
+        self.assertEqual(os.listdir(exports_dir.name), ['task.ndjson.gz'])
+
+        # exports are removed once they expire
+        self.assertEqual(exports.remove_expired(), 0)
+        expired = datetime.now().timestamp() - self.app.config['EXPORT_TTL'] - 1
+        os.utime(path, (expired, expired))
+        self.assertEqual(exports.remove_expired(), 1)
+        self.assertEqual(os.listdir(exports_dir.name), [])
+
+    def test_queued_email(self):
+        def send(subject):
+            email.send_email(subject, 'admin@example.com', ['john@example.com'],
+                             'text', '<p>html</p>')
+
+        with mail.record_messages() as outbox:
+            send('first')
+            send('second')
+            self.assertEqual(outbox, [])
+            self.assertEqual(self.app.redis.llen(email.OUTBOX_KEY), 2)
+            self.run_jobs()
+            self.assertEqual([msg.subject for msg in outbox], ['first', 'second'])
+        self.assertFalse(self.app.redis.exists(email.OUTBOX_KEY, email.SENDING_KEY,
+                                               email.DISPATCHER_KEY))
+
+        # emails the connection failed on are sent by the next dispatcher
+        for subject in ('third', 'fourth', 'fifth'):
+            send(subject)
+        connection_send = flask_mail.Connection.send
+        calls = []
+
+        def fail_second(conn, msg):
+            calls.append(msg.subject)
+            if len(calls) == 2:
+                raise smtplib.SMTPServerDisconnected()
+            connection_send(conn, msg)
+
+        with mail.record_messages() as outbox:
+            with mock.patch.object(flask_mail.Connection, 'send', fail_second):
+                self.assertRaises(smtplib.SMTPServerDisconnected, email.dispatch)
+            self.assertEqual(self.app.redis.llen(email.SENDING_KEY), 2)
+            self.assertEqual(email.dispatch(), 2)
+        self.assertEqual([msg.subject for msg in outbox], ['third', 'fourth', 'fifth'])
+
+        # the dispatcher lock is released when its task can't be enqueued
+        with mock.patch('app.jobs.enqueue', side_effect=redis.exceptions.ConnectionError), \
+                mail.record_messages() as outbox, self.assertLogs(self.app.logger, 'WARNING'):
+            send('sixth')
+        self.assertEqual(outbox, [])
+        self.assertEqual(self.app.redis.llen(email.OUTBOX_KEY), 1)
+        self.assertFalse(self.app.redis.exists(email.DISPATCHER_KEY))
+
+    def test_scheduler(self):
+        self.app.config['SCHEDULE'] = {'flush_last_seen': 60, 'reconcile_counters': 3600}
+        # only one node gets to enqueue a job that is due
+        self.assertEqual(scheduler.enqueue_due(), ['flush_last_seen', 'reconcile_counters'])
+        self.assertEqual(scheduler.enqueue_due(), [])
+        self.assertEqual(self.app.task_queues['default'].count, 2)
+        self.app.redis.delete('scheduler:due:flush_last_seen')
+        self.assertEqual(scheduler.enqueue_due(), ['flush_last_seen'])
+
+        self.run_jobs()
+        stats = scheduler.metrics()
+        self.assertEqual(stats['flush_last_seen']['runs'], '2')
+        self.assertEqual(stats['flush_last_seen']['last_status'], 'ok')
+        self.assertEqual(stats['reconcile_counters']['last_result'], '0 users fixed')
+
+        # a job that is still running from an earlier turn is skipped
+        self.app.redis.set('scheduler:running:flush_last_seen', 1)
+        with self.assertLogs(self.app.logger, 'WARNING'):
+            scheduler.run_job('flush_last_seen')
+        self.assertEqual(scheduler.metrics()['flush_last_seen']['runs'], '2')
+        self.app.redis.delete('scheduler:running:flush_last_seen')
+
+        # failures are recorded, and release the run lock
+        failing = mock.Mock(side_effect=ValueError)
+        with mock.patch.dict(scheduler.JOBS, {'flush_last_seen': failing}), \
+                self.assertLogs(self.app.logger, 'ERROR'):
+            scheduler.run_job('flush_last_seen')
+        stats = scheduler.metrics()['flush_last_seen']
+        self.assertEqual((stats['runs'], stats['failures'], stats['last_status']),
+                         ('3', '1', 'failed'))
+        self.assertFalse(self.app.redis.exists('scheduler:running:flush_last_seen'))
+
+    def test_delete_account(self):
+        self.app.config['ACCOUNT_DELETE_BATCH_SIZE'] = 2
+        john = User(username='john', email='john@example.com')
+        susan = User(username='susan', email='susan@example.com')
+        mary = User(username='mary', email='mary@example.com')
+        john.set_password('cat')
+        db.session.add_all([john, susan, mary])
+        db.session.add_all([Post(body=f'hello {i}', author=john) for i in range(3)])
+        db.session.add(Post(body='hello from susan', author=susan))
+        susan.follow(john)
+        john.follow(mary)
+        mary.follow(susan)
+        db.session.commit()
+        for author, recipient in ((john, susan), (john, susan), (susan, john), (mary, susan)):
+            message = Message(author=author, recipient=recipient, body='hi')
+            db.session.add(message)
+            Conversation.add_message(message)
+            recipient.add_unread_message()
+        db.session.commit()
+        john_id = john.id
+
+        client = self.login(john)
+        self.assertEqual(client.post('/delete_account').status_code, 302)
+        # the account is gone for logins and sessions before it is deleted
+        db.session.expire_all()
+        self.assertTrue(john.deleted)
+        self.assertIsNone(load_user(str(john_id)))
+        self.assertEqual(self.login(susan).get('/user/john').status_code, 404)
+        response = self.app.test_client().post('/auth/login',
+                                               data={'username': 'john', 'password': 'cat'})
+        self.assertEqual(response.location, '/auth/login')
+        self.assertEqual(self.login(john).get('/index').status_code, 302)
+        # and nobody can follow or message it while the deletion is pending
+        client = self.login(mary)
+        self.assertEqual(client.post('/follow/john').location, '/index')
+        self.assertEqual(client.get('/user/john/popup').status_code, 404)
+        self.assertEqual(client.post('/send_message/john', data={'message': 'hi'}).status_code,
+                         404)
+        self.assertEqual(client.get('/messages/john').status_code, 404)
+        self.assertFalse(mary.is_following(john))
+
+        self.run_jobs()
+        db.session.expire_all()
+        self.assertIsNone(db.session.get(User, john_id))
+        self.assertFalse(self.app.redis.exists(f'task-lock:delete_account:{john_id}'))
+        self.assertEqual(db.session.scalars(sa.select(Post.body)).all(), ['hello from susan'])
+        self.assertEqual([post.body for post in Post.search('hello')[0].items],
+                         ['hello from susan'])
+        self.assertEqual(db.session.scalars(sa.select(Message.sender_id)).all(), [mary.id])
+        self.assertEqual(db.session.scalar(sa.select(sa.func.count()).select_from(
+            sa.select(Conversation).where(sa.or_(Conversation.owner_id == john_id,
+                                                 Conversation.peer_id == john_id))
+            .subquery())), 0)
+        self.assertEqual((susan.following_count(), susan.followers_count()), (0, 1))
+        self.assertEqual((mary.following_count(), mary.followers_count()), (1, 0))
+        self.assertEqual(susan.unread_message_count(), 1)
+        self.assertEqual(User.reconcile_counters(), 0)
+
+    def test_outbox(self):
+        self.app.search_backend = search.ElasticsearchBackend()
+        john = User(username='john', email='john@example.com')
+        p1 = Post(body='first', author=john)
+        p2 = Post(body='second', author=john)
+        db.session.add_all([p1, p2])
+        db.session.commit()
+        # indexing is recorded with the change, and a drain is on its way
+        self.assertEqual(db.session.scalars(sa.select(Outbox.key)).all(),
+                         [f'post:{p1.id}', f'post:{p2.id}'])
+        self.assertTrue(self.app.redis.exists(outbox.DRAINER_KEY))
+        pending, lag = outbox.lag()
+        self.assertEqual(pending, 2)
+        self.assertGreaterEqual(lag, 0)
+
+        calls = []
+
+        def committed(session):
+            calls.append('commit')
+
+        sa.event.listen(db.session, 'after_commit', committed)
+        self.addCleanup(sa.event.remove, db.session, 'after_commit', committed)
+
+        def sync_many(index, models, deleted_ids):
+            # the rows are claimed, and not locked, while Elasticsearch is called
+            calls.append('sync')
+            self.assertTrue(all(available > datetime.now().timestamp() + 60
+                                for available in db.session.scalars(
+                                    sa.select(Outbox.available_at))))
+            return {p1.id}
+
+        with mock.patch('app.search.sync_many', side_effect=sync_many):
+            self.assertEqual(outbox.drain(), 1)
+        self.assertEqual(calls[:2], ['commit', 'sync'])
+        row = db.session.scalar(sa.select(Outbox))
+        self.assertEqual((row.key, row.attempts), (f'post:{p1.id}', 1))
+        self.assertAlmostEqual(row.available_at, datetime.now().timestamp() + 2, delta=1)
+        self.assertFalse(self.app.redis.exists(outbox.DRAINER_KEY))
+
+        # failed rows are retried after a backoff that grows with each attempt
+        with mock.patch('app.search.sync_many', return_value=set()) as sync:
+            self.assertEqual(outbox.drain(), 0)
+            sync.assert_not_called()
+        later = datetime.now().timestamp() + 3
+        with mock.patch('app.outbox.time', return_value=later), \
+                mock.patch('app.search.sync_many', side_effect=ConnectionError), \
+                self.assertLogs(self.app.logger, 'WARNING'):
+            self.assertEqual(outbox.drain(), 0)
+        db.session.refresh(row)
+        self.assertEqual((row.attempts, row.available_at), (2, later + 4))
+        with mock.patch('app.outbox.time', return_value=later + 4), \
+                mock.patch('app.search.sync_many', return_value=set()) as sync:
+            self.assertEqual(outbox.drain(), 1)
+        self.assertEqual([model.id for model in sync.call_args.args[1]], [p1.id])
+        self.assertEqual(outbox.lag(), (0, 0.0))
+
+        # deleted rows are removed from the index through the outbox too
+        search.remove_many_from_index('post', [p1.id, p2.id])
+        db.session.execute(sa.delete(Post))
+        db.session.commit()
+        with mock.patch('app.search.sync_many', return_value=set()) as sync:
+            self.assertEqual(outbox.drain(), 2)
+        sync.assert_called_once_with('post', [], {p1.id, p2.id})
+
+    def test_reindex_swaps_alias(self):
+        self.app.config['REINDEX_RANGE_SIZE'] = 2
+        self.app.search_backend = search.ElasticsearchBackend()
+        self.app.elasticsearch = es = mock.Mock()
+        john = User(username='john', email='john@example.com')
+        db.session.add_all([Post(body=f'post {i}', author=john) for i in range(5)])
+        db.session.commit()
+        es.indices.exists_alias.return_value = True
+        es.indices.get_alias.return_value = {'post-1': {}}
+        es.indices.exists.return_value = True
+        es.indices.get_settings.return_value = {
+            'post-1': {'settings': {'index.number_of_replicas': '2'}}}
+
+        indexed = []
+
+        def new_index():
+            return es.indices.create.call_args.kwargs['index']
+
+        def bulk(client, actions, chunk_size=None, raise_on_error=True):
+            # writes made while the index is built go to both versions
+            self.assertEqual(search._targets('post'), ['post', new_index()])
+            actions = list(actions)
+            indexed.extend(action['_source']['body'] for action in actions)
+            return len(actions), []
+
+        with mock.patch('app.search.bulk', side_effect=bulk) as bulk_calls:
+            index, count, _ = self.app.search_backend.reindex(Post, processes=1)
+        self.assertEqual(index, new_index())
+        self.assertTrue(index.startswith('post-'))
+        self.assertEqual((count, sorted(indexed)), (5, [f'post {i}' for i in range(5)]))
+        self.assertEqual(bulk_calls.call_count, 3)
+        # the new version gets the replicas of the old one, then the alias
+        # moves over in one step, and the old version is deleted
+        es.indices.put_settings.assert_called_once_with(index=index, settings={
+            'index': {'number_of_replicas': '2', 'refresh_interval': None}})
+        es.indices.update_aliases.assert_called_once_with(actions=[
+            {'remove': {'index': 'post-1', 'alias': 'post'}},
+            {'add': {'index': index, 'alias': 'post'}},
+        ])
+        es.indices.delete.assert_called_once_with(index=['post-1'])
+        self.assertEqual(search._targets('post'), ['post'])
+
+        # a build with failed documents is thrown away
+        es.reset_mock()
+        with mock.patch('app.search.bulk', return_value=(4, [{'create': {'status': 500}}])):
+            self.assertRaises(RuntimeError, self.app.search_backend.reindex, Post, processes=1)
+        es.indices.update_aliases.assert_not_called()
+        es.indices.delete.assert_called_once_with(index=[new_index()])
+        self.assertEqual(search._targets('post'), ['post'])
+
+    def test_search_cache(self):
+        search_cache._lru = None
+        john = User(username='john', email='john@example.com')
+        db.session.add(Post(body='hello world', author=john))
+        db.session.commit()
+
+        backend = self.app.search_backend
+        with mock.patch.object(backend, 'query_after', wraps=backend.query_after) as query:
+            self.assertEqual(Post.search('hello')[1], 1)
+            # queries that only differ in case and spacing share an entry
+            self.assertEqual(Post.search('  HELLO ')[1], 1)
+            self.assertEqual(query.call_count, 1)
+
+            # a change of the index makes every process miss the cache
+            db.session.add(Post(body='hello again', author=john))
+            db.session.commit()
+            self.assertEqual(Post.search('hello')[1], 2)
+            self.assertEqual(query.call_count, 2)
+            search_cache._lru = None
+            self.assertEqual(Post.search('hello')[1], 2)
+            self.assertEqual(query.call_count, 2)
+
+            # a rollback leaves the cache alone
+            db.session.add(Post(body='hello there', author=john))
+            db.session.flush()
+            db.session.rollback()
+            self.assertEqual(Post.search('hello')[1], 2)
+            self.assertEqual(query.call_count, 2)
+
+    def test_elasticsearch_cursors(self):
+        self.app.search_backend = search.ElasticsearchBackend()
+        self.app.elasticsearch = es = mock.Mock()
+        es.open_point_in_time.return_value = {'id': 'pit-1'}
+
+        def es_search(**kwargs):
+            if 'pit' not in kwargs:
+                return {'hits': {'hits': [{'_id': str(id)} for id in (1, 2, 3)],
+                                 'total': {'value': 6}}}
+            sorts = {3: [3.0, 30], 4: [2.0, 40], 5: [1.0, 50], 6: [1.0, 60]}
+            if 'from_' in kwargs:
+                ids = [3, 4, 5]
+            else:
+                ids = [id for id, sort in sorts.items() if sort < kwargs['search_after']]
+            return {'hits': {'hits': [{'_id': str(id), 'sort': sorts[id]} for id in ids]},
+                    'pit_id': 'pit-2'}
+
+        es.search.side_effect = es_search
+        page, total = search.query_page('post', 'hello', 2)
+        self.assertEqual((page.items, total), ([1, 2], 6))
+        # the second page starts at the offset of the first one, in a point
+        # in time, and later pages carry on from the sort values
+        page, total = search.query_page('post', 'hello', 2, page.next_cursor)
+        self.assertEqual((page.items, total), ([3, 4], None))
+        self.assertEqual(es.search.call_args.kwargs['from_'], 2)
+        self.assertEqual(es.search.call_args.kwargs['pit']['id'], 'pit-1')
+        page, _ = search.query_page('post', 'hello', 2, page.next_cursor)
+        self.assertEqual(page.items, [5, 6])
+        self.assertEqual(es.search.call_args.kwargs['search_after'], [2.0, 40])
+        self.assertEqual(es.search.call_args.kwargs['pit']['id'], 'pit-2')
+        self.assertIsNone(page.next_cursor)
+
+        # cursors that were tampered with are rejected
+        es.search.reset_mock()
+        for values in ([None, []], [None, ['offset']], [None, ['offset', -1]],
+                       [None, ['offset', 'x']], [None, ['x', 'y']], [None, [1.0, 2, 3]],
+                       [{}, ['offset', 2]], [None, 'offset'], [None]):
+            with self.assertRaises(InvalidCursor, msg=values):
+                search.query_page('post', 'hello', 2, encode_cursor(values, 'next'))
+        es.search.assert_not_called()
+
+    def test_task_in_progress(self):
+        u = User(username='john', email='john@example.com')
+        db.session.add_all([u, Task(id='1', name='export_posts', user=u)])
+        db.session.commit()
+        self.assertEqual(u.get_task_in_progress('export_posts').id, '1')
+        u.get_task_in_progress('export_posts').complete = True
+        db.session.commit()
+        self.assertIsNone(u.get_task_in_progress('export_posts'))
+
+    def test_task_progress_throttling(self):
+        u = User(username='john', email='john@example.com')
+        db.session.add(u)
+        db.session.commit()
+        job = self.app.task_queues['low'].enqueue('app.tasks.export_posts', u.id)
+        db.session.add(Task(id=job.get_id(), name='export_posts', user=u))
+        db.session.commit()
+
+        saved = []
+
+        def report(now, progress):
+            clock.monotonic.return_value = now
+            tasks._set_task_progress(progress)
+            saved.append(rq.job.Job.fetch(job.get_id(), connection=self.app.redis)
+                         .meta['progress'])
+
+        with mock.patch('app.tasks.get_current_job', return_value=job), \
+                mock.patch('app.tasks.time') as clock:
+            report(0.0, 0)
+            report(0.5, 50)   # too soon after the last update
+            report(2.0, 2)    # not far enough from the last update
+            report(3.0, 40)
+            report(3.1, 0)    # the start and the end are always saved
+            report(3.2, 100)
+        self.assertEqual(saved, [0, 0, 0, 40, 0, 100])
+        self.assertEqual([n['data']['progress'] for n in notification_store.history(u.id)],
+                         [0, 40, 0, 100])
+        self.assertTrue(db.session.get(Task, job.get_id()).complete)
+
+    def test_task_load_progress(self):
+        u = User(username='john', email='john@example.com')
+        db.session.add(u)
+        db.session.commit()
+        queue = self.app.task_queues['low']
+        running = queue.enqueue('app.tasks.export_posts', u.id)
+        running.meta['progress'] = 40
+        running.save_meta()
+        queued = queue.enqueue('app.tasks.export_posts', u.id)
+        db.session.add_all([
+            Task(id=running.get_id(), name='export_posts', user=u),
+            Task(id=queued.get_id(), name='export_posts', user=u),
+            # the job of a task that finished long ago has expired
+            Task(id='gone', name='export_posts', user=u),
+        ])
+        db.session.commit()
+
+        with mock.patch.object(rq.job.Job, 'fetch_many', wraps=rq.job.Job.fetch_many) as fetch:
+            tasks_in_progress = u.get_tasks_in_progress()
+            progress = {task.id: task.get_progress() for task in tasks_in_progress}
+        fetch.assert_called_once()
+        self.assertEqual(progress, {running.get_id(): 40, queued.get_id(): 0, 'gone': 100})
+
+    def test_launch_task(self):
+        exports_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(exports_dir.cleanup)
+        self.app.config['EXPORTS_DIR'] = exports_dir.name
+        john = User(username='john', email='john@example.com')
+        db.session.add(john)
+        db.session.commit()
+        lock = f'task-lock:export_posts:{john.id}'
+
+        # exports are routed to the low priority queue
+        task = john.launch_task('export_posts', 'Exporting posts...')
+        db.session.commit()
+        self.assertEqual(self.app.task_queues['low'].job_ids, [task.id])
+        self.assertEqual(self.app.task_queues['default'].count, 0)
+        self.assertEqual(self.app.task_queues['high'].count, 0)
+        self.assertTrue(self.app.redis.exists(lock))
+
+        # the task can't be launched again while it is pending
+        self.assertIsNone(john.launch_task('export_posts', 'Exporting posts...'))
+        self.assertEqual(self.app.task_queues['low'].count, 1)
+        self.assertEqual(len(db.session.scalars(john.tasks.select()).all()), 1)
+
+        # the lock is freed once the task completes
+        self.run_jobs()
+        self.assertTrue(db.session.get(Task, task.id).complete)
+        self.assertFalse(self.app.redis.exists(lock))
+
+        # and when the task could not be enqueued
+        with mock.patch('app.jobs.enqueue', side_effect=redis.exceptions.ConnectionError):
+            with self.assertRaises(redis.exceptions.ConnectionError):
+                john.launch_task('export_posts', 'Exporting posts...')
+        self.assertFalse(self.app.redis.exists(lock))
+
+    def test_conversations(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        u3 = User(username='mary', email='mary@example.com')
+        db.session.add_all([u1, u2, u3])
+        db.session.commit()
+        now = datetime.now(timezone.utc)
+        for i, (sender, recipient) in enumerate([(u1, u2), (u2, u1), (u1, u2), (u3, u2)]):
+            msg = Message(author=sender, recipient=recipient, body=str(i),
+                          timestamp=now + timedelta(seconds=i))
+            db.session.add(msg)
+            Conversation.add_message(msg)
+            recipient.add_unread_message()
+            db.session.commit()
+
+        inbox = keyset_paginate(u2.conversations.select(), Conversation.inbox_keys())
+        self.assertEqual([c.peer for c in inbox.items], [u3, u1])
+        self.assertEqual([c.unread_count for c in inbox.items], [1, 2])
+        self.assertEqual(inbox.items[1].last_message.body, '2')
+        thread = db.session.scalars(Message.between(u1, u2)).all()
+        self.assertEqual(sorted(m.body for m in thread), ['0', '1', '2'])
+
+        self.assertTrue(u2.mark_messages_read(u1))
+        db.session.commit()
+        self.assertEqual(u2.unread_message_count(), 1)
+        self.assertFalse(u2.mark_messages_read(u1))
+        self.assertEqual(User.reconcile_counters(), 0)
+
+    def test_database_search(self):
+        u = User(username='john', email='john@example.com')
+        p1 = Post(body='my dog chased the cat', author=u)
+        p2 = Post(body='dog days, dog nights', author=u)
+        p3 = Post(body='nothing to see here', author=u)
+        db.session.add_all([u, p1, p2, p3])
+        db.session.commit()
+
+        page, total = Post.search('Dog', per_page=10)
+        self.assertEqual(page.items, [p2, p1])
+        self.assertEqual(total, 2)
+        self.assertFalse(page.has_next)
+
+        page, total = Post.search('cat see', per_page=1)
+        self.assertEqual(total, 2)
+        found = page.items
+        page, total = Post.search('cat see', page.next_cursor, per_page=1)
+        self.assertIsNone(total)
+        self.assertFalse(page.has_next)
+        found += page.items
+        self.assertEqual(sorted(post.id for post in found), [p1.id, p3.id])
+        page, _ = Post.search('cat see', page.prev_cursor, per_page=1)
+        self.assertEqual(page.items, found[:1])
+
+        p1.body = 'my bird'
+        db.session.delete(p2)
+        db.session.commit()
+        self.assertEqual(Post.search('dog')[1], 0)
+        self.assertEqual(Post.search('bird')[0].items, [p1])
+        self.assertEqual(Post.reindex()[1], 2)
+        self.assertEqual(Post.search('bird')[0].items, [p1])
+
 
 if __name__ == '__main__':
     unittest.main(verbosity=2)